@@ -0,0 +1,72 @@
+'''
+Simple in-memory caches for data requested to the EC platform APIs
+
+Caches are per process, so each web server worker keeps its own copy.
+'''
+import threading
+import time
+
+
+class TTLCache(object):
+    '''
+    Dictionary-like cache that keeps track of when each entry was stored
+
+    Entries are not removed when they get old, callers decide how old an
+    entry can be when getting it (so it can still be used as a fallback if
+    a new value can not be obtained). Once `max_size` entries are stored
+    the oldest ones are removed.
+
+    :param max_size: maximum number of entries to keep (default 1000)
+    :type max_size: int
+    '''
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, max_age=None):
+        '''
+        Returns the value stored for a key and its age
+
+        :param key: the cache key
+        :param max_age: if provided, entries older than this (in seconds) are
+                        ignored
+        :type max_age: float
+
+        :returns: a tuple with the value and its age in seconds, or None if
+                  there is no entry for the key
+        :rtype: tuple
+        '''
+
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        value, stored = entry
+        age = time.time() - stored
+        if max_age is not None and age >= max_age:
+            return None
+
+        return value, age
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time())
+
+            if len(self._entries) > self.max_size:
+                oldest = sorted(self._entries.iteritems(),
+                                key=lambda item: item[1][1])
+                for old_key, entry in oldest[:len(oldest) - self.max_size]:
+                    del self._entries[old_key]
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,479 @@
+'''
+Shared HTTP client for the EC platform APIs
+
+All calls to the EC Data Collection, Metadata and Identity APIs should go
+through the functions in this module rather than the module level
+`requests` functions, so connections are pooled and kept alive between
+calls instead of opening a new TCP (and TLS) connection every time.
+
+One `requests.Session` is created per process and EC base URL (scheme and
+host), lazily on first use, so it is safe to use after the web server or
+harvest workers fork.
+
+Relevant configuration options:
+
+    # Number of different hosts to keep pools for (default 10)
+    ckanext.glasgow.http.pool_connections = 10
+
+    # Maximum number of connections kept alive per host (default 10)
+    ckanext.glasgow.http.pool_maxsize = 10
+
+    # Default timeouts in seconds, used when the caller does not provide
+    # one (defaults 10 and 50)
+    ckanext.glasgow.http.connect_timeout = 10
+    ckanext.glasgow.http.timeout = 50
+
+Requests using idempotent methods (GET, HEAD and OPTIONS) are retried on
+connection errors, timeouts and 502, 503 and 504 responses, waiting twice
+as long after each attempt:
+
+    # Number of retries (default 2) and initial wait in seconds (default
+    # 0.5)
+    ckanext.glasgow.http.retries = 2
+    ckanext.glasgow.http.retry_backoff = 0.5
+
+Each host has a circuit breaker. After a number of consecutive failures
+(as above) it opens, and requests to that host fail straight away with
+`CircuitOpenError` instead of waiting for the timeout. Once `reset_timeout`
+seconds have passed a single trial request is let through, closing the
+circuit again if it succeeds:
+
+    # Consecutive failures to open the circuit (default 5, 0 disables it)
+    ckanext.glasgow.http.circuit_breaker.failures = 5
+    ckanext.glasgow.http.circuit_breaker.reset_timeout = 30
+
+The latency, status and size of every request are recorded, see
+`ckanext.glasgow.metrics`.
+
+'''
+import logging
+import threading
+import time
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from pylons import config
+
+import ckan.plugins as p
+
+from ckanext.glasgow import metrics
+
+
+log = logging.getLogger(__name__)
+
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+RETRY_STATUS_CODES = frozenset([502, 503, 504])
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    '''
+    Raised instead of sending a request while the EC API is unavailable
+
+    It is a `ConnectionError`, so callers handling those (or any
+    `RequestException`) need no changes.
+    '''
+    pass
+
+
+class CircuitBreaker(object):
+    '''
+    Keeps track of consecutive failures of the requests to a host
+
+    The circuit is `closed` while requests work. After `failures`
+    consecutive failures it becomes `open` and requests are not allowed
+    until `reset_timeout` seconds have passed. Then it is `half_open`: one
+    trial request is allowed, and depending on its result the circuit is
+    closed or opened again.
+
+    :param failures: consecutive failures needed to open the circuit (0
+                     means never)
+    :type failures: int
+    :param reset_timeout: seconds to wait before allowing a trial request
+    :type reset_timeout: float
+    '''
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failures=5, reset_timeout=30):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+
+        self.consecutive_failures = 0
+        self.opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened is None:
+            return self.CLOSED
+        if time.time() - self.opened >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def before_request(self):
+        '''
+        Checks if a request can be sent
+
+        :raises: :py:exc:`CircuitOpenError` if the circuit is open, or if
+            it is half open and the trial request is still in progress
+        '''
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return
+            if state == self.HALF_OPEN and not self._trial:
+                self._trial = True
+                return
+
+        raise CircuitOpenError(
+            'The EC API is unavailable after {0} consecutive failures, '
+            'not sending request'.format(self.consecutive_failures))
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            self.opened = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self._trial or (
+                    self.opened is None and self.failures and
+                    self.consecutive_failures >= self.failures):
+                self.opened = time.time()
+            self._trial = False
+
+    def cancel(self):
+        '''
+        Called when a request could not be completed for reasons not
+        related to the EC API health, to allow a new trial request
+        '''
+        with self._lock:
+            self._trial = False
+
+    def as_dict(self):
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'opened': self.opened,
+        }
+
+
+def _get_base_url(url):
+    parts = urlparse.urlsplit(url)
+    return '{0}://{1}'.format(parts.scheme, parts.netloc)
+
+
+def _get_default_timeout():
+    connect_timeout = float(
+        config.get('ckanext.glasgow.http.connect_timeout', 10))
+    read_timeout = float(config.get('ckanext.glasgow.http.timeout', 50))
+
+    return (connect_timeout, read_timeout)
+
+
+def _new_session():
+
+    pool_connections = p.toolkit.asint(
+        config.get('ckanext.glasgow.http.pool_connections', 10))
+    pool_maxsize = p.toolkit.asint(
+        config.get('ckanext.glasgow.http.pool_maxsize', 10))
+
+    adapter = HTTPAdapter(pool_connections=pool_connections,
+                          pool_maxsize=pool_maxsize)
+
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+def get_session(url):
+    '''
+    Returns the shared `requests.Session` for the host of the provided URL
+
+    :param url: any URL on the EC API (eg the one returned by
+                `_get_api_endpoint`)
+    :type url: string
+
+    :returns: a session with a keep-alive connection pool for that host
+    :rtype: requests.Session
+    '''
+
+    base_url = _get_base_url(url)
+
+    session = _sessions.get(base_url)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(base_url)
+            if session is None:
+                log.debug('Creating HTTP session for {0}'.format(base_url))
+                session = _new_session()
+                _sessions[base_url] = session
+
+    return session
+
+
+def get_circuit_breaker(url):
+    '''
+    Returns the circuit breaker for the host of the provided URL
+
+    :rtype: :py:class:`CircuitBreaker`
+    '''
+
+    base_url = _get_base_url(url)
+
+    breaker = _circuit_breakers.get(base_url)
+    if breaker is None:
+        with _circuit_breakers_lock:
+            breaker = _circuit_breakers.get(base_url)
+            if breaker is None:
+                breaker = CircuitBreaker(
+                    failures=p.toolkit.asint(config.get(
+                        'ckanext.glasgow.http.circuit_breaker.failures', 5)),
+                    reset_timeout=float(config.get(
+                        'ckanext.glasgow.http.circuit_breaker.reset_timeout',
+                        30)))
+                _circuit_breakers[base_url] = breaker
+
+    return breaker
+
+
+def is_available(url=None):
+    '''
+    Checks whether requests to the EC API are currently being sent
+
+    Controllers can use this to avoid calling actions that need the EC API
+    (or to show a warning) while it is unavailable.
+
+    :param url: any URL on the EC API host to check. If not provided, all
+                hosts used so far are checked.
+    :type url: string
+
+    :returns: False if the circuit breaker for the host (or any host) is
+              open, True otherwise
+    :rtype: bool
+    '''
+
+    if url is not None:
+        breakers = [get_circuit_breaker(url)]
+    else:
+        breakers = _circuit_breakers.values()
+
+    return not any(breaker.state == CircuitBreaker.OPEN
+                   for breaker in breakers)
+
+
+def get_circuit_states():
+    '''
+    Returns the state of the circuit breakers for all hosts used so far
+
+    :returns: a dict with the base URLs as keys and dicts with the `state`,
+              `consecutive_failures` and `opened` time as values
+    :rtype: dict
+    '''
+
+    return dict((base_url, breaker.as_dict())
+                for base_url, breaker in _circuit_breakers.items())
+
+
+def reset():
+    '''
+    Closes all pooled connections and resets the circuit breakers
+
+    Sessions will be created again on the next request.
+    '''
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+    with _circuit_breakers_lock:
+        _circuit_breakers.clear()
+
+
+def request(method, url, retries=None, **kwargs):
+    '''
+    Sends a request to the EC API using the pooled session for its host
+
+    Accepts the same parameters as `requests.request`. If no `timeout` is
+    provided the configured defaults will be used.
+
+    Connection errors, timeouts and 502, 503 and 504 responses are retried
+    with exponential backoff. Bodies with a `rewind` method (eg
+    :py:class:`ckanext.glasgow.streaming.MultipartEncoder`) are rewound
+    before being sent again.
+
+    :param retries: number of times to retry the request. By default the
+                    configured retries for idempotent methods and none for
+                    the rest. Only pass it for other methods if sending the
+                    request twice is safe.
+    :type retries: int
+
+    :raises: :py:exc:`CircuitOpenError` if the EC API host is unavailable
+
+    :returns: the response object
+    :rtype: requests.Response
+    '''
+
+    if kwargs.get('timeout') is None:
+        kwargs['timeout'] = _get_default_timeout()
+
+    if retries is None:
+        if method.upper() in IDEMPOTENT_METHODS:
+            retries = p.toolkit.asint(
+                config.get('ckanext.glasgow.http.retries', 2))
+        else:
+            retries = 0
+
+    session = get_session(url)
+    breaker = get_circuit_breaker(url)
+    data = kwargs.get('data')
+
+    operation = metrics.get_operation(method, url)
+    start = time.time()
+    status = 'error'
+    response = None
+    attempt = 0
+    try:
+        while True:
+            breaker.before_request()
+            try:
+                response = session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout), e:
+                breaker.record_failure()
+                if attempt >= retries:
+                    raise
+                reason = str(e)
+            except Exception:
+                breaker.cancel()
+                raise
+            else:
+                status = response.status_code
+                if status not in RETRY_STATUS_CODES:
+                    breaker.record_success()
+                    return response
+
+                breaker.record_failure()
+                if attempt >= retries:
+                    return response
+                reason = 'status {0}'.format(status)
+                response.close()
+                response = None
+                status = 'error'
+
+            attempt += 1
+            wait = float(config.get('ckanext.glasgow.http.retry_backoff',
+                                    0.5)) * 2 ** (attempt - 1)
+            log.warning('Request {0} {1} failed ({2}), retrying in {3}s '
+                        '({4}/{5})'.format(method, url, reason, wait,
+                                           attempt, retries))
+            time.sleep(wait)
+
+            if hasattr(data, 'rewind'):
+                data.rewind()
+    except CircuitOpenError:
+        status = 'circuit_open'
+        raise
+    finally:
+        metrics.record(operation, time.time() - start, status,
+                       bytes_sent=_get_body_size(data),
+                       bytes_received=_get_body_size(response),
+                       retries=attempt)
+
+
+def _get_body_size(body):
+    '''
+    Returns the size of a request body or response, if known
+
+    The size of streamed responses is taken from their `Content-Length`
+    header, as the body has not been read yet.
+    '''
+
+    if isinstance(body, basestring):
+        return len(body)
+    if isinstance(body, requests.Response):
+        if body._content is not False:
+            # Not streamed, the body has been read already
+            return len(body.content or '')
+        length = body.headers.get('Content-Length', '')
+        return int(length) if length.isdigit() else 0
+
+    # Streamed bodies like `streaming.MultipartEncoder`
+    length = getattr(body, 'len', None)
+    if isinstance(length, (int, long)):
+        return length
+
+    return 0
+
+
+def get(url, **kwargs):
+    '''
+    Sends a GET request to the EC API, see `request`
+    '''
+
+    return request('GET', url, **kwargs)
+
+
+def imap_concurrently(function, items, concurrency, initializer=None):
+    '''
+    Calls `function` on each of the items using a bounded thread pool
+
+    This is meant for functions that mostly wait on the EC API. They should
+    not touch the database, as the SQLAlchemy session is not shared between
+    threads, and they should handle their own exceptions.
+
+    :param function: function accepting a single item
+    :param items: list of items to process
+    :param concurrency: maximum number of threads to use. If lower than 2
+                        items are processed serially in the current thread.
+    :type concurrency: int
+    :param initializer: function called without arguments when each worker
+                        thread starts (eg to set up thread-local state).
+                        It is not called when processing items serially.
+
+    :returns: an iterator over the results, in the same order as `items`.
+              Results are available as soon as they and all the previous
+              ones have finished, so the caller can start processing them
+              while the rest are still running.
+    :rtype: iterator
+    '''
+
+    items = list(items)
+    concurrency = min(concurrency, len(items))
+
+    if concurrency < 2:
+        for item in items:
+            yield function(item)
+        return
+
+    pool = ThreadPool(concurrency, initializer)
+    try:
+        for result in pool.imap(function, items, chunksize=1):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def map_concurrently(function, items, concurrency):
+    '''
+    Same as `imap_concurrently` but returns a list with all the results
+    '''
+
+    return list(imap_concurrently(function, items, concurrency))
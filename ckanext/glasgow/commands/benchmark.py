@@ -0,0 +1,119 @@
+import sys
+import json
+
+from ckan import model
+from ckan.lib.cli import CkanCommand
+
+
+class Benchmark(CkanCommand):
+    '''Times the EC harvesters against a synthetic catalogue
+
+    Usage:
+
+      glasgow_benchmark [--organizations N] [--datasets N] [--files N]
+                        [--versions N] [--audits N] [--faults FILE]
+                        [--output FILE] [--rebuild-db]
+        - Serves a generated catalogue from the mock EC API, runs an
+          initial harvest and a changelog harvest against it and writes
+          the timings of each stage as JSON.
+
+    The harvests write to the configured database, so run this against a
+    test one (eg with `-c test.ini`). Use `--rebuild-db` to empty it first,
+    which is required if it already contains datasets. Needs the test
+    requirements (Flask) to run the mock EC API.
+
+    To measure how the harvesters cope with a slow or failing EC API, pass
+    a JSON file with the faults to inject on the mock EC API routes with
+    `--faults` (see `mock_ec.load_faults`).
+
+    '''
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+
+    def __init__(self, name):
+
+        super(Benchmark, self).__init__(name)
+
+        self.parser.add_option('--organizations', dest='organizations',
+                               type='int', default=5,
+                               help='Number of organizations (default 5)')
+        self.parser.add_option('--datasets', dest='datasets',
+                               type='int', default=20,
+                               help='Number of datasets per organization '
+                                    '(default 20)')
+        self.parser.add_option('--files', dest='files',
+                               type='int', default=3,
+                               help='Number of files per dataset (default 3)')
+        self.parser.add_option('--versions', dest='versions',
+                               type='int', default=2,
+                               help='Number of versions per file (default 2)')
+        self.parser.add_option('--audits', dest='audits',
+                               type='int', default=100,
+                               help='Number of changelog audits (default '
+                                    '100)')
+        self.parser.add_option('--page-size', dest='page_size',
+                               type='int', default=1000,
+                               help='Records per page on the EC API list '
+                                    'endpoints (default 1000)')
+        self.parser.add_option('--seed', dest='seed', type='int', default=0,
+                               help='Seed for the generated catalogue '
+                                    '(default 0)')
+        self.parser.add_option('--port', dest='port', type='int',
+                               default=7072,
+                               help='Port for the mock EC API (default '
+                                    '7072)')
+        self.parser.add_option('--faults', dest='faults', default=None,
+                               help='JSON file with the faults to inject on '
+                                    'the mock EC API')
+        self.parser.add_option('--output', dest='output', default=None,
+                               help='File to write the results to (default '
+                                    'standard output)')
+        self.parser.add_option('--rebuild-db', dest='rebuild_db',
+                               action='store_true', default=False,
+                               help='Empty the database before running')
+
+    def command(self):
+        self._load_config()
+
+        import ckanext.harvest.model as harvest_model
+        import ckanext.glasgow.model as custom_model
+        from ckanext.glasgow.tests import mock_ec
+        from ckanext.glasgow.tests.benchmark import Catalogue, run_benchmark
+
+        if self.options.rebuild_db:
+            model.repo.rebuild_db()
+        elif model.Session.query(model.Package).count():
+            print ('The database already contains datasets, run the '
+                   'benchmark on an empty test database (--rebuild-db)')
+            sys.exit(1)
+
+        harvest_model.setup()
+        custom_model.setup()
+
+        catalogue = Catalogue(
+            organizations=self.options.organizations,
+            datasets=self.options.datasets,
+            files=self.options.files,
+            versions=self.options.versions,
+            audits=self.options.audits,
+            page_size=self.options.page_size,
+            seed=self.options.seed,
+        )
+
+        if self.options.faults:
+            mock_ec.load_faults(self.options.faults)
+
+        results = run_benchmark(catalogue, port=self.options.port)
+
+        for stage in results['stages']:
+            print >> sys.stderr, (
+                '{name}: {objects} objects, {errors} errors in '
+                '{seconds:.2f}s'.format(**stage))
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        if self.options.output:
+            with open(self.options.output, 'w') as f:
+                f.write(output)
+        else:
+            print output
@@ -1,39 +1,155 @@
 import sys
+import json
+import time
 
+import requests
 from sqlalchemy import or_
 
 from ckan import model
 from ckan.lib.cli import CkanCommand
+import ckan.lib.dictization.model_dictize as model_dictize
 from ckan.plugins import toolkit
 
-from ckanext.glasgow.model import harvest_last_audit_table
-from ckanext.glasgow.logic.action import ECAPIError
-from ckanext.glasgow.harvesters.changelog import save_last_audit_id
+from ckanext.glasgow import client
+
+from ckanext.glasgow.model import (
+    harvest_last_audit_table,
+    harvest_initial_checkpoint_table,
+    ec_request_task_table,
+)
+from ckanext.glasgow.logic.action import (
+    _get_api_auth_token,
+    _save_task_statuses,
+    apply_task_status_operation,
+    request_task_status_operation,
+)
+from ckanext.glasgow.harvesters.changelog import (
+    _end_savepoint,
+    save_last_audit_id,
+)
 
 
 class UpdateFromEcApiChangeLog(CkanCommand):
-    summary = "--NO SUMMARY--"
-    usage = "--NO USAGE--"
+    '''Checks the status of all pending requests to the EC API
+
+    Usage:
+
+      changelog_update [-j CONCURRENCY] [-t TIMEOUT] [-b BATCH_SIZE]
+        - Requests the status of all tasks sent to the EC API, up to
+          CONCURRENCY at the same time, and updates them.
+
+    '''
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+
+    def __init__(self, name):
+
+        super(UpdateFromEcApiChangeLog, self).__init__(name)
+
+        self.parser.add_option('-j', '--concurrency', dest='concurrency',
+                               type='int', default=8,
+                               help='Number of requests to the EC API to '
+                                    'run at the same time (default 8)')
+        self.parser.add_option('-t', '--timeout', dest='timeout',
+                               type='float', default=20,
+                               help='Timeout in seconds for each request to '
+                                    'the EC API (default 20)')
+        self.parser.add_option('-b', '--batch-size', dest='batch_size',
+                               type='int', default=100,
+                               help='Number of task updates to commit at '
+                                    'once (default 100)')
 
     def command(self):
         self._load_config()
+
+        start = time.time()
+
         pending_tasks = model.Session.query(model.TaskStatus) \
             .filter(or_(model.TaskStatus.state == 'in_progress',
                     model.TaskStatus.state == 'sent'))
 
-        check_for_update = toolkit.get_action('check_for_task_status_update')
-        for task in pending_tasks.all():
-            context = {
-                'model': model,
-                'session': model.Session,
-                'ignore_auth': True,
-            }
+        task_dicts = [model_dictize.task_status_dictize(task, {'model': model})
+                      for task in pending_tasks.all()]
+
+        # The token is read once, as the worker threads can not access it
+        headers = {
+            'Authorization': _get_api_auth_token(),
+            'Content-Type': 'application/json',
+        }
+        timeout = self.options.timeout
+
+        def request_operation(task_dict):
             try:
-                check_for_update(context, {'task_id': task.id})
-                print 'updated task {0}'.format(task.id)
-            except ECAPIError, e:
-                print 'failed to update task {0}: {1}'.format(task.id,
-                                                              e.extra_msg)
+                latest = request_task_status_operation(
+                    task_dict, headers=headers, timeout=timeout)
+                return task_dict, latest, None
+            except (toolkit.ValidationError,
+                    requests.exceptions.RequestException), e:
+                return task_dict, None, e
+
+        context = {
+            'model': model,
+            'session': model.Session,
+            'ignore_auth': True,
+            'defer_commit': True,
+        }
+
+        updated = []
+        failed = 0
+        batch = []
+        for task_dict, latest, error in client.imap_concurrently(
+                request_operation, task_dicts, self.options.concurrency):
+            if error:
+                failed += 1
+                print 'failed to update task {0}: {1}'.format(
+                    task_dict['id'], _error_message(error))
+                continue
+
+            # The actions run for each task (eg creating the dataset) are
+            # committed along with the batch, on a savepoint so a failing
+            # one does not roll back the rest
+            savepoint = model.Session.begin_nested()
+            try:
+                updated_dict = apply_task_status_operation(
+                    context.copy(), task_dict, latest, save=False)
+                _end_savepoint(savepoint)
+            except toolkit.ValidationError, e:
+                # The task will be checked again on the next run
+                _end_savepoint(savepoint, commit=False)
+                failed += 1
+                print 'failed to update task {0}: {1}'.format(
+                    task_dict['id'], _error_message(e))
+                continue
+
+            if updated_dict:
+                batch.append(updated_dict)
+
+            if len(batch) >= self.options.batch_size:
+                updated.extend(self._commit(context, batch))
+                batch = []
+
+        updated.extend(self._commit(context, batch))
+
+        elapsed = time.time() - start
+        print ('Checked {0} tasks in {1:.1f}s ({2:.1f} tasks/s): '
+               '{3} updated, {4} unchanged, {5} failed').format(
+            len(task_dicts), elapsed, len(task_dicts) / max(elapsed, 0.001),
+            len(updated), len(task_dicts) - len(updated) - failed, failed)
+
+    def _commit(self, context, task_dicts):
+        # Save the batch of tasks and commit it with the changes made by
+        # the actions run for them
+        context = dict(context, defer_commit=False)
+        task_ids = [task_dict['id'] for task_dict in
+                    _save_task_statuses(context, task_dicts)]
+        for task_id in task_ids:
+            print 'updated task {0}'.format(task_id)
+        return task_ids
+
+
+def _error_message(error):
+    return getattr(error, 'error_dict', None) or str(error)
 
 
 class ChangelogAudit(CkanCommand):
@@ -91,6 +207,65 @@ class ChangelogAudit(CkanCommand):
         print 'Set last audit id to', audit_id
 
 
+class RequestTasks(CkanCommand):
+    '''Manages the index of EC request ids to task statuses
+
+    Usage:
+
+      request_tasks backfill
+        - Index the request ids of all existing task statuses (only needed
+          for tasks created before the index was added).
+
+    '''
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+
+    def command(self):
+
+        self._load_config()
+        if len(self.args) == 0:
+            self.parser.print_usage()
+            sys.exit(1)
+
+        cmd = self.args[0]
+        if cmd == 'backfill':
+            self._backfill()
+
+    def _backfill(self):
+
+        existing = set(r[0] for r in model.Session.query(
+            ec_request_task_table.c.request_id))
+
+        tasks = model.Session.query(model.TaskStatus.id,
+                                    model.TaskStatus.value) \
+            .order_by(model.TaskStatus.last_updated) \
+            .yield_per(1000)
+
+        rows = {}
+        for task_id, value in tasks:
+            try:
+                value = json.loads(value)
+            except (TypeError, ValueError):
+                continue
+            request_id = (value.get('request_id')
+                          if isinstance(value, dict) else None)
+            if not request_id or unicode(request_id) in existing:
+                continue
+
+            # If there is more than one, use the most recent task
+            rows[unicode(request_id)] = task_id
+
+        if rows:
+            model.Session.execute(
+                ec_request_task_table.insert(),
+                [{'request_id': request_id, 'task_id': task_id}
+                 for request_id, task_id in rows.iteritems()])
+            model.Session.commit()
+
+        print 'Indexed {0} request ids'.format(len(rows))
+
+
 class Cleanup(CkanCommand):
     '''Cleans up DB tables
 
@@ -99,6 +274,10 @@ class Cleanup(CkanCommand):
       db_clean harvest
         - Clean up harvest tables (jobs, objects, extras and errors)
 
+      db_clean checkpoints
+        - Clear the initial harvest checkpoints (ie next initial harvest
+          will start from the first organization).
+
     '''
 
     summary = __doc__.split('\n')[0]
@@ -114,6 +293,13 @@ class Cleanup(CkanCommand):
         cmd = self.args[0]
         if cmd == 'harvest':
             self._clear_harvest()
+        elif cmd == 'checkpoints':
+            self._clear_checkpoints()
+
+    def _clear_checkpoints(self):
+        model.Session.execute(harvest_initial_checkpoint_table.delete())
+        model.Session.commit()
+        print 'Initial harvest checkpoints table emptied'
 
     def _clear_harvest(self):
 
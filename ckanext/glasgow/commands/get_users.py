@@ -3,7 +3,6 @@ import uuid
 import urllib
 
 from pylons import config
-import requests
 
 from ckan import model
 from ckan.lib.cli import CkanCommand
@@ -15,6 +14,7 @@ from ckanext.glasgow.logic.schema import (
     user_schema
 )
 
+from ckanext.glasgow import client
 from ckanext.glasgow.harvesters import get_org_name
 from ckanext.glasgow.harvesters.ec_harvester import _fetch_from_ec
 
@@ -77,7 +77,7 @@ def create_orgs(organization_id, site_user):
     api_url = config.get('ckanext.glasgow.metadata_api', '').rstrip('/')
     api_endpoint = '{}/Metadata/Organisation/{}'.format(api_url, organization_id)
 
-    request = requests.get(api_endpoint, verify=False)
+    request = client.get(api_endpoint, verify=False)
     try:
         result = _fetch_from_ec(request)
         org = result['MetadataResultSet'][0]
@@ -1,4 +1,5 @@
 import json
+import logging
 
 from pylons import config
 
@@ -8,12 +9,24 @@ from ckan.controllers.package import PackageController
 
 import ckan.plugins as p
 
+from ckanext.glasgow import client, tokens
 from ckanext.glasgow.logic.action import (
     ECAPINotAuthorized,
     ECAPIError,
 )
 
 
+log = logging.getLogger(__name__)
+
+EC_UNAVAILABLE_MESSAGE = ('The EC platform is currently unavailable, '
+                          'please try again later')
+
+HOP_BY_HOP_HEADERS = frozenset([
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailers', 'transfer-encoding', 'upgrade',
+])
+
+
 class DatasetController(PackageController):
 
     def read(self, id, format='html'):
@@ -40,6 +53,9 @@ class DatasetController(PackageController):
             except ECAPIError, e:
                 change_request = None
                 #flash
+            except client.CircuitOpenError:
+                helpers.flash_error(EC_UNAVAILABLE_MESSAGE)
+                change_request = None
             except p.toolkit.NotAuthorized:
                 change_request = None
 
@@ -70,6 +86,9 @@ class DatasetController(PackageController):
                     context, {'id': pending_task['value'].get('request_id')})[-1]
             except ECAPIError, e:
                 change_request = None
+            except client.CircuitOpenError:
+                helpers.flash_error(EC_UNAVAILABLE_MESSAGE)
+                change_request = None
 
             vars = {
                 'task': pending_task,
@@ -124,8 +143,10 @@ class DatasetController(PackageController):
                     if not token.startswith('Bearer '):
                         token = 'Bearer ' + token
                     f.write(token)
-                    vars = {'msg': 'Authorization token updated'}
-                    return p.toolkit.render('auth_token.html', extra_vars=vars)
+                # Stop using the previous token, cached on this process
+                tokens.invalidate(('tmp_auth_token_file', tmp_token_file))
+                vars = {'msg': 'Authorization token updated'}
+                return p.toolkit.render('auth_token.html', extra_vars=vars)
 
             except IOError:
                 error = ('Could not write to temp auth token file: {0}'
@@ -216,6 +237,9 @@ class DatasetController(PackageController):
             helpers.flash_error('{0}'.format(e.error_dict['message']))
         except ECAPIError:
             helpers.flash_error('{0}'.format(e.error_dict['message']))
+        except client.CircuitOpenError:
+            helpers.flash_error(EC_UNAVAILABLE_MESSAGE)
+            request_status = None
         except p.toolkit.NotAuthorized:
             return p.toolkit.abort(401, p.toolkit._('Not authorized to view change requests'))
 
@@ -232,6 +256,8 @@ class DatasetController(PackageController):
             approvals_list = p.toolkit.get_action('approvals_list')({}, {})
         except (ECAPINotAuthorized, p.toolkit.ValidationError), e:
             helpers.flash_error('The EC API returned and error: {0}'.format(str(e)))
+        except client.CircuitOpenError:
+            helpers.flash_error(EC_UNAVAILABLE_MESSAGE)
 
         except p.toolkit.NotAuthorized:
 
@@ -249,6 +275,8 @@ class DatasetController(PackageController):
                 'accept': accept})
         except p.toolkit.ValidationError, e:
             helpers.flash_error('The EC API returned and error: {0}'.format(str(e)))
+        except client.CircuitOpenError:
+            helpers.flash_error(EC_UNAVAILABLE_MESSAGE)
         else:
             if accept:
                 helpers.flash_success('Request {0} approved'.format(id))
@@ -259,13 +287,31 @@ class DatasetController(PackageController):
 
     def approval_download(self, id):
 
+        request_headers = p.toolkit.request.headers
         try:
             download = p.toolkit.get_action('approval_download')({}, {
-                'request_id': id})
+                'request_id': id,
+                'stream': True,
+                # Allow resuming downloads and seeking
+                'range': request_headers.get('Range'),
+                'if_range': request_headers.get('If-Range'),
+            })
         except p.toolkit.ValidationError, e:
             helpers.flash_error('The EC API returned and error: {0}'.format(str(e)))
 
+            p.toolkit.redirect_to('approvals_list')
+        except client.CircuitOpenError:
+            helpers.flash_error(EC_UNAVAILABLE_MESSAGE)
+
             p.toolkit.redirect_to('approvals_list')
         else:
-            p.toolkit.response.headers = download['headers']
+            # Hop-by-hop headers only apply to the connection to the EC API
+            headers = dict(
+                (name, value) for name, value in download['headers'].items()
+                if name.lower() not in HOP_BY_HOP_HEADERS)
+            p.toolkit.response.headers = headers
+            p.toolkit.response.status_int = download['status']
+
+            # The file is sent to the client as it is downloaded, keeping
+            # the original Content-Length (and Content-Range) headers
             return download['content']
@@ -0,0 +1,25 @@
+import ckan.model as model
+from ckan.plugins import toolkit
+
+
+class MetricsController(toolkit.BaseController):
+
+    def show(self):
+        '''
+        EC API metrics in the Prometheus text format, for sysadmins only
+        '''
+        context = {
+            'model': model,
+            'session': model.Session,
+            'user': toolkit.c.user,
+        }
+        try:
+            text = toolkit.get_action('ec_api_metrics_show')(
+                context, {'format': 'prometheus'})
+        except toolkit.NotAuthorized:
+            return toolkit.abort(403, toolkit._(
+                'Not authorized to see the EC API metrics'))
+
+        toolkit.response.headers['Content-Type'] = (
+            'text/plain; version=0.0.4; charset=utf-8')
+        return text
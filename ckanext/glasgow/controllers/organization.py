@@ -7,6 +7,8 @@ from ckan import model
 from ckan import plugins as p
 import ckan.lib.helpers as helpers
 
+from ckanext.glasgow import client
+from ckanext.glasgow.controllers.dataset import EC_UNAVAILABLE_MESSAGE
 from ckanext.glasgow.logic.action import (
     ECAPINotAuthorized,
     ECAPIError,
@@ -36,6 +38,9 @@ class OrgController(OrganizationController):
             except ECAPIError, e:
                 change_request = None
                 #flash
+            except client.CircuitOpenError:
+                helpers.flash_error(EC_UNAVAILABLE_MESSAGE)
+                change_request = None
             except p.toolkit.NotAuthorized:
                 change_request = None
 
@@ -76,6 +81,9 @@ class OrgController(OrganizationController):
         except ECAPIError, e:
             helpers.flash_error('{0}'.format(e.error_dict['message']))
             request_status = None
+        except client.CircuitOpenError:
+            helpers.flash_error(EC_UNAVAILABLE_MESSAGE)
+            request_status = None
         except p.toolkit.NotAuthorized:
             return p.toolkit.abort(401, p.toolkit._('Not authorized to view change requests'))
             request_status = None
@@ -101,6 +109,9 @@ class OrgController(OrganizationController):
                 {'name': organization_id, 'organization_id': org['id']})
         except ECAPIError, e:
             helpers.flash_error('{0}'.format(e.error_dict['message']))
+        except client.CircuitOpenError:
+            helpers.flash_error(EC_UNAVAILABLE_MESSAGE)
+            tasks = []
         except p.toolkit.NotAuthorized:
             return p.toolkit.abort(401, p.toolkit._('Not authorized to view change requests'))
 
@@ -1,11 +1,14 @@
 import slugify
+from sqlalchemy import and_, or_, not_, select
 
 from ckan import plugins as p
 from ckan import model
+from ckan.model.types import make_uuid
 
 from ckanext.harvest.harvesters.base import HarvesterBase
 
 from ckanext.glasgow.logic.action import _expire_task_status
+from ckanext.glasgow.model import EcRequestTask
 
 
 class EcHarvester(HarvesterBase):
@@ -39,6 +42,196 @@ class EcHarvester(HarvesterBase):
         return self._user_name
 
 
+class HarvestObjectWriter(object):
+    '''
+    Buffers harvest objects, extras and errors and writes them in bulk
+
+    Instead of creating and saving `HarvestObject`, `HarvestObjectExtra` and
+    `HarvestObjectError` instances one by one (which flushes and commits
+    each time), rows are
+    buffered and written with multi-row inserts. Ids are generated when
+    the objects are added, so they can be returned to the harvest framework
+    straight away. Any other columns get their default values.
+
+    Nothing is committed until `commit` is called, so callers can write
+    other changes (eg the last audit id) in the same transaction.
+
+    :param harvest_job: the job the new objects belong to (not needed if
+                        only adding extras to existing objects)
+    :type harvest_job: HarvestJob
+    :param batch_size: number of buffered rows that triggers a write to the
+                       database (default 1000)
+    :type batch_size: int
+    '''
+
+    def __init__(self, harvest_job=None, batch_size=1000):
+        self.harvest_job = harvest_job
+        self.batch_size = batch_size
+        self._objects = []
+        self._extras = []
+        self._errors = []
+
+    def add(self, guid, content, extras=None):
+        '''
+        Adds a new harvest object
+
+        :param guid: the object guid
+        :param content: the object content
+        :param extras: list of (key, value) tuples to store as extras
+        :type extras: list
+
+        :returns: the id of the new harvest object
+        :rtype: string
+        '''
+
+        harvest_object_id = make_uuid()
+        self._objects.append({
+            'id': harvest_object_id,
+            'guid': unicode(guid),
+            'content': content,
+            'harvest_job_id': self.harvest_job.id,
+            'harvest_source_id': self.harvest_job.source_id,
+        })
+
+        for key, value in extras or []:
+            self.add_extra(harvest_object_id, key, value)
+
+        self._flush_if_needed()
+
+        return harvest_object_id
+
+    def add_extra(self, harvest_object_id, key, value):
+        '''
+        Adds a new extra to a harvest object (new or existing)
+        '''
+        self._extras.append({
+            'id': make_uuid(),
+            'harvest_object_id': harvest_object_id,
+            'key': key,
+            'value': value,
+        })
+
+        self._flush_if_needed()
+
+    def add_error(self, harvest_object_id, message, stage):
+        '''
+        Adds a new error to a harvest object (new or existing)
+        '''
+        self._errors.append({
+            'id': make_uuid(),
+            'harvest_object_id': harvest_object_id,
+            'message': message,
+            'stage': stage,
+        })
+
+        self._flush_if_needed()
+
+    def _flush_if_needed(self):
+        if (len(self._objects) + len(self._extras) +
+                len(self._errors)) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes all buffered rows to the database, without committing
+        '''
+        from ckanext.harvest.model import (
+            harvest_object_table,
+            harvest_object_extra_table,
+            harvest_object_error_table,
+        )
+
+        # Objects first, as extras and errors reference them
+        if self._objects:
+            model.Session.execute(harvest_object_table.insert(),
+                                  self._objects)
+            self._objects = []
+        if self._extras:
+            model.Session.execute(harvest_object_extra_table.insert(),
+                                  self._extras)
+            self._extras = []
+        if self._errors:
+            model.Session.execute(harvest_object_error_table.insert(),
+                                  self._errors)
+            self._errors = []
+
+    def commit(self):
+        '''
+        Writes all buffered rows and commits the current transaction
+        '''
+        self.flush()
+        model.Session.commit()
+
+
+def supersede_harvest_objects(harvest_objects, purge=False):
+    '''
+    Makes the provided harvest objects the current ones for their datasets
+
+    Any other current objects with the same package id or guid are marked
+    as not current with a single UPDATE, or deleted (along with their
+    extras and errors) if `purge` is set, so the harvest object table does
+    not keep growing with every update. Objects from the same jobs as the
+    provided ones are never deleted, as the job may still write extras or
+    errors for them. The provided objects are left
+    untouched, callers should set them as current. Nothing is committed.
+
+    :param harvest_objects: the new current objects
+    :type harvest_objects: list
+    :param purge: delete the superseded objects instead of keeping them
+    :type purge: bool
+
+    :returns: the number of objects superseded
+    :rtype: int
+    '''
+    from ckanext.harvest.model import (
+        harvest_object_table,
+        harvest_object_extra_table,
+        harvest_object_error_table,
+    )
+
+    table = harvest_object_table
+
+    ids = [obj.id for obj in harvest_objects if obj.id]
+    package_ids = set(obj.package_id for obj in harvest_objects
+                      if obj.package_id)
+    guids = set(obj.guid for obj in harvest_objects if obj.guid)
+
+    if not package_ids and not guids:
+        return 0
+
+    same_dataset = []
+    if package_ids:
+        same_dataset.append(table.c.package_id.in_(package_ids))
+    if guids:
+        same_dataset.append(table.c.guid.in_(guids))
+
+    superseded = and_(or_(*same_dataset), table.c.current == True)
+    if ids:
+        superseded = and_(superseded, not_(table.c.id.in_(ids)))
+
+    count = 0
+    if purge:
+        # Objects from the same jobs may still get extras or errors written
+        # once their own import finishes, so they are only marked as not
+        # current
+        job_ids = set(obj.harvest_job_id for obj in harvest_objects
+                      if obj.harvest_job_id)
+        purged = superseded
+        if job_ids:
+            purged = and_(purged, not_(table.c.harvest_job_id.in_(job_ids)))
+        purged_ids = select([table.c.id]).where(purged)
+        for child_table in (harvest_object_extra_table,
+                            harvest_object_error_table):
+            model.Session.execute(child_table.delete().where(
+                child_table.c.harvest_object_id.in_(purged_ids)))
+        count += model.Session.execute(table.delete().where(purged)).rowcount
+
+    result = model.Session.execute(
+        table.update().where(superseded).values(current=False))
+
+    return count + result.rowcount
+
+
 def get_initial_dataset_name(data_dict, field='title'):
 
     name = slugify.slugify(data_dict[field])
@@ -87,8 +280,12 @@ def get_task_for_request_id(context, request_id):
 
     model = context['model']
 
+    if not request_id:
+        return None
+
     task = model.Session.query(model.TaskStatus) \
-        .filter(model.TaskStatus.value.like('%{0}%'.format(request_id))) \
+        .join(EcRequestTask, EcRequestTask.task_id == model.TaskStatus.id) \
+        .filter(EcRequestTask.request_id == unicode(request_id)) \
         .first()
 
     return task
@@ -1,39 +1,371 @@
 import logging
 import json
-import hashlib
 import datetime
+import functools
+import threading
+import time
 import uuid
 
 import requests
+from pylons import config
 
 from ckan import plugins as p
 from ckan import model
 
 from ckanext.harvest.model import HarvestObject
 
-from ckanext.glasgow.logic.action import _get_api_endpoint, _expire_task_status
+from ckanext.glasgow import client
+from ckanext.glasgow.logic.action import (
+    _get_api_endpoint,
+    _save_task_statuses,
+    _task_status_fields,
+)
 
 import ckanext.glasgow.logic.schema as custom_schema
 from ckanext.glasgow.model import HarvestLastAudit
 from ckanext.glasgow.harvesters import (
     EcHarvester,
+    HarvestObjectWriter,
     get_dataset_name_from_task,
     get_initial_dataset_name,
     get_task_for_request_id,
     get_org_name,
+    supersede_harvest_objects,
 )
 
 
 log = logging.getLogger(__name__)
 
 
-def save_last_audit_id(audit_id, harvest_job_id=None):
+# Extra set on the harvest objects imported on the gather stage, with the
+# result of the import (`done` or `error`)
+IMPORT_RESULT_EXTRA = 'changelog_import'
+
+# Extra with the EC metadata needed to import an audit, requested on the
+# gather or fetch stages (see `get_remote_metadata`)
+REMOTE_METADATA_EXTRA = 'remote_metadata'
+
+# Commands whose handlers call CKAN actions that always commit (eg
+# `member_create`), so they can not be imported on a savepoint as part of
+# a group commit
+_committing_commands = frozenset([
+    'CreateOrganisation',
+    'CreateUser',
+    'UpdateUser',
+    'ChangeUserRoles',
+])
+
+# Errors requesting the EC metadata for an audit
+_fetch_errors = (
+    requests.exceptions.RequestException,
+    ValueError,
+    p.toolkit.ValidationError,
+    p.toolkit.ObjectNotFound,
+    p.toolkit.NotAuthorized,
+)
+
+
+def save_last_audit_id(audit_id, harvest_job_id=None, commit=True):
 
     new_last_audit = HarvestLastAudit(
         audit_id=audit_id,
         harvest_job_id=harvest_job_id,
     )
-    new_last_audit.save()
+    if commit:
+        new_last_audit.save()
+    else:
+        new_last_audit.add()
+
+
+def changelog_pages(audit_id, page_size=1000):
+    '''
+    Requests all audits created after the provided one, page by page
+
+    The EC API includes the starting audit in the results, so this is
+    removed, and the last audit of each page is used as the start of the
+    next one. Pages are requested until the API returns less audits than
+    requested.
+
+    :param audit_id: the last audit already processed ('0' to start from
+                     the beginning)
+    :type audit_id: string
+    :param page_size: number of audits to request each time
+    :type page_size: int
+
+    :returns: an iterator over lists of audits
+    :rtype: iterator
+    '''
+
+    # At least one new audit apart from the starting one
+    page_size = max(page_size, 2)
+
+    while True:
+        audits = p.toolkit.get_action('changelog_show')(
+            {'ignore_auth': True},
+            {'audit_id': audit_id, 'top': page_size})
+
+        drained = len(audits) < page_size
+
+        if (audit_id != '0' and audits and
+                unicode(audits[0]['AuditId']) == unicode(audit_id)):
+            audits = audits[1:]
+
+        if not audits:
+            return
+
+        yield audits
+
+        if drained:
+            return
+
+        audit_id = unicode(audits[-1]['AuditId'])
+
+
+# Object type and operation of the commands that can be compacted
+_audit_operations = {
+    'CreateDataSet': ('dataset', 'create'),
+    'UpdateDataSet': ('dataset', 'update'),
+    'CreateFile': ('file', 'create'),
+    'UpdateFile': ('file', 'update'),
+    'DeleteFileVersion': ('file', 'delete'),
+    'CreateOrganisation': ('organization', 'create'),
+    'UpdateOrganisation': ('organization', 'update'),
+    'CreateUser': ('user', 'create'),
+    'UpdateUser': ('user', 'update'),
+    'ChangeUserRoles': ('user', 'update'),
+}
+
+# Properties identifying each type of object
+_object_key_properties = {
+    'dataset': ('DataSetId',),
+    'file': ('DataSetId', 'FileId'),
+    'organization': ('OrganisationId',),
+    'user': ('UserName',),
+}
+
+
+def get_audit_object_key(audit):
+    '''
+    Returns a key identifying the object changed by an audit
+
+    Keys start with the object type, so eg a dataset and an organization
+    with the same id get different ones, and are built from the relevant
+    ids only (not all the audit properties). Audits that can not be
+    compacted (unknown commands or missing ids) get a key of their own.
+
+    :returns: a tuple, eg `('file', '1', 'a2b3...')`
+    :rtype: tuple
+    '''
+    object_type = _audit_operations.get(audit.get('Command'), (None,))[0]
+    properties = audit.get('CustomProperties') or {}
+
+    if object_type:
+        ids = [properties.get(name)
+               for name in _object_key_properties[object_type]]
+        if all(ids):
+            return tuple([object_type] + [unicode(i) for i in ids])
+
+    return ('audit', unicode(audit.get('AuditId')))
+
+
+def _merge_audits(audit, replaced):
+    '''
+    Returns a copy of the audit with the request and audit ids of the
+    ones it replaces, so their tasks are updated when importing it
+    '''
+    if not replaced:
+        return audit
+
+    audit = dict(audit)
+    audit['CompactedAuditIds'] = (audit.get('CompactedAuditIds', []) +
+                                  [a['AuditId'] for a in replaced])
+    audit['CompactedRequestIds'] = (
+        audit.get('CompactedRequestIds', []) +
+        [a['RequestId'] for a in replaced if a.get('RequestId')])
+    return audit
+
+
+def _compact_object_audits(audits):
+    operations = [_audit_operations[a['Command']][1] for a in audits]
+    compacted = []
+
+    # Changes before a delete are removed along with the object. Deletes
+    # are kept even after a create, as it could have been a new version of
+    # an existing file, and they are cheap to import if there is nothing
+    # to delete
+    if 'delete' in operations:
+        last_delete = len(operations) - 1 - operations[::-1].index('delete')
+        compacted.append(_merge_audits(audits[last_delete],
+                                       audits[:last_delete]))
+        audits = audits[last_delete + 1:]
+        operations = operations[last_delete + 1:]
+
+    if audits:
+        if 'create' in operations:
+            # The object is created with its latest version (the handlers
+            # get the latest metadata from the EC API, except for files,
+            # where the version comes from the audit)
+            kept = dict(audits[operations.index('create')])
+            kept['CustomProperties'] = audits[-1]['CustomProperties']
+            replaced = [a for a in audits if a['AuditId'] != kept['AuditId']]
+        else:
+            kept = audits[-1]
+            replaced = audits[:-1]
+        compacted.append(_merge_audits(kept, replaced))
+
+    return compacted
+
+
+def compact_audits(audits):
+    '''
+    Collapses the audits for each object into the fewest equivalent ones
+
+    For each object (see `get_audit_object_key`):
+
+    * Creates followed by updates become a single create with the
+      properties (ie the file version) of the latest audit.
+    * Consecutive updates become the latest one.
+    * Anything before a delete is dropped.
+
+    The audits kept have the ids of the ones they replace in
+    `CompactedAuditIds` and `CompactedRequestIds`.
+
+    :param audits: audits as returned by `changelog_show`
+    :type audits: list
+
+    :returns: the compacted audits, sorted by AuditId
+    :rtype: list
+    '''
+    sequences = {}
+    for audit in sorted(audits, key=lambda a: int(a['AuditId'])):
+        sequences.setdefault(get_audit_object_key(audit), []).append(audit)
+
+    compacted = []
+    for key, sequence in sequences.iteritems():
+        if key[0] == 'audit' or len(sequence) == 1:
+            compacted.extend(sequence)
+        else:
+            compacted.extend(_compact_object_audits(sequence))
+
+    return sorted(compacted, key=lambda a: int(a['AuditId']))
+
+
+def get_audit_partition(audit):
+    '''
+    Returns the key of the object an audit changes
+
+    Audits for files are keyed by their dataset, as they change it too (its
+    resources and harvest objects).
+
+    :returns: a (type, id) tuple, eg `('dataset', '1')`
+    :rtype: tuple
+    '''
+    properties = audit.get('CustomProperties') or {}
+
+    if properties.get('DataSetId'):
+        return ('dataset', unicode(properties['DataSetId']))
+    if properties.get('UserName'):
+        return ('user', unicode(properties['UserName']))
+    if properties.get('OrganisationId'):
+        return ('organization', unicode(properties['OrganisationId']))
+
+    return ('audit', unicode(audit.get('AuditId')))
+
+
+def partition_audits(items):
+    '''
+    Groups audits by the object they change, so they can be imported
+    concurrently
+
+    Audits for the same object are kept in the same partition, sorted by
+    AuditId, so they are applied in order. Organization audits are imported
+    on a first phase, as datasets and memberships depend on them.
+
+    :param items: list of (harvest_object_id, audit) tuples
+    :type items: list
+
+    :returns: a list of phases to import one after the other. Each phase is
+              a list of partitions (lists of (harvest_object_id, audit)
+              tuples) that can be imported at the same time.
+    :rtype: list
+    '''
+    partitions = {}
+    for harvest_object_id, audit in items:
+        partitions.setdefault(get_audit_partition(audit), []).append(
+            (harvest_object_id, audit))
+
+    organizations = []
+    others = []
+    for key in sorted(partitions.keys()):
+        partition = sorted(partitions[key],
+                           key=lambda item: int(item[1]['AuditId']))
+        if key[0] == 'organization':
+            organizations.append(partition)
+        else:
+            others.append(partition)
+
+    return [phase for phase in (organizations, others) if phase]
+
+
+def batch_partitions(partitions, size):
+    '''
+    Joins consecutive partitions until they have at least `size` audits
+
+    Used to import many small partitions (eg one per dataset) on the same
+    transaction. Partitions are never split, so audits for the same object
+    are still imported in order.
+
+    :param partitions: list of partitions, as returned by `partition_audits`
+    :type partitions: list
+    :param size: minimum number of audits on each batch
+    :type size: int
+
+    :returns: a list of lists of (harvest_object_id, audit) tuples
+    :rtype: list
+    '''
+    batches = []
+    batch = []
+    for partition in partitions:
+        batch.extend(partition)
+        if len(batch) >= size:
+            batches.append(batch)
+            batch = []
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def _end_savepoint(savepoint, commit=True):
+    '''
+    Releases or rolls back a savepoint started with `begin_nested`
+
+    Some CKAN actions (eg `member_create`) always commit, which releases the
+    current savepoint. Nothing is done if that already happened.
+    '''
+    if savepoint is None or model.Session().transaction is not savepoint:
+        return
+
+    if commit:
+        savepoint.commit()
+    else:
+        savepoint.rollback()
+
+
+def _register_translator():
+    '''
+    Registers a translator for the current (worker) thread
+
+    Pylons only registers it for the thread handling the request or command,
+    and CKAN validators need one to build their error messages.
+    '''
+    import pylons
+    from paste.registry import Registry
+    from ckan.lib.cli import MockTranslator
+
+    registry = Registry()
+    registry.prepare()
+    registry.register(pylons.translator, MockTranslator())
 
 
 class EcChangelogHarvester(EcHarvester):
@@ -62,58 +394,310 @@ class EcChangelogHarvester(EcHarvester):
         else:
             audit_id = '0'
 
-        # Get all Audits
-        audits = p.toolkit.get_action('changelog_show')(
-            {'ignore_auth': True},
-            {'audit_id': audit_id, 'top': 1000})
+        page_size = p.toolkit.asint(
+            config.get('ckanext.glasgow.harvest.changelog_page_size', 1000))
+        max_audits = p.toolkit.asint(
+            config.get('ckanext.glasgow.harvest.changelog_max_audits', 0))
+        time_budget = float(
+            config.get('ckanext.glasgow.harvest.changelog_time_budget', 0))
+
+        start = time.time()
+
+        writer = HarvestObjectWriter(harvest_job)
+
+        gathered = []
+        num_audits = 0
+        last_audit = None
+        try:
+            # Keep requesting audits until there are no more left or one of
+            # the limits is reached
+            for audits in changelog_pages(audit_id, page_size):
+                if max_audits:
+                    audits = audits[:max_audits - num_audits]
+
+                gathered.extend(audits)
+                num_audits += len(audits)
+                last_audit = audits[-1]
+
+                if max_audits and num_audits >= max_audits:
+                    log.info('Reached the maximum number of audits per run '
+                             '({0}), the rest will be gathered on the next '
+                             'one'.format(max_audits))
+                    break
+                if time_budget and time.time() - start > time_budget:
+                    log.info('Ran out of time after gathering {0} audits, '
+                             'the rest will be gathered on the next '
+                             'one'.format(num_audits))
+                    break
+        except p.toolkit.ValidationError, e:
+            # Keep the audits gathered so far, the next run will start from
+            # the last one
+            if not num_audits:
+                raise
+            log.warning('Error requesting audits after {0}, stopping: '
+                        '{1}'.format(last_audit['AuditId'], str(e)))
 
         # Check if there are any new audits to process
-        if not len(audits) or (
-           len(audits) == 1 and
-           audits[0]['AuditId'] == audit_id):
+        if not num_audits:
             log.debug(
                 'No new audits to process since last run ' +
                 '(Last audit id {0})'.format(audit_id))
             return []
 
-        # Ignore the first audit if an audit id was defined as start,
-        # as this one will be included in the results
-        audits = audits[1:] if audit_id != '0' and len(audits) > 1 else audits
+        # Only the fewest audits needed to get each object to its latest
+        # state are imported
+        compacted = compact_audits(gathered)
 
         ids = []
-        update_audits = {}
-        for audit in audits:
-            # We only want to use the most recent update per object per run
-            # Store the most recent audit against a hash of the id fields
-            if 'update' in audit['Command'].lower():
-                m = hashlib.md5()
-                m.update(json.dumps(audit['CustomProperties']))
-                ids_hash = m.hexdigest()
-                update_audits[ids_hash] = audit
-            else:
-                obj = HarvestObject(guid=audit['AuditId'], job=harvest_job,
-                                    content=json.dumps(audit))
-                obj.save()
-                ids.append(obj.id)
-
-        # Save the last AuditId to know where to start in the next run
-        save_last_audit_id(audit['AuditId'], harvest_job.id)
-
-        for key, audit in update_audits.iteritems():
-            obj = HarvestObject(guid=audit['AuditId'], job=harvest_job,
-                                content=json.dumps(audit))
-            obj.save()
-            ids.append(obj.id)
+        to_import = []
+        for audit in compacted:
+            harvest_object_id = writer.add(guid=audit['AuditId'],
+                                           content=json.dumps(audit))
+            ids.append(harvest_object_id)
+            to_import.append((harvest_object_id, audit))
+
+        # Save the last AuditId to know where to start in the next run, in
+        # the same transaction as the harvest objects
+        save_last_audit_id(last_audit['AuditId'], harvest_job.id,
+                           commit=False)
+        writer.commit()
+
+        log.info('Gathered {0} audits since audit {1} in {2:.1f}s, {3} to '
+                 'import after compacting them'.format(
+                     num_audits, audit_id, time.time() - start, len(ids)))
+
+        if p.toolkit.asbool(config.get(
+                'ckanext.glasgow.harvest.prefetch_changelog', True)):
+            self._prefetch_metadata(to_import)
+
+        concurrency = p.toolkit.asint(
+            config.get('ckanext.glasgow.harvest.changelog_import_concurrency',
+                       1))
+        batch_size = p.toolkit.asint(
+            config.get('ckanext.glasgow.harvest.changelog_commit_batch_size',
+                       1))
+        if concurrency > 1 or batch_size > 1:
+            self._import_concurrently(to_import, concurrency, batch_size)
 
         return ids
 
+    def _prefetch_metadata(self, items):
+        '''
+        Gets the EC metadata for all gathered audits concurrently
+
+        Requests are sent using a bounded thread pool (the size is set with
+        `ckanext.glasgow.harvest.fetch_concurrency`, default 8) and the
+        results are stored as `remote_metadata` extras in bulk, so the
+        import stage does not need to call the EC API. Any failures,
+        including unexpected errors, are left for the fetch stage to retry
+        and report.
+
+        :param items: list of (harvest_object_id, audit) tuples
+        :type items: list
+        '''
+        concurrency = p.toolkit.asint(
+            config.get('ckanext.glasgow.harvest.fetch_concurrency', 8))
+
+        def fetch(item):
+            harvest_object_id, audit = item
+            try:
+                return harvest_object_id, get_remote_metadata(audit), None
+            except _fetch_errors, e:
+                log.debug('Could not prefetch metadata for audit {0}: {1}'
+                          .format(audit.get('AuditId'), str(e)))
+                return harvest_object_id, None, e
+            except Exception, e:
+                # Eg a malformed EC record. The audits are already saved, so
+                # this must not stop the gather stage
+                log.warning('Error prefetching metadata for audit {0}: {1}'
+                            .format(audit.get('AuditId'), str(e)),
+                            exc_info=True)
+                return harvest_object_id, None, e
+
+        to_fetch = [item for item in items
+                    if needs_remote_metadata(item[1])]
+
+        writer = HarvestObjectWriter()
+        num_fetched = 0
+        for harvest_object_id, metadata, error in client.imap_concurrently(
+                fetch, to_fetch, concurrency):
+            if error:
+                continue
+            writer.add_extra(harvest_object_id, REMOTE_METADATA_EXTRA,
+                             json.dumps(metadata))
+            num_fetched += 1
+
+        writer.commit()
+
+        log.debug('Prefetched metadata for {0} of {1} audits'.format(
+            num_fetched, len(to_fetch)))
+
     def fetch_stage(self, harvest_object):
+
+        if (self._get_object_extra(harvest_object, IMPORT_RESULT_EXTRA) or
+                self._get_object_extra(harvest_object,
+                                       REMOTE_METADATA_EXTRA)):
+            # Already done on the gather stage
+            return True
+
+        audit = json.loads(harvest_object.content)
+        if not needs_remote_metadata(audit):
+            return True
+
+        try:
+            metadata = get_remote_metadata(audit)
+        except _fetch_errors, e:
+            self._save_object_error(
+                'Error fetching the EC metadata for audit {0}: {1}'.format(
+                    audit.get('AuditId'), str(e)),
+                harvest_object, 'Fetch')
+            return False
+
+        writer = HarvestObjectWriter()
+        writer.add_extra(harvest_object.id, REMOTE_METADATA_EXTRA,
+                         json.dumps(metadata))
+        writer.commit()
+
+        model.Session.expire(harvest_object, ['extras'])
+
         return True
 
+    def _import_concurrently(self, items, concurrency, batch_size=1):
+        '''
+        Imports the gathered audits, partitioned by the object they change
+
+        Partitions are imported at the same time on up to `concurrency`
+        threads, each one with its own database session, while the audits
+        on each partition are imported in order. The result is stored as an
+        extra on each harvest object, so the import stage does not import
+        them again. Objects without it (eg if the process is stopped) are
+        imported on the import stage as usual.
+
+        If `batch_size` is bigger than 1, small partitions are joined so up
+        to that many audits can be committed together (see
+        `_import_partition`).
+        '''
+        start = time.time()
+
+        # Get the site user before starting, as it might need creating
+        self._get_user_name()
+
+        import_partition = functools.partial(
+            self._import_partition,
+            batch_size=batch_size,
+            commit_interval=p.toolkit.asint(config.get(
+                'ckanext.glasgow.harvest.changelog_commit_interval', 0)),
+            calling_thread=threading.current_thread())
+
+        writer = HarvestObjectWriter()
+        num_partitions = 0
+        failed = 0
+        for phase in partition_audits(items):
+            num_partitions += len(phase)
+            if batch_size > 1:
+                phase = batch_partitions(phase, batch_size)
+            for results in client.imap_concurrently(
+                    import_partition, phase, concurrency,
+                    initializer=_register_translator):
+                for harvest_object_id, success in results:
+                    writer.add_extra(harvest_object_id, IMPORT_RESULT_EXTRA,
+                                     'done' if success else 'error')
+                    if not success:
+                        failed += 1
+        writer.commit()
+
+        log.info('Imported {0} audits in {1} partitions in {2:.1f}s ({3} '
+                 'failed)'.format(len(items), num_partitions,
+                                  time.time() - start, failed))
+
+    def _import_partition(self, partition, batch_size=1, commit_interval=0,
+                          calling_thread=None):
+        '''
+        Imports the audits of a partition in order, on a worker thread
+
+        By default each audit is committed on its own. With a `batch_size`
+        bigger than 1, up to that many audits share a transaction, which is
+        also committed once it has been open for `commit_interval` seconds
+        (if set). Each audit is imported on a savepoint, so a failing one
+        is rolled back without losing the rest of the batch, and errors are
+        written along with the batch. Audits for commands that always
+        commit (see `_committing_commands`) commit the pending batch and
+        are then imported on their own.
+
+        The thread's database session is removed at the end, unless this
+        runs on `calling_thread` (`imap_concurrently` runs single items
+        serially), whose session is still in use.
+        '''
+        group_commit = batch_size > 1
+        writer = HarvestObjectWriter()
+        results = []
+        pending = 0
+        batch_start = None
+        try:
+            for harvest_object_id, audit in partition:
+                grouped = (group_commit and
+                           audit.get('Command') not in _committing_commands)
+                if group_commit and not grouped and pending:
+                    writer.commit()
+                    pending = 0
+                if not pending:
+                    batch_start = time.time()
+
+                harvest_object = HarvestObject.get(harvest_object_id)
+                try:
+                    success = self._import_audit(
+                        harvest_object, audit,
+                        writer=writer if grouped else None)
+                except Exception, e:
+                    # Keep going with the rest of audits, the import stage
+                    # would do the same
+                    log.error('Error importing audit {0}: {1}'.format(
+                        audit.get('AuditId'), e), exc_info=True)
+                    if grouped:
+                        # Only its savepoint was rolled back
+                        writer.add_error(harvest_object_id, str(e), 'Import')
+                    else:
+                        model.Session.rollback()
+                        self._save_object_error(str(e), harvest_object,
+                                                'Import')
+                    success = False
+                results.append((harvest_object_id, success))
+
+                if grouped:
+                    pending += 1
+                    if (pending >= batch_size or
+                            (commit_interval and
+                             time.time() - batch_start >= commit_interval)):
+                        writer.commit()
+                        pending = 0
+            if pending:
+                writer.commit()
+        finally:
+            if threading.current_thread() is not calling_thread:
+                model.Session.remove()
+
+        return results
+
     def import_stage(self, harvest_object):
 
+        imported = self._get_object_extra(harvest_object, IMPORT_RESULT_EXTRA)
+        if imported:
+            # Already imported on the gather stage
+            return imported == 'done'
+
         audit = json.loads(harvest_object.content)
 
+        return self._import_audit(harvest_object, audit)
+
+    def _import_audit(self, harvest_object, audit, writer=None):
+        '''
+        Imports an audit by calling the handler for its command
+
+        If a `HarvestObjectWriter` is provided nothing is committed: the
+        changes are made on a savepoint, which is rolled back if the audit
+        fails, and errors are added to the writer.
+        '''
+
         log.debug('Import stage for audit "{0}"'.format(audit.get('AuditId')))
 
         command = audit.get('Command')
@@ -131,48 +715,78 @@ class EcChangelogHarvester(EcHarvester):
             'local_action': True,
         }
 
+        savepoint = None
+        if writer:
+            # Leave the changes on the current transaction, on a savepoint
+            # that can be rolled back on its own if the audit fails
+            context['defer_commit'] = True
+            savepoint = model.Session.begin_nested()
+
         log.debug('Calling handler for command "{0}"'.format(command))
         try:
 
-            request_id = audit.get('RequestId')
+            # Compacted audits also apply the requests of the ones they
+            # replaced
+            request_ids = ([audit.get('RequestId')] +
+                           audit.get('CompactedRequestIds', []))
 
-            # Mark relevant task as in progress
-            self._mark_task_as_processing(context, request_id)
+            # Mark relevant tasks as in progress
+            self._mark_tasks_as_processing(context, request_ids)
 
             handler(context, audit, harvest_object)
 
-            self._mark_task_as_finished(context, request_id)
+            self._mark_tasks_as_finished(context, request_ids)
+
+            _end_savepoint(savepoint)
 
             return True
         except p.toolkit.ValidationError, e:
-            self._save_object_error(str(e), harvest_object, 'Import')
+            msg = str(e)
         except p.toolkit.ObjectNotFound, e:
             msg = e.message or str(e) or 'Object not found'
+        except Exception:
+            _end_savepoint(savepoint, commit=False)
+            raise
+
+        _end_savepoint(savepoint, commit=False)
+        if writer:
+            writer.add_error(harvest_object.id, msg, 'Import')
+        else:
             self._save_object_error(msg, harvest_object, 'Import')
 
         return False
 
-    def _mark_task_as_processing(self, context, request_id):
-        return self._update_task_state(context, request_id, 'processing')
-
-    def _mark_task_as_finished(self, context, request_id):
-        return self._update_task_state(context, request_id, 'finished')
+    def _mark_tasks_as_processing(self, context, request_ids):
+        return self._update_task_states(context, request_ids, 'processing')
 
-    def _update_task_state(self, context, request_id, state):
+    def _mark_tasks_as_finished(self, context, request_ids):
+        return self._update_task_states(context, request_ids, 'finished')
 
-        task = get_task_for_request_id(context, request_id)
+    def _update_task_states(self, context, request_ids, state):
+        '''
+        Sets the state of the tasks for the provided EC request ids
 
-        if task:
-            task.state = state
-            task.last_updated = datetime.datetime.now()
+        All tasks found are saved at once (and committed unless
+        `defer_commit` is set in the context).
 
-            task.save()
+        :returns: the number of tasks updated
+        :rtype: int
+        '''
+        now = datetime.datetime.now()
 
-            _expire_task_status(context, task.id)
+        task_dicts = []
+        for request_id in request_ids:
+            task = get_task_for_request_id(context, request_id)
+            if task:
+                task_dict = dict((field, getattr(task, field))
+                                 for field in _task_status_fields)
+                task_dict.update({'state': state, 'last_updated': now})
+                task_dicts.append(task_dict)
 
-            return True
+        if task_dicts:
+            _save_task_statuses(context, task_dicts)
 
-        return False
+        return len(task_dicts)
 
 
 def _get_latest_organization_version(audit):
@@ -183,7 +797,7 @@ def _get_latest_organization_version(audit):
         organization_id=audit['CustomProperties'].get('OrganisationId'),
     )
 
-    response = requests.request(method, url, verify=False)
+    response = client.request(method, url, verify=False)
 
     if response.status_code != 200:
         return False
@@ -210,7 +824,7 @@ def _get_latest_dataset_version(audit):
         dataset_id=audit['CustomProperties'].get('DataSetId'),
     )
 
-    response = requests.request(method, url, verify=False)
+    response = client.request(method, url, verify=False)
 
     if response.status_code != 200:
         return False
@@ -246,7 +860,7 @@ def _get_file_version(audit):
         version_id=audit['CustomProperties'].get('VersionId'),
     )
 
-    response = requests.request(method, url, verify=False)
+    response = client.request(method, url, verify=False)
 
     if response.status_code != 200:
         return False
@@ -273,9 +887,32 @@ def _get_file_version(audit):
     return resource_dict
 
 
+def _get_ec_user(audit):
+
+    return p.toolkit.get_action('ec_user_show')(
+        {'ignore_auth': True},
+        {'ec_username': audit['CustomProperties']['UserName']})
+
+
+def _get_audit_metadata(harvest_object, audit, fetch):
+    '''
+    Returns the EC metadata stored on the harvest object
+
+    If there is none (eg if the handler is called directly) it is requested
+    with `fetch`.
+    '''
+    if harvest_object is not None:
+        for extra in harvest_object.extras:
+            if extra.key == REMOTE_METADATA_EXTRA:
+                return json.loads(extra.value)
+
+    return fetch(audit)
+
+
 def handle_dataset_create(context, audit, harvest_object):
 
-    dataset_dict = _get_latest_dataset_version(audit)
+    dataset_dict = _get_audit_metadata(harvest_object, audit,
+                                       _get_latest_dataset_version)
 
     if not dataset_dict:
         msg = ['Could not get remote dataset metadata: {0}'.format(
@@ -299,14 +936,16 @@ def handle_dataset_create(context, audit, harvest_object):
 
     harvest_object.add()
 
-    model.Session.commit()
+    if not context.get('defer_commit'):
+        model.Session.commit()
 
     return True
 
 
 def handle_dataset_update(context, audit, harvest_object):
 
-    dataset_dict = _get_latest_dataset_version(audit)
+    dataset_dict = _get_audit_metadata(harvest_object, audit,
+                                       _get_latest_dataset_version)
 
     if not dataset_dict:
         msg = ['Could not get remote dataset metadata: {0}'.format(
@@ -330,22 +969,18 @@ def handle_dataset_update(context, audit, harvest_object):
 
     harvest_object.add()
 
-    previous_objects = model.Session.query(HarvestObject) \
-        .filter(HarvestObject.guid==harvest_object.guid) \
-        .filter(HarvestObject.current==True) \
-        .all()
+    supersede_harvest_objects([harvest_object], purge=True)
 
-    for obj in previous_objects:
-        obj.delete()
-
-    model.Session.commit()
+    if not context.get('defer_commit'):
+        model.Session.commit()
 
     return True
 
 
 def handle_file_create(context, audit, harvest_object):
 
-    resource_dict = _get_file_version(audit)
+    resource_dict = _get_audit_metadata(harvest_object, audit,
+                                        _get_file_version)
 
     dataset_id = audit['CustomProperties'].get('DataSetId')
 
@@ -387,15 +1022,10 @@ def handle_file_create(context, audit, harvest_object):
 
     harvest_object.add()
 
-    previous_objects = model.Session.query(HarvestObject) \
-        .filter(HarvestObject.guid==harvest_object.guid) \
-        .filter(HarvestObject.current==True) \
-        .all()
-
-    for obj in previous_objects:
-        obj.delete()
+    supersede_harvest_objects([harvest_object], purge=True)
 
-    model.Session.commit()
+    if not context.get('defer_commit'):
+        model.Session.commit()
 
     return True
 
@@ -419,22 +1049,18 @@ def handle_file_delete(context, audit, harvest_object):
 
     harvest_object.add()
 
-    previous_objects = model.Session.query(HarvestObject) \
-        .filter(HarvestObject.guid==harvest_object.guid) \
-        .filter(HarvestObject.current==True) \
-        .all()
-
-    for obj in previous_objects:
-        obj.delete()
+    supersede_harvest_objects([harvest_object], purge=True)
 
-    model.Session.commit()
+    if not context.get('defer_commit'):
+        model.Session.commit()
 
     return True
 
 
 def handle_file_update(context, audit, harvest_object):
 
-    resource_dict = _get_file_version(audit)
+    resource_dict = _get_audit_metadata(harvest_object, audit,
+                                        _get_file_version)
 
     dataset_id = audit['CustomProperties'].get('DataSetId')
 
@@ -462,22 +1088,18 @@ def handle_file_update(context, audit, harvest_object):
 
     harvest_object.add()
 
-    previous_objects = model.Session.query(HarvestObject) \
-        .filter(HarvestObject.guid==harvest_object.guid) \
-        .filter(HarvestObject.current==True) \
-        .all()
+    supersede_harvest_objects([harvest_object], purge=True)
 
-    for obj in previous_objects:
-        obj.delete()
-
-    model.Session.commit()
+    if not context.get('defer_commit'):
+        model.Session.commit()
 
     return True
 
 
 def handle_organization_create(context, audit, harvest_object):
 
-    org_dict = _get_latest_organization_version(audit)
+    org_dict = _get_audit_metadata(harvest_object, audit,
+                                   _get_latest_organization_version)
 
     if not org_dict:
         msg = ['Could not get remote organization metadata: {0}'.format(
@@ -500,7 +1122,8 @@ def handle_organization_create(context, audit, harvest_object):
 
 def handle_organization_update(context, audit, harvest_object):
 
-    org_dict = _get_latest_organization_version(audit)
+    org_dict = _get_audit_metadata(harvest_object, audit,
+                                   _get_latest_organization_version)
 
     if not org_dict:
         msg = ['Could not get remote organization metadata: {0}'.format(
@@ -522,10 +1145,12 @@ def handle_organization_update(context, audit, harvest_object):
 
 
 def handle_user_create(context, audit, harvest_object):
-    username = audit['CustomProperties']['UserName']
+    user = _get_audit_metadata(harvest_object, audit, _get_ec_user)
+    if not user:
+        msg = ['Could not get remote user: {0}'.format(
+            json.dumps(audit['CustomProperties']))]
+        raise p.toolkit.ObjectNotFound(msg)
 
-    user = p.toolkit.get_action('ec_user_show')(
-        context, {'ec_username': username})
     user_dict = custom_schema.convert_ec_user_to_ckan_user(user)
     user_dict['password'] = str(uuid.uuid4())
 
@@ -541,10 +1166,12 @@ def handle_user_create(context, audit, harvest_object):
 
 
 def handle_user_update(context, audit, harvest_object):
-    username = audit['CustomProperties']['UserName']
+    user = _get_audit_metadata(harvest_object, audit, _get_ec_user)
+    if not user:
+        msg = ['Could not get remote user: {0}'.format(
+            json.dumps(audit['CustomProperties']))]
+        raise p.toolkit.ObjectNotFound(msg)
 
-    user = p.toolkit.get_action('ec_user_show')(
-        context, {'ec_username': username})
     user_dict = custom_schema.convert_ec_user_to_ckan_user(user)
 
     ckan_user = p.toolkit.get_action('user_update')(context, user_dict)
@@ -568,6 +1195,42 @@ def handle_user_update(context, audit, harvest_object):
     return True
 
 
+# Functions requesting the EC metadata needed by each command
+_remote_metadata_functions = {
+    'CreateDataSet': _get_latest_dataset_version,
+    'UpdateDataSet': _get_latest_dataset_version,
+    'CreateFile': _get_file_version,
+    'UpdateFile': _get_file_version,
+    'CreateOrganisation': _get_latest_organization_version,
+    'UpdateOrganisation': _get_latest_organization_version,
+    'CreateUser': _get_ec_user,
+    'UpdateUser': _get_ec_user,
+    'ChangeUserRoles': _get_ec_user,
+}
+
+
+def needs_remote_metadata(audit):
+
+    return audit.get('Command') in _remote_metadata_functions
+
+
+def get_remote_metadata(audit):
+    '''
+    Requests the EC metadata needed to import an audit
+
+    This only calls the EC API and does not access the database, so it can
+    be called for several audits at the same time from different threads.
+
+    :returns: the metadata (converted to a CKAN dict for datasets, files and
+              organizations), False if the EC API did not return it or
+              None if the audit does not need any
+    '''
+
+    function = _remote_metadata_functions.get(audit.get('Command'))
+    if function:
+        return function(audit)
+
+
 def get_audit_command_handler(command):
 
     handlers = {
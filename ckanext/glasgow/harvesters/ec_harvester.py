@@ -3,18 +3,21 @@ import json
 
 from pylons import config
 import requests
-from sqlalchemy.sql import update, bindparam
 
 import ckan.model as model
 import ckan.plugins.toolkit as toolkit
 
-from ckanext.harvest.model import HarvestJob, HarvestObject, HarvestObjectExtra
+from ckanext.harvest.model import HarvestJob, HarvestObject
 
+from ckanext.glasgow import client, streaming
 import ckanext.glasgow.logic.schema as glasgow_schema
+from ckanext.glasgow.model import HarvestInitialCheckpoint
 from ckanext.glasgow.harvesters import (
     EcHarvester,
+    HarvestObjectWriter,
     get_initial_dataset_name,
     get_org_name,
+    supersede_harvest_objects,
 )
 
 
@@ -42,23 +45,154 @@ def _fetch_from_ec(request):
     return result
 
 
-def ec_api(endpoint):
-    skip = 0
+def _stream_from_ec(request):
+    '''
+    Yields the records of an EC API list response as they are received
 
-    while True:
-        request = requests.get(endpoint, params={'$skip': skip}, verify=False)
-        result = _fetch_from_ec(request)
+    The request must have been made with `stream=True`.
+    '''
+    if request.status_code != requests.codes.ok:
+        request.close()
+        raise EcApiException(
+            'Unable to get content for URL: {0}:'.format(request.url))
+
+    result = streaming.JSONListStream(
+        request.iter_content(streaming.CHUNK_SIZE), 'MetadataResultSet')
+    try:
+        for record in result:
+            yield record
+    except ValueError:
+        raise EcApiException('Not a JSON response: {0}:'.format(request.url))
+    finally:
+        request.close()
 
-        if not result.get('MetadataResultSet'):
+    if result.fields.get('IsErrorResponse', False):
+        raise EcApiException(
+            'EC API Error: {0}:'.format(result.fields.get('ErrorMessage', '')))
+
+
+def ec_api_pages(endpoint, skip=0, batch_size=None):
+    '''
+    Iterates over the pages of a paginated EC API list endpoint
+
+    Responses are parsed as they are received, so if `batch_size` is
+    provided the full page is never held in memory.
+
+    :param endpoint: the list endpoint URL
+    :type endpoint: string
+    :param skip: the offset to start from
+    :type skip: int
+    :param batch_size: if provided, pages are split in lists of at most
+                       this number of records
+    :type batch_size: int
+
+    :returns: an iterator of tuples, with the `$skip` offset of the first
+              record and the list of records
+    :rtype: iterator
+    '''
+
+    while True:
+        request = client.get(endpoint, params={'$skip': skip}, verify=False,
+                             stream=True)
+
+        num_records = 0
+        records = []
+        for record in _stream_from_ec(request):
+            records.append(record)
+            if batch_size and len(records) >= batch_size:
+                yield skip + num_records, records
+                num_records += len(records)
+                records = []
+
+        if records:
+            yield skip + num_records, records
+            num_records += len(records)
+
+        if not num_records:
             raise StopIteration
 
-        try:
-            for i in result['MetadataResultSet']:
-                yield i
-        except KeyError:
-            raise EcApiException('No MetadataResultSet in JSON response')
+        skip += num_records
+
+
+def ec_api(endpoint):
+    for skip, records in ec_api_pages(endpoint, batch_size=1):
+        for record in records:
+            yield record
+
+
+def get_organization_datasets(org_id, skip=0):
+    '''
+    Requests all datasets of an organization to the EC API
+
+    Only talks to the EC API, so it is safe to call from worker threads.
+    Errors are not raised but returned along with the pages that could be
+    requested before the error, so they can still be used.
+
+    :param org_id: the EC organization id
+    :type org_id: string
+    :param skip: the offset to start from
+    :type skip: int
+
+    :returns: a tuple with the organization id, the list of pages
+              requested (see `ec_api_pages`) and an error message if the
+              pagination could not be completed (None otherwise)
+    :rtype: tuple
+    '''
+
+    api_url = config.get('ckanext.glasgow.metadata_api', '').rstrip('/')
+    endpoint = api_url + '/Organisations/{0}/Datasets'.format(org_id)
+
+    pages = []
+    try:
+        for page_skip, records in ec_api_pages(endpoint, skip):
+            pages.append((page_skip, records))
+    except (requests.exceptions.RequestException, EcApiException), e:
+        return org_id, pages, str(e)
+
+    return org_id, pages, None
+
+
+def get_files_metadata(org_id, dataset_id):
+    '''
+    Requests the metadata of all files of a dataset to the EC API
+
+    Only talks to the EC API, so it is safe to call from worker threads.
+
+    :returns: a list of CKAN resource dicts (empty if the dataset has no
+              files)
+    :rtype: list
+
+    :raises: `requests.exceptions.RequestException` or `EcApiException`
+    '''
+
+    api_url = config.get('ckanext.glasgow.metadata_api', '').rstrip('/')
+    # NB: this end point does not seem to support the $skip parameter
+    api_endpoint = api_url + '/Metadata/Organisation/{0}/Dataset/{1}/File'
 
-        skip += len(result['MetadataResultSet'])
+    request = client.get(api_endpoint.format(org_id, dataset_id),
+                         verify=False)
+    if request.status_code == 404:
+        log.debug('No files for dataset {0}'.format(dataset_id))
+        return []
+
+    result = _fetch_from_ec(request)
+
+    files = result['MetadataResultSet']
+    ckan_dicts = glasgow_schema.convert_ec_files_to_ckan_resources(
+        [file_metadata['FileMetadata'] for file_metadata in files])
+
+    resources = []
+    for file_metadata, ckan_dict in zip(files, ckan_dicts):
+        ckan_dict['id'] = file_metadata['FileId']
+
+        ckan_dict['ec_api_version_id'] = file_metadata['Version']
+
+        #TODO: This needs to be removed once MS api is using the proper ExternalURL field
+        if not ckan_dict.get('url') and file_metadata['FileMetadata'].get('FileExternalUrl'):
+            ckan_dict['url'] = file_metadata['FileMetadata'].get('FileExternalUrl')
+        resources.append(ckan_dict)
+
+    return resources
 
 
 class EcInitialHarvester(EcHarvester):
@@ -119,94 +253,257 @@ class EcInitialHarvester(EcHarvester):
             .limit(1).first()
         try:
             orgs = self._create_orgs()
+        except EcApiException, e:
+            self._save_gather_error(e.message, harvest_job)
+            return False
 
-            api_url = config.get('ckanext.glasgow.metadata_api', '').rstrip('/')
-            api_endpoint = api_url + '/Organisations/{0}/Datasets'
-
-            harvest_object_ids = []
-            for org_name in orgs:
-                context = {
-                    'model': model,
-                    'session': model.Session,
-                    'user': self._get_site_user()['name']
-                }
-
-                organization_show = toolkit.get_action('organization_show')
-                org = organization_show(context, {'id': org_name})
-
-                ec_api_org_id = org['id']
-
-                endpoint = api_endpoint.format(ec_api_org_id)
-
-                for dataset in ec_api(endpoint):
-
-                    harvest_object = HarvestObject(
+        context = {
+            'model': model,
+            'session': model.Session,
+            'user': self._get_site_user()['name']
+        }
+        organization_show = toolkit.get_action('organization_show')
+        org_ids = [organization_show(context, {'id': org_name})['id']
+                   for org_name in orgs]
+
+        # Resume from where previous runs stopped, if any
+        checkpoints = self._get_checkpoints(harvest_job)
+        harvest_object_ids = self._adopt_unprocessed_objects(harvest_job,
+                                                             checkpoints)
+
+        to_gather = []
+        for org_id in org_ids:
+            checkpoint = checkpoints.get(org_id)
+            if not checkpoint:
+                checkpoint = HarvestInitialCheckpoint(
+                    harvest_source_id=harvest_job.source_id,
+                    organization_id=org_id)
+                checkpoints[org_id] = checkpoint
+            elif checkpoint.finished:
+                log.debug('Organization {0} already gathered, skipping...'
+                          .format(org_id))
+                continue
+            elif checkpoint.skip:
+                log.debug('Resuming organization {0} from dataset {1}'
+                          .format(org_id, checkpoint.skip))
+            to_gather.append((org_id, checkpoint.skip or 0))
+
+        # Organizations are requested concurrently, but the results are
+        # processed in the same order as the organizations list
+        concurrency = toolkit.asint(
+            config.get('ckanext.glasgow.harvest.gather_concurrency', 4))
+
+        writer = HarvestObjectWriter(harvest_job)
+        datasets = []
+        failed_orgs = []
+        for org_id, pages, error in client.imap_concurrently(
+                lambda args: get_organization_datasets(*args),
+                to_gather, concurrency):
+
+            checkpoint = checkpoints[org_id]
+            checkpoint.harvest_job_id = harvest_job.id
+
+            num_datasets = 0
+            for skip, records in pages:
+                page_datasets = []
+                for dataset in records:
+                    harvest_object_id = writer.add(
                         guid=dataset['Id'],
                         content=json.dumps(dataset),
-                        job=harvest_job,
                         # Add reference to CKAN org to use on import stage
-                        extras=[HarvestObjectExtra(
-                            key='owner_org', value=org['id'])]
+                        extras=[('owner_org', org_id)]
                     )
-
-                    harvest_object.save()
-                    harvest_object_ids.append(harvest_object.id)
-
-        except EcApiException, e:
-            self._save_gather_error(e.message, harvest_job)
-            return False
+                    page_datasets.append((harvest_object_id,
+                                          dataset.get('OrganisationId'),
+                                          dataset['Id']))
+
+                # Objects and checkpoint are saved in the same transaction,
+                # so a new run will continue from the next page
+                checkpoint.skip = skip + len(records)
+                model.Session.add(checkpoint)
+                writer.commit()
+
+                harvest_object_ids.extend(d[0] for d in page_datasets)
+                datasets.extend(page_datasets)
+                num_datasets += len(records)
+
+            if error:
+                # Keep the datasets gathered for this and the other
+                # organizations, and just report the error
+                failed_orgs.append(org_id)
+                self._save_gather_error(
+                    'Error gathering datasets for organization {0} after {1} datasets: {2}'
+                    .format(org_id, num_datasets, error), harvest_job)
+            else:
+                log.debug('Gathered {0} datasets for organization {1}'.format(
+                    num_datasets, org_id))
+                checkpoint.finished = True
+                model.Session.add(checkpoint)
+                model.Session.commit()
+
+        if failed_orgs:
+            log.info('Gathering failed for organizations {0}, next run will '
+                     'resume from the last gathered page'.format(
+                         ', '.join(failed_orgs)))
+            if not harvest_object_ids:
+                return False
+        else:
+            # All done, next run will start a new import from scratch
+            self._clear_checkpoints(harvest_job)
+
+        if toolkit.asbool(
+                config.get('ckanext.glasgow.harvest.prefetch_files', True)):
+            self._prefetch_files(datasets)
 
         return harvest_object_ids
 
+    def _get_checkpoints(self, harvest_job):
+        checkpoints = model.Session.query(HarvestInitialCheckpoint) \
+            .filter(HarvestInitialCheckpoint.harvest_source_id ==
+                    harvest_job.source_id) \
+            .all()
+
+        return dict((checkpoint.organization_id, checkpoint)
+                    for checkpoint in checkpoints)
+
+    def _clear_checkpoints(self, harvest_job):
+        model.Session.query(HarvestInitialCheckpoint) \
+            .filter(HarvestInitialCheckpoint.harvest_source_id ==
+                    harvest_job.source_id) \
+            .delete(synchronize_session=False)
+        model.Session.commit()
+
+    def _adopt_unprocessed_objects(self, harvest_job, checkpoints):
+        '''
+        Moves objects gathered by previous unfinished runs to this job
+
+        If a previous gather stage was interrupted after saving some pages,
+        those harvest objects were never sent to the fetch queue. As they
+        are accounted for in the checkpoints they won't be gathered again,
+        so they are added to the current job instead.
+
+        :returns: a list with the ids of the adopted objects
+        :rtype: list
+        '''
+
+        job_ids = set(checkpoint.harvest_job_id
+                      for checkpoint in checkpoints.values()
+                      if checkpoint.harvest_job_id and
+                      checkpoint.harvest_job_id != harvest_job.id)
+        if not job_ids:
+            return []
+
+        harvest_objects = model.Session.query(HarvestObject) \
+            .filter(HarvestObject.harvest_job_id.in_(job_ids)) \
+            .filter(HarvestObject.state == u'WAITING') \
+            .all()
+
+        for harvest_object in harvest_objects:
+            harvest_object.harvest_job_id = harvest_job.id
+        model.Session.commit()
+
+        if harvest_objects:
+            log.debug('Added {0} objects from previous unfinished jobs'
+                      .format(len(harvest_objects)))
+
+        return [harvest_object.id for harvest_object in harvest_objects]
+
+    def _prefetch_files(self, datasets):
+        '''
+        Gets the file metadata for all gathered datasets concurrently
+
+        Requests are sent using a bounded thread pool (the size is set with
+        `ckanext.glasgow.harvest.fetch_concurrency`, default 8) and the
+        results are stored as `file` extras in bulk. Harvest objects
+        successfully prefetched are flagged with a `files_fetched` extra so
+        the fetch stage does not request them again. Any failures,
+        including unexpected errors, are left for the fetch stage to retry
+        and report.
+
+        :param datasets: list of tuples with the harvest object id, the EC
+                         organization id and the EC dataset id
+        :type datasets: list
+        '''
+
+        concurrency = toolkit.asint(
+            config.get('ckanext.glasgow.harvest.fetch_concurrency', 8))
+
+        def fetch(dataset):
+            harvest_object_id, org_id, dataset_id = dataset
+            try:
+                return harvest_object_id, get_files_metadata(org_id,
+                                                             dataset_id)
+            except (requests.exceptions.RequestException,
+                    EcApiException), e:
+                log.debug('Could not prefetch files for dataset {0}: {1}'
+                          .format(dataset_id, str(e)))
+                return harvest_object_id, None
+            except Exception, e:
+                # Eg a malformed file record, this must not stop the gather
+                # stage
+                log.warning('Error prefetching files for dataset {0}: {1}'
+                            .format(dataset_id, str(e)), exc_info=True)
+                return harvest_object_id, None
+
+        writer = HarvestObjectWriter()
+        num_fetched = 0
+        for harvest_object_id, resources in client.imap_concurrently(
+                fetch, datasets, concurrency):
+            if resources is None:
+                continue
+            for resource in resources:
+                writer.add_extra(harvest_object_id, u'file',
+                                 json.dumps(resource))
+            writer.add_extra(harvest_object_id, u'files_fetched', u'true')
+            num_fetched += 1
+
+        writer.commit()
+
+        log.debug('Prefetched files for {0} of {1} datasets'.format(
+            num_fetched, len(datasets)))
+
     def fetch_stage(self, harvest_object):
-        api_url = config.get('ckanext.glasgow.metadata_api', '').rstrip('/')
-        # NB: this end point does not seem to support the $skip parameter
-        api_endpoint = api_url + '/Metadata/Organisation/{0}/Dataset/{1}/File'
+
+        if self._get_object_extra(harvest_object, 'files_fetched'):
+            # Already done on the gather stage
+            return True
 
         try:
             content = json.loads(harvest_object.content)
             org = content['OrganisationId']
             dataset = content['Id']
-            request = requests.get(api_endpoint.format(org, dataset), verify=False)
-            if request.status_code == 404:
-                result = False
-                log.debug('No files for dataset {0}'.format(dataset))
-            else:
-                result = _fetch_from_ec(request)
+            resources = get_files_metadata(org, dataset)
         except requests.exceptions.RequestException, e:
             self._save_object_error(
                 'Error fetching file metadata for package {0}: {1}'.format(
                     harvest_object.guid, str(e)),
                 harvest_object, 'Fetch')
             return False
-        except ValueError:
+        except (ValueError, KeyError), e:
+            # Eg invalid JSON or a malformed file record
+            log.warning('Error processing file metadata for package {0}: '
+                        '{1}'.format(harvest_object.guid, str(e)),
+                        exc_info=True)
             self._save_object_error(
-                ('Could not load json when fetching file metadata for'
-                 'package {0}: {1}').format(harvest_object.guid, e.error_dict),
+                'Error processing file metadata for package {0}: {1}'.format(
+                    harvest_object.guid, str(e)),
                 harvest_object, 'Fetch')
             return False
         except EcApiException, e:
             self._save_object_error(e.message, harvest_object, 'Fetch')
             return False
 
-        if not result:
+        if not resources:
             return True
 
-        for file_metadata in result['MetadataResultSet']:
-            # create harvest object extra for each file
-            ckan_dict = glasgow_schema.convert_ec_file_to_ckan_resource(
-                file_metadata['FileMetadata'])
-            ckan_dict['id'] = file_metadata['FileId']
+        # create harvest object extra for each file
+        writer = HarvestObjectWriter()
+        for ckan_dict in resources:
+            writer.add_extra(harvest_object.id, u'file', json.dumps(ckan_dict))
+        writer.commit()
 
-            ckan_dict['ec_api_version_id'] = file_metadata['Version']
+        model.Session.expire(harvest_object, ['extras'])
 
-            #TODO: This needs to be removed once MS api is using the proper ExternalURL field
-            if not ckan_dict.get('url') and file_metadata['FileMetadata'].get('FileExternalUrl'):
-                ckan_dict['url'] = file_metadata['FileMetadata'].get('FileExternalUrl')
-            harvest_object.extras.append(
-                HarvestObjectExtra(key='file', value=json.dumps(ckan_dict))
-            )
-        harvest_object.save()
         return True
 
     def import_stage(self, harvest_object):
@@ -292,15 +589,9 @@ class EcInitialHarvester(EcHarvester):
                         harvest_object, 'Import')
                     return False
 
-            from ckanext.harvest.model import harvest_object_table
-            conn = model.Session.connection()
-            u = update(
-                harvest_object_table) \
-                .where(harvest_object_table.c.package_id == bindparam('b_package_id')) \
-                .values(current=False)
-            conn.execute(u, b_package_id=pkg['id'])
-
             harvest_object.package_id = pkg['id']
+            supersede_harvest_objects([harvest_object])
+
             harvest_object.current = True
             harvest_object.save()
         except toolkit.ValidationError, e:
@@ -1,15 +1,65 @@
 import datetime
+import functools
 import json
+
+import requests
+
 from ckan import model
 import ckan.lib.helpers as helpers
 import ckan.plugins.toolkit as toolkit
 
+from ckanext.glasgow import client
 from ckanext.glasgow.logic.schema import resource_schema as custom_resource_schema
 from ckanext.glasgow.logic.action import _get_api_endpoint
+
+
+# Static data, computed once per process
+_licenses = None
+_resource_schema_keys = None
+
+
+def cached_for_request(get_key=lambda *args: args):
+    '''
+    Decorator that caches the result of a helper for the current request
+
+    Helpers are called many times when rendering a page (eg once per
+    resource), so the result for the same arguments is stored on the
+    template context, which is discarded at the end of the request.
+    Outside a web request the helper is always called.
+
+    :param get_key: function that gets the helper arguments and returns a
+                    hashable key for them (defaults to the arguments tuple)
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args):
+            try:
+                cache = getattr(toolkit.c, '_glasgow_helpers_cache', None)
+            except TypeError:
+                # No request (eg tests or command line)
+                return function(*args)
+            if not isinstance(cache, dict):
+                cache = {}
+                toolkit.c._glasgow_helpers_cache = cache
+
+            key = (function.__name__, get_key(*args))
+            if key not in cache:
+                cache[key] = function(*args)
+            return cache[key]
+        return wrapper
+    return decorator
+
+
 def get_licenses():
+    global _licenses
 
-    return [('', '')] + model.Package.get_license_options()
+    if _licenses is None:
+        _licenses = [('', '')] + model.Package.get_license_options()
 
+    return list(_licenses)
+
+
+@cached_for_request()
 def get_resource_versions(dataset_id, resource_id):
     try:
         context = {
@@ -32,7 +82,13 @@ def get_resource_versions(dataset_id, resource_id):
 
         helpers.flash_error('{0}'.format(e.error_dict['message']))
         return []
+    except requests.exceptions.RequestException, e:
+        # Includes client.CircuitOpenError, if the EC API is unavailable
+        helpers.flash_error('Could not get the file versions from the EC '
+                            'platform: {0}'.format(e))
+        return []
 
+@cached_for_request(lambda pkg_dict: pkg_dict['name'])
 def get_pending_files_for_dataset(pkg_dict):
     try:
         pending_files = toolkit.get_action('pending_files_for_dataset')({
@@ -48,6 +104,7 @@ def get_pending_files_for_dataset(pkg_dict):
         return []
 
 
+@cached_for_request()
 def get_pending_task_for_dataset(pkg_name):
     try:
         return toolkit.get_action('pending_task_for_dataset')({
@@ -71,16 +128,25 @@ def parse_metadata_string(metadata_str):
     return json.loads(metadata_str)
 
 
+def _get_resource_schema_keys():
+    global _resource_schema_keys
+
+    if _resource_schema_keys is None:
+        _resource_schema_keys = frozenset(
+            custom_resource_schema().keys() + [
+                'ec_api_org_id', 'FileName', 'DataSetId', 'can_be_previewed',
+                'on_same_domain', 'clear_upload',
+            ])
+
+    return _resource_schema_keys
+
+
 def get_resource_ec_extra_fields(resource_dict):
 
     if resource_dict.get('extras'):
         return resource_dict['extras']
 
-    resource_schema_keys = custom_resource_schema().keys()
-    resource_schema_keys.extend([
-        'ec_api_org_id', 'FileName', 'DataSetId', 'can_be_previewed',
-        'on_same_domain', 'clear_upload',
-    ])
+    resource_schema_keys = _get_resource_schema_keys()
 
     extra_ec_fields = []
     for key, value in resource_dict.iteritems():
@@ -106,3 +172,13 @@ def get_ec_api_metadata_link(object_type, object_dict):
         )
 
     return url
+
+
+def is_ec_api_available():
+    '''
+    Returns False while requests to the EC API are failing
+
+    Templates can use it to hide or disable actions that need the EC
+    platform, see `client.is_available`.
+    '''
+    return client.is_available()
@@ -1,5 +1,6 @@
 import os
 import cgi
+import copy
 import logging
 import json
 import datetime
@@ -26,11 +27,12 @@ import ckan.logic.schema as core_schema
 import ckanext.oauth2waad.plugin as oauth2
 
 
+from ckanext.glasgow import cache, client, metrics, streaming, tokens
 import ckanext.glasgow.logic.schema as custom_schema
+import ckanext.glasgow.model as custom_model
 
 
 log = logging.getLogger(__name__)
-requests.packages.urllib3.add_stderr_logger()
 
 get_action = p.toolkit.get_action
 check_access = p.toolkit.check_access
@@ -54,10 +56,32 @@ class ECAPIValidationError(p.toolkit.ValidationError):
     pass
 
 
+class ECAPIRequestNotFound(ECAPIError):
+    pass
+
+
+_change_request_cache = cache.TTLCache()
+
+
 def _make_uuid():
     return unicode(uuid.uuid4())
 
 
+def _ec_api_not_authorized(response):
+    '''
+    Returns the exception to raise for a 401 response from the EC API
+
+    The EC API rejected one of the cached auth tokens before its expiry
+    time (eg a temporary token that was replaced), so they are all removed
+    from the cache, and the next request gets new ones.
+    '''
+    tokens.invalidate()
+
+    return ECAPINotAuthorized(
+        'CTPEC API returned an authentication failure: {0}'.format(
+            response.content))
+
+
 def _get_api_auth_token():
     '''
     Use the auth_token obtained when logging in with the WAAD credentials
@@ -93,8 +117,7 @@ def _get_api_auth_token():
         tmp_token_file = config.get('ckanext.glasgow.tmp_auth_token_file')
         if tmp_token_file:
             try:
-                with open(tmp_token_file, 'r') as f:
-                    token = f.read().strip('\n')
+                token = tokens.tmp_auth_token(tmp_token_file)
             except IOError:
                 log.critical('Temp auth token file not found: {0}'
                              .format(tmp_token_file))
@@ -105,6 +128,129 @@ def _get_api_auth_token():
     return token
 
 
+# EC API endpoints for each operation: HTTP method, path and the API base
+# URL configuration option (`ckanext.glasgow.<api>`)
+_api_operations = {
+    'dataset_show': (
+        'GET',
+        '/Metadata/Organisation/{organization_id}/Dataset/{dataset_id}',
+        'metadata_api'),
+    'dataset_request_create': (
+        'POST',
+        '/Datasets/Organisation/{organization_id}',
+        'data_collection_api'),
+    'dataset_request_update': (
+        'PUT',
+        '/Datasets/Organisation/{organization_id}/Dataset/{dataset_id}',
+        'data_collection_api'),
+    'file_show': (
+        'GET',
+        '/Metadata/Organisation/{organization_id}/Dataset/{dataset_id}/File/{file_id}',
+        'metadata_api'),
+    'file_request_create': (
+        'POST',
+        '/Files/Organisation/{organization_id}/Dataset/{dataset_id}',
+        'data_collection_api'),
+    'file_request_update': (
+        'POST',
+        '/Files/Organisation/{organization_id}/Dataset/{dataset_id}/File/{file_id}',
+        'data_collection_api'),
+    'file_version_request_update': (
+        'PUT',
+        '/Files/Organisation/{organization_id}/Dataset/{dataset_id}/File/{file_id}/Version/{version_id}',
+        'data_collection_api'),
+    'file_version_request_delete': (
+        'DELETE',
+        '/Files/Organisation/{organization_id}/Dataset/{dataset_id}/File/{file_id}/Version/{version_id}',
+        'data_collection_api'),
+    'file_version_show': (
+        'GET',
+        '/Metadata/Organisation/{organization_id}/Dataset/{dataset_id}/File/{file_id}/Version/{version_id}',
+        'metadata_api'),
+    'file_versions_show': (
+        'GET',
+        '/Metadata/Organisation/{organization_id}/Dataset/{dataset_id}/File/{file_id}/Versions',
+        'metadata_api'),
+    'organization_show': (
+        'GET',
+        '/Metadata/Organisation/{organization_id}',
+        'metadata_api'),
+    'organization_request_create': (
+        'POST',
+        '/Organisations',
+        'data_collection_api'),
+    'organization_request_update': (
+        'PUT',
+        '/Organisations/Organisation/{organization_id}',
+        'data_collection_api'),
+    'request_status_show': (
+        'GET',
+        '/ChangeLog/RequestStatus/{request_id}',
+        'metadata_api'),
+    'changelog_show': (
+        'GET',
+        '/ChangeLog/RequestChanges',
+        'metadata_api'),
+    'approvals_list': (
+        'GET',
+        '/Approval',
+        'data_collection_api'),
+    'approval_accept': (
+        'POST',
+        '/Approval/{request_id}/Accept',
+        'data_collection_api'),
+    'approval_reject': (
+        'POST',
+        '/Approval/{request_id}/Reject',
+        'data_collection_api'),
+    'approval_download': (
+        'GET',
+        '/Approval/{request_id}/Download',
+        'data_collection_api'),
+
+    'user_role_update': (
+        'PUT',
+        '/UserRoles/User/{user_id}',
+        'data_collection_api'),
+    'user_org_role_update': (
+        'PUT',
+        '/UserRoles/Organisation/{organization_id}/User/{user_id}',
+        'data_collection_api'),
+
+    'user_show': (
+        'GET',
+        '/Identity/User/{username}',
+        'identity_api'),
+    'user_list': (
+        'GET',
+        '/Identity/User',
+        'identity_api'),
+    'user_list_for_organization': (
+        'GET',
+        '/Identity/Organisation/{organization_id}/User',
+        'identity_api'),
+    'user_request_create': (
+        'POST',
+        '/Users',
+        'data_collection_api'),
+    'user_in_organization_request_create': (
+        'POST',
+        '/Users/Organisation/{organization_id}',
+        'data_collection_api'),
+
+    # Requested directly by the harvesters, listed so their calls are
+    # identified in the metrics
+    'dataset_list_for_organization': (
+        'GET',
+        '/Organisations/{organization_id}/Datasets',
+        'metadata_api'),
+    'file_list_for_dataset': (
+        'GET',
+        '/Metadata/Organisation/{organization_id}/Dataset/{dataset_id}/File',
+        'metadata_api'),
+}
+
+
 def _get_api_endpoint(operation):
     '''
     Returns the relevant EC API endpoint for a particular operation
@@ -122,125 +268,15 @@ def _get_api_endpoint(operation):
     :rtype: tuple
     '''
 
-    write_base = config.get('ckanext.glasgow.data_collection_api', '').rstrip('/')
-    read_base = config.get('ckanext.glasgow.metadata_api', '').rstrip('/')
-    identity_base = config.get('ckanext.glasgow.identity_api', '').rstrip('/')
-
-    operations = {
-        'dataset_show': (
-            'GET',
-            '/Metadata/Organisation/{organization_id}/Dataset/{dataset_id}',
-            read_base),
-        'dataset_request_create': (
-            'POST',
-            '/Datasets/Organisation/{organization_id}',
-            write_base),
-        'dataset_request_update': (
-            'PUT',
-            '/Datasets/Organisation/{organization_id}/Dataset/{dataset_id}',
-            write_base),
-        'file_show': (
-            'GET',
-            '/Metadata/Organisation/{organization_id}/Dataset/{dataset_id}/File/{file_id}',
-            read_base),
-        'file_request_create': (
-            'POST',
-            '/Files/Organisation/{organization_id}/Dataset/{dataset_id}',
-            write_base),
-        'file_request_update': (
-            'POST',
-            '/Files/Organisation/{organization_id}/Dataset/{dataset_id}/File/{file_id}',
-            write_base),
-        'file_version_request_update': (
-            'PUT',
-            '/Files/Organisation/{organization_id}/Dataset/{dataset_id}/File/{file_id}/Version/{version_id}',
-            write_base),
-        'file_version_request_delete': (
-            'DELETE',
-            '/Files/Organisation/{organization_id}/Dataset/{dataset_id}/File/{file_id}/Version/{version_id}',
-            write_base),
-        'file_version_show': (
-            'GET',
-            '/Metadata/Organisation/{organization_id}/Dataset/{dataset_id}/File/{file_id}/Version/{version_id}',
-            read_base),
-        'file_versions_show': (
-            'GET',
-            '/Metadata/Organisation/{organization_id}/Dataset/{dataset_id}/File/{file_id}/Versions',
-            read_base),
-        'organization_show': (
-            'GET',
-            '/Metadata/Organisation/{organization_id}',
-            read_base),
-        'organization_request_create': (
-            'POST',
-            '/Organisations',
-            write_base),
-        'organization_request_update': (
-            'PUT',
-            '/Organisations/Organisation/{organization_id}',
-            write_base),
-        'request_status_show': (
-            'GET',
-            '/ChangeLog/RequestStatus/{request_id}',
-            read_base),
-        'changelog_show': (
-            'GET',
-            '/ChangeLog/RequestChanges',
-            read_base),
-        'approvals_list': (
-            'GET',
-            '/Approval',
-            write_base),
-        'approval_accept': (
-            'POST',
-            '/Approval/{request_id}/Accept',
-            write_base),
-        'approval_reject': (
-            'POST',
-            '/Approval/{request_id}/Reject',
-            write_base),
-        'approval_download': (
-            'GET',
-            '/Approval/{request_id}/Download',
-            write_base),
-
-        'user_role_update': (
-            'PUT',
-            '/UserRoles/User/{user_id}',
-            write_base),
-        'user_org_role_update': (
-            'PUT',
-            '/UserRoles/Organisation/{organization_id}/User/{user_id}',
-            write_base),
-
-        'user_show': (
-            'GET',
-            '/Identity/User/{username}',
-            identity_base),
-        'user_list': (
-            'GET',
-            '/Identity/User',
-            identity_base),
-        'user_list_for_organization': (
-            'GET',
-            '/Identity/Organisation/{organization_id}/User',
-            identity_base),
-        'user_request_create': (
-            'POST',
-            '/Users',
-            write_base),
-        'user_in_organization_request_create': (
-            'POST',
-            '/Users/Organisation/{organization_id}',
-            write_base),
-    }
-
     try:
-        method, path, url = operations[operation]
-        return method, urlparse.urljoin(url, path)
+        method, path, api = _api_operations[operation]
     except KeyError:
         return None, None
 
+    base_url = config.get('ckanext.glasgow.{0}'.format(api), '').rstrip('/')
+
+    return method, urlparse.urljoin(base_url, path)
+
 
 def _get_ec_api_org_id(ckan_org_id):
     # Get EC API id from parent organization
@@ -454,16 +490,12 @@ def dataset_request_create(context, data_dict):
 
     # Create a task status entry with the validated data
 
-    task_dict = _create_task_status(context,
-                                    task_type='dataset_request_create',
-                                    # This will be used as dataset id
-                                    entity_id=_make_uuid(),
-                                    entity_type='dataset',
-                                    # This will be used for validating datasets
-                                    key=validated_data_dict['name'],
-                                    value=json.dumps(
-                                        {'data_dict': data_dict})
-                                    )
+    task_dict = _new_task_status(task_type='dataset_request_create',
+                                 # This will be used as dataset id
+                                 entity_id=_make_uuid(),
+                                 entity_type='dataset',
+                                 # This will be used for validating datasets
+                                 key=validated_data_dict['name'])
 
     # Convert payload from CKAN to EC API spec
 
@@ -523,6 +555,43 @@ def resource_create(context, data_dict):
                                                            data_dict)
 
 
+def _get_upload_body(ec_dict, uploaded_file):
+    '''
+    Returns a streamed multipart body with the file metadata and contents
+
+    The file is read in chunks from the upload temp file as the request is
+    sent, and the progress is logged roughly every 10%.
+    '''
+
+    progress = {'logged': 0}
+
+    def log_progress(bytes_read, total):
+        percent = bytes_read * 100 / total if total else 100
+        if percent >= progress['logged'] + 10 or bytes_read == total:
+            progress['logged'] = percent
+            log.debug('Uploading {0} to EC API: {1}/{2} bytes ({3}%)'.format(
+                uploaded_file.filename, bytes_read, total, percent))
+
+    return streaming.MultipartEncoder([
+        ('metadata', json.dumps(ec_dict)),
+        ('file', (uploaded_file.filename, uploaded_file.file)),
+    ], callback=log_progress)
+
+
+def _get_upload_request_options():
+    '''
+    Returns the timeout and retries for requests with a file upload
+
+    Uploads are not retried by default. They are POST requests creating a
+    new EC request, so retrying one after a timeout or a 502-504 response,
+    when the EC API might have received it, can create duplicates.
+    '''
+    return {
+        'timeout': float(config.get('ckanext.glasgow.upload.timeout', 300)),
+        'retries': int(config.get('ckanext.glasgow.upload.retries', 0)),
+    }
+
+
 def file_request_create(context, data_dict):
     '''
     Requests the creation of a dataset to the EC Data Collection API
@@ -591,14 +660,10 @@ def file_request_create(context, data_dict):
     key = '{0}@{1}'.format(validated_data_dict.get('package_id', 'file'),
                            datetime.datetime.now().isoformat())
     uploaded_file = data_dict.pop('upload', None)
-    task_dict = _create_task_status(context,
-                                    task_type='file_request_create',
-                                    entity_id=_make_uuid(),
-                                    entity_type='file',
-                                    key=key,
-                                    value=json.dumps(
-                                        {'data_dict': data_dict})
-                                    )
+    task_dict = _new_task_status(task_type='file_request_create',
+                                 entity_id=_make_uuid(),
+                                 entity_type='file',
+                                 key=key)
 
     # Convert payload from CKAN to EC API spec
 
@@ -617,17 +682,13 @@ def file_request_create(context, data_dict):
         'Authorization': _get_api_auth_token(),
     }
 
+    upload_kwargs = {}
     if isinstance(uploaded_file, cgi.FieldStorage):
-        files = {
-            'file': (uploaded_file.filename,
-                     uploaded_file.file)
-        }
-        data = {
-            'metadata': json.dumps(ec_dict)
-        }
+        data = _get_upload_body(ec_dict, uploaded_file)
+        headers['Content-Type'] = data.content_type
+        upload_kwargs = _get_upload_request_options()
     else:
         headers['Content-Type'] = 'application/json'
-        files = None
 
         # Use ExternalUrl instead of FileExternalUrl
         ec_dict['ExternalUrl'] = ec_dict.pop('FileExternalUrl', None)
@@ -637,9 +698,9 @@ def file_request_create(context, data_dict):
     content = send_request_to_ec_platform(method, url,
                                           data=data,
                                           headers=headers,
-                                          files=files,
                                           context=context,
-                                          task_dict=task_dict)
+                                          task_dict=task_dict,
+                                          **upload_kwargs)
 
     # Store data in task status table
 
@@ -660,26 +721,75 @@ def file_request_create(context, data_dict):
     }
 
 
-def _create_task_status(context, task_type, entity_id, entity_type, key,
-                        value):
+_task_status_fields = ('id', 'entity_id', 'entity_type', 'task_type', 'key',
+                       'value', 'state', 'error', 'last_updated')
 
-    context.update({'ignore_auth': True})
 
-    if not isinstance(value, basestring):
-        value = json.dumps(value)
+def _new_task_status(task_type, entity_id, entity_type, key):
+    '''
+    Returns a task status dict for a request to the EC API
 
-    task_dict = {
+    The task is not stored yet: the request actions save it once with its
+    final state and value, after sending the request, with
+    `_update_task_status_success` or `_update_task_status_error`.
+    '''
+    return {
+        'id': _make_uuid(),
         'task_type': task_type,
         'entity_id': entity_id,
         'entity_type': entity_type,
         'key': key,
-        'value': value,
+        'value': None,
         'state': 'new',
         'last_updated': datetime.datetime.now(),
     }
-    task_dict = get_action('task_status_update')(context, task_dict)
 
-    return task_dict
+
+def _save_task_statuses(context, task_dicts):
+    '''
+    Stores several task statuses in a single transaction
+
+    This is a lighter version of `task_status_update` for the tasks
+    created by this extension: the dicts are saved as they are, without
+    validating and dictizing them again, and `value` is only JSON encoded
+    if it is not a string already. Existing tasks (with the same id) are
+    updated and the rest created. The changes are committed once for all
+    tasks, unless `defer_commit` is set in the context.
+
+    :param task_dicts: task status dicts
+    :type task_dicts: list
+
+    :returns: the saved task status dicts
+    :rtype: list
+    '''
+    saved = []
+    for task_dict in task_dicts:
+        task_dict = dict(task_dict)
+        task_dict.setdefault('id', _make_uuid())
+
+        value = task_dict.get('value')
+        if value is not None and not isinstance(value, basestring):
+            task_dict['value'] = json.dumps(value)
+
+        last_updated = task_dict.get('last_updated')
+        if not last_updated:
+            task_dict['last_updated'] = datetime.datetime.now()
+        elif isinstance(last_updated, basestring):
+            task_dict['last_updated'] = dateutil.parser.parse(last_updated)
+
+        # Tasks created on this session are updated without querying them
+        model.Session.merge(model.TaskStatus(**dict(
+            (field, task_dict.get(field)) for field in _task_status_fields)))
+
+        saved.append(task_dict)
+
+    if not context.get('defer_commit'):
+        model.Session.commit()
+
+    for task_dict in saved:
+        task_dict['last_updated'] = task_dict['last_updated'].isoformat()
+
+    return saved
 
 
 def resource_update(context, data_dict):
@@ -701,18 +811,18 @@ def _update_task_status_success(context, task_dict, value):
 
     context.update({'ignore_auth': True})
 
-    if not isinstance(value, basestring):
-        value = json.dumps(value)
+    request_id = value.get('request_id') if isinstance(value, dict) else None
+    if request_id:
+        # Index the request id so the task can be found when processing the
+        # changelog. It gets committed along with the task status below
+        model.Session.merge(custom_model.EcRequestTask(
+            request_id=unicode(request_id), task_id=task_dict['id']))
 
     task_dict['state'] = 'sent'
     task_dict['value'] = value
     task_dict['last_updated'] = datetime.datetime.now()
 
-    task_dict = get_action('task_status_update')(context, task_dict)
-
-    _expire_task_status(context, task_dict['id'])
-
-    return task_dict
+    return _save_task_statuses(context, [task_dict])[0]
 
 
 def file_request_update(context, data_dict):
@@ -800,14 +910,10 @@ def file_request_update(context, data_dict):
                            datetime.datetime.now().isoformat())
 
     uploaded_file = data_dict.pop('upload', None)
-    task_dict = _create_task_status(context,
-                                    task_type='file_request_update',
-                                    entity_id=validated_data_dict['package_id'],
-                                    entity_type='file',
-                                    key=key,
-                                    value=json.dumps(
-                                        {'data_dict': data_dict})
-                                    )
+    task_dict = _new_task_status(task_type='file_request_update',
+                                 entity_id=validated_data_dict['package_id'],
+                                 entity_type='file',
+                                 key=key)
 
     # Send request to EC Data Collection API
 
@@ -823,17 +929,13 @@ def file_request_update(context, data_dict):
         'Authorization': _get_api_auth_token(),
     }
 
+    upload_kwargs = {}
     if isinstance(uploaded_file, cgi.FieldStorage):
-        files = {
-            'file': (uploaded_file.filename,
-                     uploaded_file.file)
-        }
-        data = {
-            'metadata': json.dumps(ec_dict)
-        }
+        data = _get_upload_body(ec_dict, uploaded_file)
+        headers['Content-Type'] = data.content_type
+        upload_kwargs = _get_upload_request_options()
     else:
         headers['Content-Type'] = 'application/json'
-        files = None
 
         # Check if the URL provided is actually the same file (using
         # the platform download URL)
@@ -845,9 +947,9 @@ def file_request_update(context, data_dict):
 
         data = json.dumps(ec_dict)
     content = send_request_to_ec_platform(method, url, data, headers,
-                                          files=files,
                                           context=context,
-                                          task_dict=task_dict)
+                                          task_dict=task_dict,
+                                          **upload_kwargs)
 
     try:
         request_id = content['RequestId']
@@ -879,28 +981,20 @@ def _update_task_status_error(context, task_dict, value):
 
     context.update({'ignore_auth': True})
 
-    if not isinstance(value, basestring):
-        value = json.dumps(value)
-
     task_dict['state'] = 'error'
     task_dict['value'] = value
     task_dict['last_updated'] = datetime.datetime.now()
 
-    task_dict = get_action('task_status_update')(context, task_dict)
-
-    _expire_task_status(context, task_dict['id'])
-
-    return task_dict
+    return _save_task_statuses(context, [task_dict])[0]
 
 
 def _expire_task_status(context, task_id):
     '''Expires a TaskStatus object from the current Session
 
-    TaskStatus are generally updated twice in the same Session (first in
-    `_create_task_status` and then in either `_update_task_status_error`
-    or `_update_task_status_succes`. If we want functions calling the
-    `dataset_request_create` action to access the latest version, we need to
-    expire the object currently held in the Session.
+    The harvesters update TaskStatus objects that may have been loaded
+    before in the same Session. If we want functions called later on to
+    access the latest version, we need to expire the object currently held
+    in the Session.
     '''
     if not context.get('model'):
         return
@@ -999,15 +1093,11 @@ def dataset_request_update(context, data_dict):
     key = '{0}@{1}'.format(validated_data_dict.get('name', data_dict['id']),
                            datetime.datetime.now().isoformat())
 
-    task_dict = _create_task_status(context,
-                                    task_type='dataset_request_update',
-                                    # This will be used as dataset id
-                                    entity_id=validated_data_dict['id'],
-                                    entity_type='dataset',
-                                    key=key,
-                                    value=json.dumps(
-                                        {'data_dict': validated_data_dict})
-                                    )
+    task_dict = _new_task_status(task_type='dataset_request_update',
+                                 # This will be used as dataset id
+                                 entity_id=validated_data_dict['id'],
+                                 entity_type='dataset',
+                                 key=key)
 
     # Send request to EC Data Collection API
 
@@ -1078,7 +1168,6 @@ def resource_version_show(context, data_dict):
 
     content = send_request_to_ec_platform(method, url)
 
-    res_ec_to_ckan = custom_schema.convert_ec_file_to_ckan_resource
     try:
         metadata = content['MetadataResultSet']
     except IndexError:
@@ -1086,10 +1175,10 @@ def resource_version_show(context, data_dict):
 
     versions = []
     if metadata:
-        for version in metadata:
-            ckan_resource = res_ec_to_ckan(version['FileMetadata'])
+        versions = custom_schema.convert_ec_files_to_ckan_resources(
+            [version['FileMetadata'] for version in metadata])
+        for version, ckan_resource in zip(metadata, versions):
             ckan_resource['version'] = version['Version']
-            versions.append(ckan_resource)
     return versions
 
 
@@ -1104,70 +1193,135 @@ def check_for_task_status_update(context, data_dict):
     task_status = p.toolkit.get_action('task_status_show')(context,
         {'id': task_id})
 
+    latest = request_task_status_operation(task_status)
+
+    return apply_task_status_operation(context, task_status, latest)
+
+
+def _get_task_status_request_dict(task_status):
     try:
         request_dict = json.loads(task_status.get('value', ''))
-        method, url = _get_api_endpoint('request_status_show')
-        url = url.format(request_id=request_dict['request_id'])
+        request_dict['request_id']
     except ValueError:
         raise p.toolkit.ValidationError(
             ['task_status value is not valid JSON'])
     except KeyError:
         raise p.toolkit.ValidationError(['no request_id in task_status value'])
 
-    headers = {
-        'Authorization': _get_api_auth_token(),
-        'Content-Type': 'application/json',
-    }
+    return request_dict
+
+
+def request_task_status_operation(task_status, headers=None, timeout=None):
+    '''
+    Requests the latest operation for the EC request of a task status
 
-    response = requests.request(method, url, headers=headers, verify=False)
+    This only calls the EC API and does not access the database, so it can
+    be called for several tasks at the same time from different threads.
+    The result can be stored with `apply_task_status_operation`.
+
+    :param task_status: task status dict, with the EC `request_id` stored
+                        in its value
+    :type task_status: dict
+    :param headers: headers to send (defaults to the current auth token)
+    :type headers: dict
+    :param timeout: timeout for the request (defaults to the client one)
+    :type timeout: float
+
+    :returns: the most recent operation returned by the EC API
+    :rtype: dict
+    '''
+
+    request_dict = _get_task_status_request_dict(task_status)
+
+    method, url = _get_api_endpoint('request_status_show')
+    url = url.format(request_id=request_dict['request_id'])
+
+    if headers is None:
+        headers = {
+            'Authorization': _get_api_auth_token(),
+            'Content-Type': 'application/json',
+        }
+
+    kwargs = {'headers': headers, 'verify': False}
+    if timeout:
+        kwargs['timeout'] = timeout
+
+    response = client.request(method, url, **kwargs)
     if response.status_code == requests.codes.ok:
         try:
             result = response.json()
         except ValueError:
             raise ECAPIValidationError(['EC API Error: response not JSON'])
 
-        latest = result['Operations'][-1]
-        latest_timestamp = dateutil.parser.parse(latest['Timestamp'],
-                                                 yearfirst=True)
+        return result['Operations'][-1]
+    else:
+        raise ECAPIError(['EC API returned an error: {0} - {1}'.format(
+            response.status_code, url)])
+
+
+def apply_task_status_operation(context, task_status, latest, save=True):
+    '''
+    Updates a task status with the latest operation from the EC API
+
+    If the operation is more recent than the last update of the task, its
+    state is updated, and if the request succeeded the relevant action
+    is run (eg creating the dataset).
+
+    :param task_status: task status dict
+    :type task_status: dict
+    :param latest: operation returned by `request_task_status_operation`
+    :type latest: dict
+    :param save: if False, the updated task status is only returned, so
+                 callers can save several at once with
+                 `_save_task_statuses` (default True)
+    :type save: bool
+
+    :returns: the updated task status dict, or None if there were no
+              changes
+    :rtype: dict
+    '''
 
-        task_status_timestamp = dateutil.parser.parse(
-            task_status['last_updated'])
+    request_dict = _get_task_status_request_dict(task_status)
 
+    latest_timestamp = dateutil.parser.parse(latest['Timestamp'],
+                                             yearfirst=True)
 
-        if latest_timestamp > task_status_timestamp:
-            if latest['OperationState'] == 'InProgress':
+    task_status_timestamp = dateutil.parser.parse(
+        task_status['last_updated'])
 
-               task_status['state'] = 'in_progress'
-               request_dict['ec_api_message'] = latest['Message']
+    if latest_timestamp > task_status_timestamp:
+        if latest['OperationState'] == 'InProgress':
 
-            elif latest['OperationState'] == 'Failed':
+            task_status['state'] = 'in_progress'
+            request_dict['ec_api_message'] = latest['Message']
 
-               task_status['state'] = 'error'
-               task_status['error'] = latest['Message']
+        elif latest['OperationState'] == 'Failed':
 
+            task_status['state'] = 'error'
+            task_status['error'] = latest['Message']
 
-            elif latest['OperationState'] == 'Succeeded':
-                task_status['state'] = 'succeeded'
-                request_dict['ec_api_message'] = latest['Message']
+        elif latest['OperationState'] == 'Succeeded':
+            task_status['state'] = 'succeeded'
+            request_dict['ec_api_message'] = latest['Message']
 
-                # call dataset_create/user_create/etc
-                try:
-                    on_task_status_success(context, task_status)
-                except NoSuchTaskType, e:
-                    task_status['state'] = 'error'
-                    # todo: fix abuse of task_status.value
-                    request_dict['ec_api_message'] = e.message
+            # call dataset_create/user_create/etc
+            try:
+                on_task_status_success(context, task_status)
+            except NoSuchTaskType, e:
+                task_status['state'] = 'error'
+                # todo: fix abuse of task_status.value
+                request_dict['ec_api_message'] = e.message
 
-            task_status.update({
-                'value': json.dumps(request_dict),
-                'last_updated': latest['Timestamp'],
-            })
+        task_status.update({
+            'value': json.dumps(request_dict),
+            'last_updated': latest['Timestamp'],
+        })
 
-            return  p.toolkit.get_action('task_status_update')(context,
-                                                               task_status)
-    else:
-        raise ECAPIError(['EC API returned an error: {0} - {1}'.format(
-            response.status_code, url)])
+        if not save:
+            return task_status
+
+        return p.toolkit.get_action('task_status_update')(context,
+                                                          task_status)
 
 
 class NoSuchTaskType(Exception):
@@ -1187,7 +1341,10 @@ def on_task_status_success(context, task_status_dict):
             'user': site_user['name'],
             'model': model,
             'session': model.Session,
-            'schema': custom_schema.ec_create_package_schema()
+            'schema': custom_schema.ec_create_package_schema(),
+            # Callers saving several tasks at once commit the dataset along
+            # with its task status
+            'defer_commit': context.get('defer_commit', False),
         }
 
         #todo update extras from successs
@@ -1209,18 +1366,76 @@ def on_task_status_success(context, task_status_dict):
 
 @p.toolkit.side_effect_free
 def get_change_request(context, data_dict):
+    '''
+    Requests the status of a change request to the EC API
+
+    Results are cached for a short time, as this is called on every view of
+    pending datasets and organizations. Requests not found are cached too.
+    If the EC API fails or is slow and there is an older result for the
+    request, this is returned instead.
+
+    :param id: the EC request id
+    :type id: string
+
+    :returns: a list with the operations for the request
+    :rtype: list
+    '''
     p.toolkit.check_access('get_change_request', context, data_dict)
     try:
         request_id = data_dict['id']
     except KeyError:
         raise p.toolkit.ValidationError(['id missing'])
 
+    ttl = float(config.get('ckanext.glasgow.change_request_cache.ttl', 30))
+    if ttl <= 0:
+        return _request_change_request(request_id)
+
+    not_found_ttl = float(config.get(
+        'ckanext.glasgow.change_request_cache.not_found_ttl', 60))
+    stale_ttl = float(config.get(
+        'ckanext.glasgow.change_request_cache.stale_ttl', 600))
+    stale_timeout = float(config.get(
+        'ckanext.glasgow.change_request_cache.stale_timeout', 3))
+
+    cached = _change_request_cache.get(request_id)
+    if cached:
+        (found, results), age = cached
+        if age < (ttl if found else not_found_ttl):
+            if not found:
+                raise ECAPIRequestNotFound(results)
+            return copy.deepcopy(results)
+
+    stale = None
+    if cached and cached[0][0] and cached[1] < stale_ttl:
+        stale = cached[0][1]
+
+    try:
+        # Don't wait too long if there is something to fall back to
+        results = _request_change_request(
+            request_id, timeout=stale_timeout if stale else None)
+    except ECAPIRequestNotFound, e:
+        _change_request_cache.set(request_id, (False, e.error_dict))
+        raise
+    except (ECAPIError, requests.exceptions.RequestException), e:
+        if stale is None:
+            raise
+        log.warning('Could not get status for request {0}, using a cached '
+                    'one: {1}'.format(request_id, str(e)))
+        return copy.deepcopy(stale)
+
+    _change_request_cache.set(request_id, (True, results))
+
+    return copy.deepcopy(results)
+
+
+def _request_change_request(request_id, timeout=None):
+
     method, url = _get_api_endpoint('request_status_show')
     url = url.format(request_id=request_id)
 
     import ckanext.oauth2waad.plugin as oauth2waad_plugin
     try:
-        access_token = oauth2waad_plugin.service_to_service_access_token('metadata')
+        access_token = tokens.service_to_service_access_token('metadata')
         if not access_token.startswith('Bearer '):
             access_token = 'Bearer ' + access_token
         headers = {
@@ -1230,7 +1445,11 @@ def get_change_request(context, data_dict):
     except oauth2waad_plugin.ServiceToServiceAccessTokenError, e:
         raise ECAPIError(['EC API Error: Failed to get service auth {0}'.format(e.message)])
 
-    response = requests.request(method, url, headers=headers, verify=False)
+    kwargs = {'headers': headers, 'verify': False}
+    if timeout:
+        kwargs['timeout'] = timeout
+
+    response = client.request(method, url, **kwargs)
     if response.status_code == requests.codes.ok:
         try:
             results = response.json()
@@ -1245,6 +1464,9 @@ def get_change_request(context, data_dict):
 
         return results
 
+    elif response.status_code == requests.codes.not_found:
+        raise ECAPIRequestNotFound(['EC API Error: {0} - {1}'.format(
+            response.status_code, response.content)])
     else:
         raise ECAPIError(['EC API Error: {0} - {1}'.format(
             response.status_code, response.content)])
@@ -1293,7 +1515,7 @@ def changelog_show(context, data_dict):
     # Get Service to Service auth token
 
     try:
-        access_token = oauth2.service_to_service_access_token('metadata')
+        access_token = tokens.service_to_service_access_token('metadata')
     except oauth2.ServiceToServiceAccessTokenError:
         log.warning('Could not get the Service to Service auth token')
         access_token = None
@@ -1303,7 +1525,7 @@ def changelog_show(context, data_dict):
         'Content-Type': 'application/json',
     }
 
-    response = requests.request(method, url, headers=headers, params=params, verify=False)
+    response = client.request(method, url, headers=headers, params=params, verify=False)
 
     content = response.json()
 
@@ -1318,7 +1540,7 @@ def changelog_show(context, data_dict):
             'content': [content],
         }
         if status_code == 401:
-            raise ECAPINotAuthorized('CTPEC API returned an authentication failure: {0}'.format(response.content))
+            raise _ec_api_not_authorized(response)
         else:
             raise p.toolkit.ValidationError(error_dict)
 
@@ -1352,14 +1574,10 @@ def organization_request_create(context, data_dict):
     ec_dict = custom_schema.convert_ckan_organization_to_ec_organization(
         validated_data_dict)
 
-    task_dict = _create_task_status(context,
-                                    task_type='organization_request_create',
-                                    entity_id=validated_data_dict['name'],
-                                    entity_type='organization',
-                                    key=validated_data_dict['name'],
-                                    value=json.dumps({
-                                        'data_dict': data_dict,
-                                    }))
+    task_dict = _new_task_status(task_type='organization_request_create',
+                                 entity_id=validated_data_dict['name'],
+                                 entity_type='organization',
+                                 key=validated_data_dict['name'])
 
     method, url = _get_api_endpoint('organization_request_create')
 
@@ -1427,13 +1645,10 @@ def organization_request_update(context, data_dict):
     if errors:
         raise p.toolkit.ValidationError(errors)
 
-    task_dict = _create_task_status(context,
-                                    task_type='organization_request_update',
-                                    entity_id=validated_data_dict['id'],
-                                    entity_type='organization',
-                                    key=validated_data_dict['name'],
-                                    value=json.dumps(
-                                        {'data_dict': data_dict}))
+    task_dict = _new_task_status(task_type='organization_request_update',
+                                 entity_id=validated_data_dict['id'],
+                                 entity_type='organization',
+                                 key=validated_data_dict['name'])
 
     ec_dict = custom_schema.convert_ckan_organization_to_ec_organization(
         validated_data_dict)
@@ -1474,6 +1689,7 @@ def send_request_to_ec_platform(method, url, data=None, headers=None, **kwargs):
 
     task_dict = kwargs.pop('task_dict', None)
     context = kwargs.pop('context', None)
+    timeout = kwargs.pop('timeout', 50)
 
     if not headers:
         headers = {
@@ -1481,16 +1697,22 @@ def send_request_to_ec_platform(method, url, data=None, headers=None, **kwargs):
             'Content-Type': 'application/json',
         }
 
+    # Streamed bodies can not be stored on the task, just their fields
+    if isinstance(data, streaming.MultipartEncoder):
+        data_summary = data.summary()
+    else:
+        data_summary = data
+
     try:
-        response = requests.request(method, url,
+        response = client.request(method, url,
                                     data=data,
                                     headers=headers,
                                     verify=False,
-                                    timeout=50,
+                                    timeout=timeout,
                                     **kwargs
                                     )
 
-        log.debug('request data: {0}'.format(str(data)))
+        log.debug('request data: {0}'.format(str(data_summary)))
         response.raise_for_status()
     except requests.exceptions.HTTPError:
         error_dict = {
@@ -1500,12 +1722,12 @@ def send_request_to_ec_platform(method, url, data=None, headers=None, **kwargs):
         }
         if task_dict:
             task_dict = _update_task_status_error(context, task_dict, {
-                'data_dict': data,
+                'data_dict': data_summary,
                 'error': error_dict
             })
 
         if response.status_code == requests.codes.unauthorized:
-            raise ECAPINotAuthorized('CTPEC API returned an authentication failure: {0}'.format(response.content))
+            raise _ec_api_not_authorized(response)
         elif response.status_code == requests.codes.not_found:
             raise ECAPINotFound('CTPEC API returned a 404: {0}'.format(response.content))
 
@@ -1519,7 +1741,7 @@ def send_request_to_ec_platform(method, url, data=None, headers=None, **kwargs):
 
         if task_dict:
             task_dict = _update_task_status_error(context, task_dict, {
-                'data_dict': data,
+                'data_dict': data_summary,
                 'error': error_dict
             })
         raise p.toolkit.ValidationError(error_dict)
@@ -1531,6 +1753,11 @@ def send_request_to_ec_platform(method, url, data=None, headers=None, **kwargs):
             'message': ['Error decoding JSON from EC Platform response'],
             'content': [response.content],
         }
+        if task_dict:
+            task_dict = _update_task_status_error(context, task_dict, {
+                'data_dict': data_summary,
+                'error': error_dict
+            })
         raise p.toolkit.ValidationError(error_dict)
 
     return content
@@ -1592,14 +1819,10 @@ def user_role_update(context, data_dict):
     key = '{0}@{1}'.format(data_dict.get('name', data_dict['id']),
                            datetime.datetime.now().isoformat())
 
-    task_dict = _create_task_status(context,
-                                    task_type='user_update',
-                                    entity_id=data_dict['id'],
-                                    entity_type='member',
-                                    key=key,
-                                    value=json.dumps(
-                                        {'data_dict': data_dict})
-                                    )
+    task_dict = _new_task_status(task_type='user_update',
+                                 entity_id=data_dict['id'],
+                                 entity_type='member',
+                                 key=key)
 
     user = p.toolkit.get_action('user_show')(
         context,
@@ -1692,13 +1915,10 @@ def user_role_delete(context, user, user_organization=None):
 
     key = '{0}@{1}'.format(user, datetime.datetime.now().isoformat())
 
-    task_dict = _create_task_status(context,
-                                    task_type='user_update',
-                                    entity_id=ckan_user['id'],
-                                    entity_type='member',
-                                    key=key,
-                                    value=None
-                                    )
+    task_dict = _new_task_status(task_type='user_update',
+                                 entity_id=ckan_user['id'],
+                                 entity_type='member',
+                                 key=key)
     
 
     if user_organization:
@@ -1754,7 +1974,7 @@ def ec_user_show(context, data_dict):
     url = url.format(username=username)
 
     try:
-        access_token = oauth2.service_to_service_access_token('identity')
+        access_token = tokens.service_to_service_access_token('identity')
     except oauth2.ServiceToServiceAccessTokenError:
         log.warning('Could not get the Service to Service auth token')
         access_token = None
@@ -1784,7 +2004,7 @@ def ec_user_list(context, data_dict):
     if top:
         params['$top'] = top
     try:
-        access_token = oauth2.service_to_service_access_token('identity')
+        access_token = tokens.service_to_service_access_token('identity')
     except oauth2.ServiceToServiceAccessTokenError:
         log.warning('Could not get the Service to Service auth token')
         access_token = None
@@ -1833,7 +2053,7 @@ def approvals_list(context, data_dict):
         'Content-Type': 'application/json',
     }
 
-    response = requests.request(method, url, headers=headers, params=params, verify=False)
+    response = client.request(method, url, headers=headers, params=params, verify=False)
 
     content = response.json()
 
@@ -1848,7 +2068,7 @@ def approvals_list(context, data_dict):
             'content': [content],
         }
         if status_code == 401:
-            raise ECAPINotAuthorized('CTPEC API returned an authentication failure: {0}'.format(response.content))
+            raise _ec_api_not_authorized(response)
         else:
             raise p.toolkit.ValidationError(error_dict)
 
@@ -1888,7 +2108,7 @@ def approval_act(context, data_dict):
         'Authorization': _get_api_auth_token(),
     }
 
-    response = requests.request(method, url, headers=headers, verify=False)
+    response = client.request(method, url, headers=headers, verify=False)
 
     # Check status codes
 
@@ -1903,7 +2123,7 @@ def approval_act(context, data_dict):
             'content': [content],
         }
         if status_code == 401:
-            raise ECAPINotAuthorized('CTPEC API returned an authentication failure: {0}'.format(response.content))
+            raise _ec_api_not_authorized(response)
         else:
             raise p.toolkit.ValidationError(error_dict)
 
@@ -1916,12 +2136,26 @@ def approval_download(context, data_dict):
 
     :param request_id: Request id to act upon
     :type top: string
+    :param stream: if True, the file contents are not downloaded in memory,
+                   and `content` is an iterator over them in chunks instead
+                   (only for use from Python code, defaults to False)
+    :type stream: bool
+    :param range: value of the HTTP `Range` header, to download only part
+                  of the file (optional)
+    :type range: string
+    :param if_range: value of the HTTP `If-Range` header (optional)
+    :type if_range: string
+
+    :returns: a dict with the response `status` (200, or 206 for partial
+              content), `headers` and `content`
+    :rtype: dict
 
     '''
 
     p.toolkit.check_access('approval_download', context, data_dict)
 
     request_id = data_dict.get('request_id', False)
+    stream = p.toolkit.asbool(data_dict.get('stream', False))
 
     # Send request to EC Audit API
 
@@ -1934,32 +2168,84 @@ def approval_download(context, data_dict):
     headers = {
         'Authorization': _get_api_auth_token(),
     }
-
-    response = requests.request(method, url, headers=headers, verify=False)
+    if stream:
+        # Get the file as stored, so the body sent to the client matches the
+        # Content-Length and Content-Range headers
+        headers['Accept-Encoding'] = 'identity'
+    if data_dict.get('range'):
+        headers['Range'] = data_dict['range']
+        if data_dict.get('if_range'):
+            headers['If-Range'] = data_dict['if_range']
+
+    response = client.request(method, url, headers=headers, verify=False,
+                              stream=stream)
 
     # Check status codes
 
     status_code = response.status_code
 
-    if status_code != 200:
+    if status_code not in (200, 206):
 
-        content = response.json()
+        # Errors like 416 (Range Not Satisfiable) might not have a JSON body
+        try:
+            content = response.json()
+        except ValueError:
+            content = response.content
+        response.close()
         error_dict = {
             'message': ['The CTPEC API returned an error code'],
             'status': [status_code],
             'content': [content],
         }
         if status_code == 401:
-            raise ECAPINotAuthorized('CTPEC API returned an authentication failure: {0}'.format(response.content))
+            raise _ec_api_not_authorized(response)
         else:
             raise p.toolkit.ValidationError(error_dict)
 
+    if stream:
+        return {
+            'status': status_code,
+            'headers': response.headers,
+            'content': streaming.iter_raw_content(response),
+        }
+
     return {
+        'status': status_code,
         'headers': response.headers,
         'content': response.content,
     }
 
 
+@p.toolkit.side_effect_free
+def ec_api_metrics_show(context, data_dict):
+    '''
+    Returns the metrics of the requests sent to the EC API
+
+    Metrics are kept per process, so only the requests sent by the web
+    server process handling this request are included.
+
+    :param format: `json` (default) or `prometheus` to get the metrics in
+                   the Prometheus text format
+    :type format: string
+
+    :returns: a dict with the metrics for each operation (see
+              `ckanext.glasgow.metrics.get_metrics`) under `operations` and
+              the state of the circuit breakers under `circuit_breakers`,
+              or a string if the format is `prometheus`
+    :rtype: dict
+    '''
+
+    check_access('ec_api_metrics_show', context, data_dict)
+
+    if data_dict.get('format') == 'prometheus':
+        return metrics.to_prometheus()
+
+    return {
+        'operations': metrics.get_metrics(),
+        'circuit_breakers': client.get_circuit_states(),
+    }
+
+
 def organization_list_for_user(context, data_dict):
     '''Return the list of organizations that the user is a member of.
 
@@ -2080,14 +2366,10 @@ def file_request_delete(context, data_dict):
     key = '{0}@{1}'.format(data_dict.get('package_id', 'file'),
                            datetime.datetime.now().isoformat())
 
-    task_dict = _create_task_status(context,
-                                    task_type='file_request_delete',
-                                    entity_id=data_dict['package_id'],
-                                    entity_type='file',
-                                    key=key,
-                                    value=json.dumps(
-                                        {'data_dict': data_dict})
-                                    )
+    task_dict = _new_task_status(task_type='file_request_delete',
+                                 entity_id=data_dict['package_id'],
+                                 entity_type='file',
+                                 key=key)
 
     # Send request to EC Data Collection API
 
@@ -2146,15 +2428,11 @@ def ec_user_create(context, data_dict):
     if errors:
         raise p.toolkit.ValidationError(errors)
 
-    task_dict = _create_task_status(context,
-                                    task_type='user_request_create',
-                                    entity_id=_make_uuid(),
-                                    entity_type='user',
-                                    # This will be used for validating datasets
-                                    key=validated_data_dict['UserName'],
-                                    value=json.dumps(
-                                        {'data_dict': data_dict})
-                                    )
+    task_dict = _new_task_status(task_type='user_request_create',
+                                 entity_id=_make_uuid(),
+                                 entity_type='user',
+                                 # This will be used for validating datasets
+                                 key=validated_data_dict['UserName'])
 
     organization_id = validated_data_dict.pop('OrganisationId', None)
     if organization_id:
@@ -2164,7 +2442,7 @@ def ec_user_create(context, data_dict):
         method, url = _get_api_endpoint('user_request_create')
 
     try:
-        access_token = oauth2.service_to_service_access_token('data_collection')
+        access_token = tokens.service_to_service_access_token('data_collection')
     except oauth2.ServiceToServiceAccessTokenError:
         log.warning('Could not get the Service to Service auth token')
         access_token = None
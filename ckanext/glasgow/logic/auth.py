@@ -79,6 +79,11 @@ def changelog_show(context, data_dict):
             'msg': 'Only sysadmins can see the change log'}
 
 
+def ec_api_metrics_show(context, data_dict):
+    return {'success': False,
+            'msg': 'Only sysadmins can see the EC API metrics'}
+
+
 def approvals_list(context, data_dict):
 
     # Check if the user has admin rights in some org
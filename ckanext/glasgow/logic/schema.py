@@ -95,11 +95,43 @@ ckan_to_ec_user_mapping = {
 }
 
 
+class FieldMapping(object):
+    '''
+    Lookup structures for one of the CKAN to EC field mappings above
+
+    These are built once on import so the converters don't need to rebuild
+    lists of keys on every call.
+
+    :param mapping: dict with CKAN field names as keys and EC field names
+                    as values
+    :type mapping: dict
+    :param exclude: CKAN fields that need special handling, which are not
+                    included in `fields`
+    :type exclude: tuple
+    '''
+
+    def __init__(self, mapping, exclude=()):
+        # (ckan_name, ec_name) pairs
+        self.fields = tuple((ckan_name, ec_name)
+                            for ckan_name, ec_name in mapping.iteritems()
+                            if ckan_name not in exclude)
+        self.ec_keys = frozenset(mapping.values())
+        self.ec_to_ckan = dict((ec_name, ckan_name)
+                               for ckan_name, ec_name in mapping.iteritems())
+
+
+organization_mapping = FieldMapping(ckan_to_ec_organization_mapping)
+dataset_mapping = FieldMapping(ckan_to_ec_dataset_mapping,
+                               exclude=('tags',))
+resource_mapping = FieldMapping(ckan_to_ec_resource_mapping)
+user_mapping = FieldMapping(ckan_to_ec_user_mapping)
+
+
 def convert_ckan_organization_to_ec_organization(ckan_dict):
 
     ec_dict = {}
 
-    for ckan_name, ec_name in ckan_to_ec_organization_mapping.iteritems():
+    for ckan_name, ec_name in organization_mapping.fields:
         ec_dict[ec_name] = ckan_dict.get(ckan_name)
 
     return ec_dict
@@ -109,7 +141,7 @@ def convert_ec_organization_to_ckan_organization(ec_dict):
 
     ckan_dict = {}
 
-    for ckan_name, ec_name in ckan_to_ec_organization_mapping.iteritems():
+    for ckan_name, ec_name in organization_mapping.fields:
         ckan_dict[ckan_name] = ec_dict.get(ec_name)
 
     # Ask MS
@@ -123,9 +155,9 @@ def convert_ckan_dataset_to_ec_dataset(ckan_dict):
 
     ec_dict = {}
 
-    for ckan_name, ec_name in ckan_to_ec_dataset_mapping.iteritems():
-        if ckan_name != 'tags' and ckan_name in ckan_dict:
-            ec_dict[ec_name] = ckan_dict.get(ckan_name)
+    for ckan_name, ec_name in dataset_mapping.fields:
+        if ckan_name in ckan_dict:
+            ec_dict[ec_name] = ckan_dict[ckan_name]
 
     if ckan_dict.get('tags'):
         ec_dict['Tags'] = ','.join([tag['name']
@@ -145,10 +177,15 @@ def convert_ckan_dataset_to_ec_dataset(ckan_dict):
 def convert_ec_dataset_to_ckan_dataset(ec_dict):
 
     ckan_dict = {}
+    extras = []
 
-    for ckan_name, ec_name in ckan_to_ec_dataset_mapping.iteritems():
-        if ec_name != 'Tags' and ec_name in ec_dict:
-            ckan_dict[ckan_name] = ec_dict.get(ec_name)
+    for key, value in ec_dict.iteritems():
+        ckan_name = dataset_mapping.ec_to_ckan.get(key)
+        if ckan_name is None:
+            # Arbitrary stuff stored as extras
+            extras.append({'key': key, 'value': value})
+        elif ckan_name != 'tags':
+            ckan_dict[ckan_name] = value
 
     if ec_dict.get('Tags'):
         ckan_dict['tags'] = [{'name': tag}
@@ -158,23 +195,26 @@ def convert_ec_dataset_to_ckan_dataset(ec_dict):
     if ckan_dict.get('id'):
         ckan_dict['id'] = unicode(ckan_dict['id'])
 
-    # Arbitrary stuff stored as extras
-    ec_keys = [v for k, v in ckan_to_ec_dataset_mapping.iteritems()]
-    ckan_dict['extras'] = []
-    for key, value in ec_dict.iteritems():
-        if key not in ec_keys:
-            ckan_dict['extras'].append({'key': key, 'value': value})
+    ckan_dict['extras'] = extras
 
     return ckan_dict
 
 
+def convert_ec_datasets_to_ckan_datasets(ec_dicts):
+    '''
+    Converts a list of EC datasets, see `convert_ec_dataset_to_ckan_dataset`
+    '''
+    return [convert_ec_dataset_to_ckan_dataset(ec_dict)
+            for ec_dict in ec_dicts]
+
+
 def convert_ckan_resource_to_ec_file(ckan_dict):
 
     ec_dict = {}
 
-    for ckan_name, ec_name in ckan_to_ec_resource_mapping.iteritems():
+    for ckan_name, ec_name in resource_mapping.fields:
         if ckan_dict.get(ckan_name):
-            ec_dict[ec_name] = ckan_dict.get(ckan_name)
+            ec_dict[ec_name] = ckan_dict[ckan_name]
 
     if not ec_dict.get('DatasetId') and ckan_dict.get('package_id'):
         ec_dict['DatasetId'] = ckan_dict.get('package_id')
@@ -193,11 +233,11 @@ def convert_ec_file_to_ckan_resource(ec_dict):
 
     ckan_dict = {}
 
-    for ckan_name, ec_name in ckan_to_ec_resource_mapping.iteritems():
+    for ckan_name, ec_name in resource_mapping.fields:
         if ec_dict.get(ec_name):
-            ckan_dict[ckan_name] = ec_dict.get(ec_name)
+            ckan_dict[ckan_name] = ec_dict[ec_name]
 
-    ec_keys = [v for k, v in ckan_to_ec_resource_mapping.iteritems()]
+    ec_keys = resource_mapping.ec_keys
     for key, value in ec_dict.iteritems():
         if key not in ec_keys:
             ckan_dict[key] = value
@@ -205,29 +245,37 @@ def convert_ec_file_to_ckan_resource(ec_dict):
     return ckan_dict
 
 
+def convert_ec_files_to_ckan_resources(ec_dicts):
+    '''
+    Converts a list of EC files, see `convert_ec_file_to_ckan_resource`
+    '''
+    return [convert_ec_file_to_ckan_resource(ec_dict)
+            for ec_dict in ec_dicts]
+
+
+ckan_to_ec_role_mapping = {
+    'admin': 'OrganisationAdmin',
+    'editor': 'OrganisationEditor',
+    'member': 'Member',
+}
+
+ec_to_ckan_role_mapping = dict(
+    (v, k) for k, v in ckan_to_ec_role_mapping.iteritems())
+
+
 def convert_ckan_member_to_ec_member(ckan_dict):
-    role_dict = {
-        'admin': 'OrganisationAdmin',
-        'editor': 'OrganisationEditor',
-        'member': 'Member',
-    }
 
     return {
         'NewOrganisationId': ckan_dict['id'],
-        'UserRoles': [ role_dict.get(ckan_dict['role']) ],
+        'UserRoles': [ ckan_to_ec_role_mapping.get(ckan_dict['role']) ],
     }
 
 def convert_ec_member_to_ckan_member(ec_dict):
-    role_dict = {
-        'OrganisationAdmin': 'admin',
-        'OrganisationEditor': 'editor',
-        'Member': 'member',
-    }
 
     try:
         return {
             'id': ec_dict['OrganisationId'],
-            'role':  role_dict[ec_dict['Roles'][0]],
+            'role':  ec_to_ckan_role_mapping[ec_dict['Roles'][0]],
             'username': ec_dict['UserName'],
         }
 
@@ -238,9 +286,9 @@ def convert_ec_member_to_ckan_member(ec_dict):
 def convert_ec_user_to_ckan_user(ec_dict):
     ckan_dict = {}
 
-    for ckan_name, ec_name in ckan_to_ec_user_mapping.iteritems():
+    for ckan_name, ec_name in user_mapping.fields:
         if ec_dict.get(ec_name):
-            ckan_dict[ckan_name] = ec_dict.get(ec_name)
+            ckan_dict[ckan_name] = ec_dict[ec_name]
 
     return ckan_dict
 
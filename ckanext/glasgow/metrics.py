@@ -0,0 +1,292 @@
+'''
+Metrics for the requests sent to the EC platform APIs
+
+Every request sent with `ckanext.glasgow.client` is recorded under the
+operation it belongs to (the names used by `_get_api_endpoint`, eg
+`dataset_request_create` or `changelog_show`), keeping:
+
+* the number of requests
+* a histogram of the latency, including any retries
+* the number of responses for each status code (or `error` if no response
+  was received and `circuit_open` if the request was not sent)
+* the bytes sent and received
+* the number of retries
+
+Metrics are kept in memory per process, so each web server worker or
+harvest process reports its own. They are available through the
+`ec_api_metrics_show` action, and in the Prometheus text format on the
+`/ec_api_metrics` endpoint (both for sysadmins only, the scraper can send a
+sysadmin API key in the `Authorization` header).
+
+Optionally, metrics can be sent to a statsd server as well:
+
+    # Host and port of the statsd server (disabled if no host is set)
+    ckanext.glasgow.metrics.statsd_host = localhost
+    ckanext.glasgow.metrics.statsd_port = 8125
+
+    # Prefix for the statsd metric names
+    ckanext.glasgow.metrics.statsd_prefix = ckanext.glasgow.ec_api
+
+'''
+import logging
+import re
+import socket
+import threading
+import urlparse
+
+from pylons import config
+
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+UNKNOWN_OPERATION = 'unknown'
+
+_metrics = {}
+_lock = threading.Lock()
+_matchers = None
+
+
+def _get_matchers():
+    global _matchers
+    if _matchers is None:
+        # Imported here as the actions depend on the client, which records
+        # the metrics
+        from ckanext.glasgow.logic.action import _api_operations
+
+        operations = [(operation, method, path)
+                      for operation, (method, path, api)
+                      in _api_operations.iteritems()]
+        # `changelog_show` appends the starting audit id to the endpoint
+        method, path, api = _api_operations['changelog_show']
+        operations.append(('changelog_show', method, path + '/{audit_id}'))
+
+        matchers = []
+        for operation, method, path in operations:
+            # Placeholders like `{dataset_id}` match any path segment
+            pattern = '[^/]+'.join(
+                re.escape(part) for part in re.split(r'\{\w+\}', path))
+            matchers.append(
+                (method, re.compile(pattern + '/?$'), operation))
+        _matchers = matchers
+
+    return _matchers
+
+
+def get_operation(method, url):
+    '''
+    Returns the name of the EC API operation for a request
+
+    :param method: the HTTP method
+    :type method: string
+    :param url: the request URL (with or without query string)
+    :type url: string
+
+    :returns: the operation name as used in `_get_api_endpoint`, or
+              `unknown` if the request does not match any
+    :rtype: string
+    '''
+
+    path = urlparse.urlsplit(url).path
+    method = method.upper()
+
+    for operation_method, regex, operation in _get_matchers():
+        if operation_method == method and regex.search(path):
+            return operation
+
+    return UNKNOWN_OPERATION
+
+
+def _new_operation_metrics():
+    return {
+        'count': 0,
+        'retries': 0,
+        'bytes_sent': 0,
+        'bytes_received': 0,
+        'latency_sum': 0.0,
+        'latency_buckets': [0] * len(LATENCY_BUCKETS),
+        'status_codes': {},
+    }
+
+
+def record(operation, latency, status, bytes_sent=0, bytes_received=0,
+           retries=0):
+    '''
+    Records a request to the EC API
+
+    :param operation: the operation name, see `get_operation`
+    :type operation: string
+    :param latency: time taken in seconds
+    :type latency: float
+    :param status: the response status code, or a string if there was no
+                   response (eg `error`)
+    :param bytes_sent: size of the request body
+    :type bytes_sent: int
+    :param bytes_received: size of the response body
+    :type bytes_received: int
+    :param retries: number of times the request was retried
+    :type retries: int
+    '''
+
+    status = str(status)
+
+    with _lock:
+        metrics = _metrics.get(operation)
+        if metrics is None:
+            metrics = _metrics[operation] = _new_operation_metrics()
+
+        metrics['count'] += 1
+        metrics['retries'] += retries
+        metrics['bytes_sent'] += bytes_sent
+        metrics['bytes_received'] += bytes_received
+        metrics['latency_sum'] += latency
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                metrics['latency_buckets'][i] += 1
+                break
+        metrics['status_codes'][status] = (
+            metrics['status_codes'].get(status, 0) + 1)
+
+    _send_to_statsd(operation, latency, status, retries)
+
+
+def get_metrics():
+    '''
+    Returns a copy of the metrics recorded so far
+
+    :returns: a dict with the operation names as keys. The values are dicts
+              with the `count`, `retries`, `bytes_sent`, `bytes_received`,
+              `latency_sum`, `latency_buckets` (cumulative counts, keyed by
+              the upper bound of each bucket as a string, including `+Inf`)
+              and `status_codes`.
+    :rtype: dict
+    '''
+
+    result = {}
+    with _lock:
+        for operation, metrics in _metrics.iteritems():
+            operation_metrics = dict(metrics)
+            operation_metrics['status_codes'] = dict(metrics['status_codes'])
+
+            buckets = {}
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS,
+                                    metrics['latency_buckets']):
+                cumulative += count
+                buckets[_format_bound(bound)] = cumulative
+            buckets['+Inf'] = metrics['count']
+            operation_metrics['latency_buckets'] = buckets
+
+            result[operation] = operation_metrics
+
+    return result
+
+
+def reset():
+    '''
+    Removes all metrics recorded so far
+    '''
+    with _lock:
+        _metrics.clear()
+
+
+def _format_bound(bound):
+    return repr(float(bound))
+
+
+def to_prometheus(metrics=None):
+    '''
+    Returns the metrics in the Prometheus text exposition format
+
+    :param metrics: metrics as returned by `get_metrics` (defaults to the
+                    current ones)
+    :type metrics: dict
+
+    :rtype: string
+    '''
+
+    if metrics is None:
+        metrics = get_metrics()
+
+    operations = sorted(metrics.keys())
+    lines = []
+
+    def add(name, metric_type, help_text, samples):
+        lines.append('# HELP {0} {1}'.format(name, help_text))
+        lines.append('# TYPE {0} {1}'.format(name, metric_type))
+        for labels, value in samples:
+            label_text = ','.join('{0}="{1}"'.format(key, label_value)
+                                  for key, label_value in labels)
+            lines.append('{0}{{{1}}} {2}'.format(name, label_text, value))
+
+    add('ckanext_glasgow_ec_api_requests_total', 'counter',
+        'Requests sent to the EC API',
+        [([('operation', op), ('status', status)], count)
+         for op in operations
+         for status, count in sorted(
+             metrics[op]['status_codes'].iteritems())])
+
+    add('ckanext_glasgow_ec_api_retries_total', 'counter',
+        'Retries of requests sent to the EC API',
+        [([('operation', op)], metrics[op]['retries'])
+         for op in operations])
+
+    add('ckanext_glasgow_ec_api_sent_bytes_total', 'counter',
+        'Bytes sent to the EC API',
+        [([('operation', op)], metrics[op]['bytes_sent'])
+         for op in operations])
+
+    add('ckanext_glasgow_ec_api_received_bytes_total', 'counter',
+        'Bytes received from the EC API',
+        [([('operation', op)], metrics[op]['bytes_received'])
+         for op in operations])
+
+    name = 'ckanext_glasgow_ec_api_request_duration_seconds'
+    lines.append('# HELP {0} Latency of the requests sent to the EC '
+                 'API'.format(name))
+    lines.append('# TYPE {0} histogram'.format(name))
+    bounds = [_format_bound(bound) for bound in LATENCY_BUCKETS] + ['+Inf']
+    for op in operations:
+        for bound in bounds:
+            lines.append('{0}_bucket{{operation="{1}",le="{2}"}} {3}'.format(
+                name, op, bound, metrics[op]['latency_buckets'][bound]))
+        lines.append('{0}_sum{{operation="{1}"}} {2!r}'.format(
+            name, op, metrics[op]['latency_sum']))
+        lines.append('{0}_count{{operation="{1}"}} {2}'.format(
+            name, op, metrics[op]['count']))
+
+    return '\n'.join(lines) + '\n'
+
+
+_statsd_socket = None
+
+
+def _send_to_statsd(operation, latency, status, retries):
+    global _statsd_socket
+
+    host = config.get('ckanext.glasgow.metrics.statsd_host')
+    if not host:
+        return
+
+    port = int(config.get('ckanext.glasgow.metrics.statsd_port', 8125))
+    prefix = config.get('ckanext.glasgow.metrics.statsd_prefix',
+                        'ckanext.glasgow.ec_api')
+
+    name = '{0}.{1}'.format(prefix, operation)
+    packets = [
+        '{0}.requests:1|c'.format(name),
+        '{0}.status.{1}:1|c'.format(name, status),
+        '{0}.latency:{1}|ms'.format(name, int(latency * 1000)),
+    ]
+    if retries:
+        packets.append('{0}.retries:{1}|c'.format(name, retries))
+
+    try:
+        if _statsd_socket is None:
+            _statsd_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        _statsd_socket.sendto('\n'.join(packets), (host, port))
+    except (socket.error, socket.gaierror), e:
+        # Metrics should never break the requests
+        log.debug('Could not send metrics to statsd: {0}'.format(e))
@@ -21,6 +21,46 @@ harvest_last_audit_table = sqlalchemy.Table(
     )
 
 
+harvest_initial_checkpoint_table = sqlalchemy.Table(
+    'harvest_initial_checkpoint', ckan.model.meta.metadata,
+    sqlalchemy.Column('id',
+                      sqlalchemy.types.UnicodeText,
+                      primary_key=True,
+                      default=ckan.model.types.make_uuid),
+    sqlalchemy.Column('harvest_source_id',
+                      sqlalchemy.types.UnicodeText,
+                      index=True),
+    sqlalchemy.Column('organization_id',
+                      sqlalchemy.types.UnicodeText),
+    sqlalchemy.Column('skip',
+                      sqlalchemy.types.Integer,
+                      default=0),
+    sqlalchemy.Column('finished',
+                      sqlalchemy.types.Boolean,
+                      default=False),
+    sqlalchemy.Column('harvest_job_id',
+                      sqlalchemy.types.UnicodeText),
+    sqlalchemy.Column('modified',
+                      sqlalchemy.types.DateTime,
+                      default=datetime.datetime.utcnow,
+                      onupdate=datetime.datetime.utcnow),
+    )
+
+
+ec_request_task_table = sqlalchemy.Table(
+    'ec_request_task', ckan.model.meta.metadata,
+    sqlalchemy.Column('request_id',
+                      sqlalchemy.types.UnicodeText,
+                      primary_key=True),
+    sqlalchemy.Column('task_id',
+                      sqlalchemy.types.UnicodeText,
+                      index=True),
+    sqlalchemy.Column('created',
+                      sqlalchemy.types.DateTime,
+                      default=datetime.datetime.utcnow),
+    )
+
+
 class HarvestLastAudit(ckan.model.DomainObject):
     def __init__(self, audit_id, harvest_job_id, created=None):
         self.audit_id = audit_id
@@ -28,10 +68,48 @@ class HarvestLastAudit(ckan.model.DomainObject):
         self.created = created
 
 
+class HarvestInitialCheckpoint(ckan.model.DomainObject):
+    '''Progress of the initial harvest gather stage for an organization
+
+    `skip` is the offset of the next page of datasets to request to the EC
+    API and `finished` is set once all datasets have been gathered.
+    '''
+    def __init__(self, harvest_source_id, organization_id, skip=0,
+                 finished=False, harvest_job_id=None):
+        self.harvest_source_id = harvest_source_id
+        self.organization_id = organization_id
+        self.skip = skip
+        self.finished = finished
+        self.harvest_job_id = harvest_job_id
+
+
+class EcRequestTask(ckan.model.DomainObject):
+    '''Maps the RequestId returned by the EC API to the CKAN task status
+
+    This allows looking up the task for a changelog audit without searching
+    the JSON values of the whole `task_status` table.
+    '''
+    def __init__(self, request_id, task_id):
+        self.request_id = request_id
+        self.task_id = task_id
+
+
 ckan.model.meta.mapper(HarvestLastAudit,
                        harvest_last_audit_table)
 
+ckan.model.meta.mapper(HarvestInitialCheckpoint,
+                       harvest_initial_checkpoint_table)
+
+ckan.model.meta.mapper(EcRequestTask,
+                       ec_request_task_table)
+
 
 def setup():
     if not harvest_last_audit_table.exists():
         harvest_last_audit_table.create()
+
+    if not harvest_initial_checkpoint_table.exists():
+        harvest_initial_checkpoint_table.create()
+
+    if not ec_request_task_table.exists():
+        ec_request_task_table.create()
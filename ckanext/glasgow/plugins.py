@@ -63,6 +63,10 @@ class GlasgowSchemaPlugin(p.SingletonPlugin, p.toolkit.DefaultDatasetForm):
         map.connect('/request/{request_id}', controller=status_ctl,
                     action='get_status')
 
+        map.connect('ec_api_metrics', '/ec_api_metrics',
+                    controller='ckanext.glasgow.controllers.metrics:MetricsController',
+                    action='show')
+
 
         org_controller = 'ckanext.glasgow.controllers.organization:OrgController'
         map.connect('/organization/new',
@@ -148,6 +152,7 @@ class GlasgowSchemaPlugin(p.SingletonPlugin, p.toolkit.DefaultDatasetForm):
             'approvals_list',
             'approval_act',
             'approval_download',
+            'ec_api_metrics_show',
         )
         return _get_module_functions(custom_actions, function_names)
 
@@ -173,6 +178,7 @@ class GlasgowSchemaPlugin(p.SingletonPlugin, p.toolkit.DefaultDatasetForm):
             'approvals_list',
             'approval_act',
             'approval_download',
+            'ec_api_metrics_show',
         )
         return _get_module_functions(custom_auth, function_names)
 
@@ -190,6 +196,7 @@ class GlasgowSchemaPlugin(p.SingletonPlugin, p.toolkit.DefaultDatasetForm):
             'parse_metadata_string',
             'get_resource_ec_extra_fields',
             'get_ec_api_metadata_link',
+            'is_ec_api_available',
         )
         return _get_module_functions(custom_helpers, function_names)
 
@@ -0,0 +1,321 @@
+'''
+Helpers to process EC API responses as they are received
+
+Instead of loading the whole response body in memory (and in the case of
+JSON responses, the whole decoded object as well), these read it in chunks
+so memory use does not depend on the size of the response.
+
+Uploads sent to the EC API are streamed in the same way, see
+`MultipartEncoder`.
+'''
+import codecs
+import json
+import os
+import re
+import uuid
+
+
+CHUNK_SIZE = 64 * 1024
+
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+class JSONListStream(object):
+    '''
+    Incremental parser for JSON objects with a (potentially long) list
+
+    The EC API returns list results wrapped in an object, eg::
+
+        {"IsErrorResponse": false, "MetadataResultSet": [{...}, {...}]}
+
+    Iterating over an instance yields the items of the list stored under
+    `key` one by one, as soon as they have been received. Only the item
+    being parsed is kept in memory. Once the iteration has finished, the
+    rest of members of the object are available in `fields`.
+
+    :param chunks: iterable with the response body in chunks (eg
+                   `response.iter_content(CHUNK_SIZE)`)
+    :param key: the member of the object with the list of items
+    :type key: string
+
+    :raises: ValueError if the response is not valid JSON or is not an
+             object
+    '''
+
+    def __init__(self, chunks, key):
+        self.key = key
+        self.fields = {}
+
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._decoder = json.JSONDecoder()
+        self._buffer = u''
+        self._pos = 0
+        self._finished = False
+
+    def _read(self):
+        if self._finished:
+            raise ValueError('Unexpected end of JSON response')
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self._finished = True
+            chunk = ''
+
+        # Discard what has been parsed already
+        self._buffer = self._buffer[self._pos:] + self._utf8.decode(
+            chunk, self._finished)
+        self._pos = 0
+
+    def _peek(self):
+        while True:
+            self._pos = _whitespace.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            self._read()
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char not in chars:
+            raise ValueError('Expected one of "{0}" in JSON response, got '
+                             '"{1}"'.format(chars, char))
+        self._pos += 1
+        return char
+
+    def _decode(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                # Numbers (or literals) at the end of the buffer may be
+                # incomplete
+                if end < len(self._buffer) or self._finished:
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._finished:
+                    raise
+            self._read()
+
+    def __iter__(self):
+        self._expect('{')
+        if self._peek() == '}':
+            return
+
+        while True:
+            name = self._decode()
+            self._expect(':')
+            if name == self.key and self._peek() == '[':
+                self._pos += 1
+                if self._peek() == ']':
+                    self._pos += 1
+                else:
+                    while True:
+                        yield self._decode()
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                self.fields[name] = self._decode()
+
+            if self._expect(',}') == '}':
+                break
+
+
+def iter_raw_content(response, chunk_size=CHUNK_SIZE):
+    '''
+    Yields the body of a response requested with `stream=True` in chunks
+
+    The body is returned as sent by the server (ie it is not decompressed),
+    so it matches the original `Content-Encoding` and `Content-Length`
+    headers. The connection is released once the body has been read (or
+    the iterator is closed).
+
+    :param response: the response object
+    :type response: requests.Response
+    :param chunk_size: size of the chunks in bytes
+    :type chunk_size: int
+
+    :returns: an iterator over the body chunks
+    :rtype: iterator
+    '''
+    try:
+        for chunk in response.raw.stream(chunk_size, decode_content=False):
+            yield chunk
+    finally:
+        response.close()
+
+
+class MultipartEncoder(object):
+    '''
+    File-like object with a `multipart/form-data` body
+
+    Unlike the `files` parameter of `requests`, which builds the whole body
+    in memory before sending it, uploaded files are read in chunks as the
+    request is sent. Pass the instance as the `data` of the request, along
+    with a `Content-Type` header set to `content_type`::
+
+        body = MultipartEncoder([
+            ('metadata', json.dumps(metadata)),
+            ('file', (upload.filename, upload.file)),
+        ])
+        client.request('POST', url, data=body,
+                       headers={'Content-Type': body.content_type})
+
+    Files are read from their current position, which is restored by
+    `rewind` so the same body can be sent again (eg to retry a failed
+    request).
+
+    :param fields: list of tuples with the name and value of each field.
+                   Values are either strings or tuples with the file name,
+                   the file object and optionally its content type.
+    :type fields: list
+    :param boundary: the boundary between parts (a random one is generated
+                     if not provided)
+    :type boundary: string
+    :param callback: function called with the number of bytes read so far
+                     and the total length each time a chunk is read
+    :param chunk_size: size of the chunks when iterating, in bytes
+    :type chunk_size: int
+    '''
+
+    def __init__(self, fields, boundary=None, callback=None,
+                 chunk_size=CHUNK_SIZE):
+        self.boundary = boundary or uuid.uuid4().hex
+        self.callback = callback
+        self.chunk_size = chunk_size
+
+        self._fields = fields
+        self._parts = []
+        self._files = []
+        self.len = 0
+
+        for name, value in fields:
+            if isinstance(value, (tuple, list)):
+                filename, fileobj = value[0], value[1]
+                content_type = (value[2] if len(value) > 2
+                                else 'application/octet-stream')
+                header = (u'--{0}\r\nContent-Disposition: form-data; '
+                          u'name="{1}"; filename="{2}"\r\n'
+                          u'Content-Type: {3}\r\n\r\n').format(
+                    self.boundary, _quote(name), _quote(filename),
+                    _decode(content_type))
+                self._add(_encode(header))
+
+                start = fileobj.tell()
+                fileobj.seek(0, os.SEEK_END)
+                size = fileobj.tell() - start
+                fileobj.seek(start)
+
+                self._files.append((fileobj, start))
+                self._parts.append(fileobj)
+                self.len += size
+                self._add('\r\n')
+            else:
+                header = (u'--{0}\r\nContent-Disposition: form-data; '
+                          u'name="{1}"\r\n\r\n').format(
+                    self.boundary, _quote(name))
+                self._add(_encode(header) + _encode(value) + '\r\n')
+
+        self._add('--{0}--\r\n'.format(self.boundary))
+
+        self.bytes_read = 0
+        self._current = 0
+        self._offset = 0
+
+    def _add(self, data):
+        self._parts.append(data)
+        self.len += len(data)
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary={0}'.format(self.boundary)
+
+    def __len__(self):
+        return self.len
+
+    def read(self, size=-1):
+        '''
+        Returns up to `size` bytes of the body (all the rest if `size` is
+        negative), or an empty string once it has all been read
+        '''
+        chunks = []
+        remaining = size
+        while self._current < len(self._parts) and remaining != 0:
+            part = self._parts[self._current]
+            if isinstance(part, str):
+                end = (len(part) if remaining < 0
+                       else min(len(part), self._offset + remaining))
+                chunk = part[self._offset:end]
+                self._offset = end
+                done = end == len(part)
+            else:
+                chunk = part.read(remaining if remaining > 0 else -1)
+                done = not chunk or remaining < 0
+            if chunk:
+                chunks.append(chunk)
+                if remaining > 0:
+                    remaining -= len(chunk)
+            if done:
+                self._current += 1
+                self._offset = 0
+
+        data = ''.join(chunks)
+        if data:
+            self.bytes_read += len(data)
+            if self.callback:
+                self.callback(self.bytes_read, self.len)
+        return data
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def rewind(self):
+        '''
+        Goes back to the start of the body, so it can be read again
+        '''
+        for fileobj, start in self._files:
+            fileobj.seek(start)
+        self.bytes_read = 0
+        self._current = 0
+        self._offset = 0
+
+    def summary(self):
+        '''
+        Returns the fields of the body without the file contents
+
+        Useful to log or store details of a request, as the body itself
+        can not be serialized.
+
+        :returns: a dict with the values of the fields, and the file name
+                  for file fields
+        :rtype: dict
+        '''
+        summary = {}
+        for name, value in self._fields:
+            if isinstance(value, (tuple, list)):
+                summary[name] = {'filename': value[0]}
+            else:
+                summary[name] = value
+        return summary
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _decode(value):
+    # Byte strings (eg file names from the upload) are assumed to be UTF-8,
+    # so they can be formatted into the unicode part headers
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def _quote(value):
+    return _decode(value).replace('\\', '\\\\').replace('"', '\\"')
@@ -0,0 +1,414 @@
+'''
+Harvest benchmarks using the mock EC API
+
+`Catalogue` generates a synthetic EC catalogue of a given size, which the
+mock EC API (`mock_ec.py`) serves instead of its fixed responses.
+`run_benchmark` then times every stage of an initial harvest followed by a
+changelog harvest against it, and returns the results as a dict that can
+be stored as JSON and compared between versions.
+
+The harvests write to the configured CKAN database, so only run them
+against a test database. They are usually run with the `glasgow_benchmark`
+paster command.
+'''
+import datetime
+import platform
+import random
+import socket
+import time
+import uuid
+from threading import Thread
+
+import pkg_resources
+from pylons import config
+
+from ckan import model
+
+from ckanext.glasgow import client, metrics
+from ckanext.glasgow.tests import mock_ec
+
+
+class Catalogue(object):
+    '''
+    Synthetic EC catalogue
+
+    All ids and contents are generated from `seed`, so catalogues created
+    with the same parameters are identical.
+
+    :param organizations: number of organizations
+    :param datasets: number of datasets per organization
+    :param files: number of files per dataset
+    :param versions: number of versions per file
+    :param audits: number of changelog audits. They are updates of the
+                   objects in the catalogue (organizations, datasets and
+                   files), so they can be imported after the initial
+                   harvest.
+    :param page_size: maximum number of records returned by the list
+                      endpoints
+    :param seed: seed for the random generator
+    '''
+
+    def __init__(self, organizations=5, datasets=20, files=3, versions=2,
+                 audits=100, page_size=1000, seed=0):
+        self.parameters = {
+            'organizations': organizations,
+            'datasets': datasets,
+            'files': files,
+            'versions': versions,
+            'audits': audits,
+            'page_size': page_size,
+            'seed': seed,
+        }
+        self.page_size = page_size
+
+        self._random = random.Random(seed)
+
+        self.organizations = []
+        self.datasets = {}
+        self.files = {}
+        self.file_versions = {}
+        self.audits = []
+
+        dataset_id = 0
+        for org_index in range(1, organizations + 1):
+            org_id = str(org_index)
+            self.organizations.append(self._organization(org_index))
+            self.datasets[org_id] = []
+
+            for i in range(datasets):
+                dataset_id += 1
+                dataset = self._dataset(dataset_id, org_index)
+                self.datasets[org_id].append(dataset)
+                self.files[(org_id, str(dataset_id))] = []
+
+                for j in range(files):
+                    file_id = self._uuid()
+                    file_versions = [
+                        self._file_version(file_id, dataset_id, org_index, k)
+                        for k in range(versions)]
+                    self.file_versions[(org_id, str(dataset_id), file_id)] = \
+                        file_versions
+                    self.files[(org_id, str(dataset_id))].append(
+                        file_versions[-1])
+
+        for audit_id in range(1, audits + 1):
+            self.audits.append(self._audit(audit_id))
+
+    def _uuid(self):
+        return str(uuid.UUID(int=self._random.getrandbits(128)))
+
+    def _words(self, count):
+        words = ('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur',
+                 'adipiscing', 'elit', 'sed', 'eiusmod', 'tempor', 'magna')
+        return ' '.join(self._random.choice(words) for i in range(count))
+
+    def _organization(self, org_index):
+        return {
+            'Id': org_index,
+            'Title': 'Benchmark Organisation {0}'.format(org_index),
+            'Name': 'Benchmark Organisation {0}'.format(org_index),
+            'CreatedTime': '2014-05-21T06:06:18.353',
+            'ModifiedTime': '2014-05-21T06:06:18.353',
+        }
+
+    def _dataset(self, dataset_id, org_index):
+        title = 'Benchmark Dataset {0}'.format(dataset_id)
+        return {
+            'Id': dataset_id,
+            'OrganisationId': org_index,
+            'Title': title,
+            'CreatedTime': '2014-06-09T14:08:08.78',
+            'ModifiedTime': '2014-06-09T14:08:08.78',
+            'Metadata': {
+                'Title': title,
+                'Description': self._words(40),
+                'Category': self._words(1),
+                'Theme': self._words(1),
+                'License': 'OGL-UK-2.0',
+                'MaintainerName': 'Benchmark Maintainer',
+                'MaintainerContact': 'maintainer@example.com',
+                'OpennessRating': str(self._random.randint(0, 5)),
+                'Quality': str(self._random.randint(0, 5)),
+                'PublishedOnBehalfOf': 'Benchmark Publisher',
+                'StandardName': self._words(3),
+                'StandardRating': str(self._random.randint(0, 5)),
+                'StandardVersion': '1.0.0',
+                'Tags': ','.join(sorted(set(self._words(4).split()))),
+                'UsageGuidance': self._words(20),
+            },
+        }
+
+    def _file_version(self, file_id, dataset_id, org_index, version_index):
+        version_id = self._uuid()
+        title = 'Benchmark File {0}'.format(file_id[:8])
+        return {
+            'FileId': file_id,
+            'DataSetId': dataset_id,
+            'OrganisationId': org_index,
+            'Version': version_id,
+            'Title': title,
+            'Status': 0,
+            'CreatedTime': '2014-06-13T09:23:27.763',
+            'ModifiedTime': '2014-06-13T09:23:27.763',
+            'FileMetadata': {
+                'Title': title,
+                'Description': self._words(20),
+                'DataSetId': str(dataset_id),
+                'FileName': 'file-{0}.csv'.format(version_index),
+                'FileExternalUrl': 'http://ec.example.com/Download/'
+                                   'Organisation/{0}/Dataset/{1}/File/{2}/'
+                                   'Version/{3}'.format(
+                                       org_index, dataset_id, file_id,
+                                       version_id),
+                'Type': 'text/csv',
+                'License': 'OGL-UK-2.0',
+                'OpennessRating': str(self._random.randint(0, 5)),
+                'Quality': str(self._random.randint(0, 5)),
+                'StandardName': self._words(3),
+                'StandardRating': str(self._random.randint(0, 5)),
+                'StandardVersion': '1.0.0',
+                'CreationDate': '2014-06-13T09:23:27',
+            },
+        }
+
+    def _audit(self, audit_id):
+        kind = self._random.choice(
+            ('UpdateDataSet', 'UpdateFile', 'CreateFile', 'UpdateDataSet',
+             'UpdateFile', 'UpdateOrganisation'))
+
+        org = self._random.choice(self.organizations)
+        org_id = str(org['Id'])
+        properties = {'OrganisationId': org_id}
+        object_type = 'Organisation'
+
+        if kind != 'UpdateOrganisation' and self.datasets[org_id]:
+            dataset = self._random.choice(self.datasets[org_id])
+            dataset_id = str(dataset['Id'])
+            properties['DataSetId'] = dataset_id
+            object_type = 'Dataset'
+
+            if kind != 'UpdateDataSet' and self.files[(org_id, dataset_id)]:
+                file_dict = self._random.choice(
+                    self.files[(org_id, dataset_id)])
+                properties['FileId'] = file_dict['FileId']
+                properties['VersionId'] = self._random.choice(
+                    self.file_versions[(org_id, dataset_id,
+                                        file_dict['FileId'])])['Version']
+                object_type = 'File'
+            else:
+                kind = 'UpdateDataSet'
+        else:
+            kind = 'UpdateOrganisation'
+
+        return {
+            'AuditId': audit_id,
+            'AuditType': '{0}Updated'.format(object_type),
+            'Command': kind,
+            'Component': 'DataPublication',
+            'CustomProperties': properties,
+            'Message': '{0} operation completed'.format(kind),
+            'ObjectType': object_type,
+            'OperationState': 'Succeeded',
+            'Owner': 'Benchmark',
+            'RequestId': self._uuid(),
+            'Timestamp': '2014-05-21T00:00:10',
+        }
+
+    # Lookups used by the mock EC API
+
+    def get_organization(self, org_id):
+        for org in self.organizations:
+            if str(org['Id']) == org_id:
+                return org
+
+    def get_dataset(self, org_id, dataset_id):
+        for dataset in self.datasets.get(org_id, []):
+            if str(dataset['Id']) == dataset_id:
+                return dataset
+
+    def get_file_version(self, org_id, dataset_id, file_id, version_id):
+        for version in self.file_versions.get(
+                (org_id, dataset_id, file_id), []):
+            if version['Version'] == version_id:
+                return version
+
+    def get_audits(self, audit_id=None, top=None, object_type=None):
+        # Audits start from the provided one, as on the EC API
+        start = 0
+        if audit_id and audit_id.isdigit():
+            start = min(max(int(audit_id) - 1, 0), len(self.audits))
+        audits = self.audits[start:]
+
+        if object_type:
+            audits = [a for a in audits if a['ObjectType'] == object_type]
+        if top:
+            audits = audits[:top]
+
+        return audits
+
+
+def start_mock_ec(catalogue, port=7072):
+    '''
+    Starts the mock EC API serving the provided catalogue on a thread, and
+    points the EC API configuration options to it
+    '''
+
+    mock_ec.catalogue = catalogue
+
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    result = s.connect_ex(('127.0.0.1', port))
+    s.close()
+    if result != 0:
+        thread = Thread(target=mock_ec.run,
+                        kwargs={'port': port, 'debug': False,
+                                'threaded': True})
+        thread.daemon = True
+        thread.start()
+
+        # Wait for the server to be ready
+        for i in range(50):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            result = s.connect_ex(('127.0.0.1', port))
+            s.close()
+            if result == 0:
+                break
+            time.sleep(0.1)
+
+    base_url = 'http://127.0.0.1:{0}'.format(port)
+    config['ckanext.glasgow.data_collection_api'] = base_url
+    config['ckanext.glasgow.metadata_api'] = base_url
+    config['ckanext.glasgow.identity_api'] = base_url
+
+
+def _create_harvest_job(harvester):
+    from ckanext.harvest.model import HarvestSource, HarvestJob
+
+    source = HarvestSource(
+        url='http://benchmark/{0}'.format(harvester.info()['name']),
+        type=harvester.info()['name'])
+    source.save()
+
+    job = HarvestJob(source=source)
+    job.save()
+
+    return job
+
+
+def _time_stage(name, function, items):
+    '''
+    Calls `function` for each of the items and returns the stage results
+    '''
+
+    metrics.reset()
+    start = time.time()
+
+    errors = 0
+    for item in items:
+        if not function(item):
+            errors += 1
+
+    seconds = time.time() - start
+    return {
+        'name': name,
+        'seconds': seconds,
+        'objects': len(items),
+        'errors': errors,
+        'objects_per_second': len(items) / seconds if seconds else None,
+        'ec_api': metrics.get_metrics(),
+    }
+
+
+def _time_gather(name, harvester, job):
+    metrics.reset()
+    start = time.time()
+
+    ids = harvester.gather_stage(job) or []
+
+    seconds = time.time() - start
+    result = {
+        'name': name,
+        'seconds': seconds,
+        'objects': len(ids),
+        'errors': 0 if ids else 1,
+        'objects_per_second': len(ids) / seconds if seconds else None,
+        'ec_api': metrics.get_metrics(),
+    }
+    return ids, result
+
+
+def run_benchmark(catalogue, port=7072):
+    '''
+    Runs an initial harvest and a changelog harvest against the catalogue
+
+    :param catalogue: the catalogue to serve from the mock EC API
+    :type catalogue: :py:class:`Catalogue`
+    :param port: port to run the mock EC API on
+    :type port: int
+
+    :returns: a dict with the parameters and environment of the run, and
+              a list of `stages`, each with its `name`, the `seconds` it
+              took, the number of harvest `objects` processed, how many
+              failed (`errors`) and the metrics of the EC API requests
+              sent during it (`ec_api`). If faults were set on the mock EC
+              API (see `mock_ec.set_fault`), `faults` has the number of
+              them injected on each route.
+    :rtype: dict
+    '''
+    from ckanext.harvest.model import HarvestObject
+    from ckanext.glasgow.harvesters.ec_harvester import EcInitialHarvester
+    from ckanext.glasgow.harvesters.changelog import EcChangelogHarvester
+
+    start_mock_ec(catalogue, port)
+    client.reset()
+
+    try:
+        version = pkg_resources.get_distribution('ckanext-glasgow').version
+    except pkg_resources.DistributionNotFound:
+        version = None
+
+    results = {
+        'version': version,
+        'started': datetime.datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'parameters': dict(catalogue.parameters),
+        'config': dict(
+            (key, value) for key, value in config.iteritems()
+            if key.startswith('ckanext.glasgow.harvest.') or
+            key.startswith('ckanext.glasgow.http.')),
+        'stages': [],
+    }
+    stages = results['stages']
+
+    def get_objects(ids):
+        return [HarvestObject.get(object_id) for object_id in ids]
+
+    # Initial harvest
+    harvester = EcInitialHarvester()
+    job = _create_harvest_job(harvester)
+
+    ids, result = _time_gather('initial_gather', harvester, job)
+    stages.append(result)
+
+    stages.append(_time_stage('initial_fetch', harvester.fetch_stage,
+                              get_objects(ids)))
+    stages.append(_time_stage('initial_import', harvester.import_stage,
+                              get_objects(ids)))
+
+    # Changelog harvest
+    harvester = EcChangelogHarvester()
+    job = _create_harvest_job(harvester)
+
+    ids, result = _time_gather('changelog_gather', harvester, job)
+    stages.append(result)
+
+    stages.append(_time_stage('changelog_import', harvester.import_stage,
+                              get_objects(ids)))
+
+    results['total_seconds'] = sum(stage['seconds'] for stage in stages)
+    results['faults'] = dict(
+        (route, dict(fault.injected))
+        for route, fault in mock_ec.faults.iteritems())
+
+    model.Session.remove()
+
+    return results
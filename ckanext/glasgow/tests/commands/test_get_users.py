@@ -292,7 +292,7 @@ class TestCreateUserAndOrgDoesNotCurrentlyExist(object):
     def teardown(self):
         helpers.reset_db()
 
-    @mock.patch('requests.get')
+    @mock.patch('ckanext.glasgow.client.get')
     def test_creates_user_no_email(self, mock_request):
         mock_request.return_value = mock.Mock(
             status_code=200,
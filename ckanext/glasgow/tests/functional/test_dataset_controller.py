@@ -6,6 +6,7 @@ from bs4 import BeautifulSoup
 
 import ckan.new_tests.helpers as helpers
 
+from ckanext.glasgow import client
 from ckanext.glasgow.tests import run_mock_ec
 from ckanext.glasgow.tests.functional import get_test_app
 
@@ -91,6 +92,43 @@ class TestDatasetController(object):
         assert request_dict['request_id'] in response.unicode_body
         assert request_dict['task_id'] in response.unicode_body
 
+    @mock.patch('ckanext.oauth2waad.plugin.service_to_service_access_token')
+    def test_pending_dataset_page_ec_unavailable(self, mock_token):
+        mock_token.return_value = 'Bearer: token'
+
+        data_dict = {
+            'name': 'test_dataset_pending',
+            'owner_org': 'test_org',
+            'title': 'Test Dataset Pending',
+            'notes': 'Some longer description',
+            'needs_approval': False,
+            'maintainer': 'Test maintainer',
+            'maintainer_email': 'Test maintainer email',
+            'license_id': 'OGL-UK-2.0',
+            'openness_rating': 3,
+            'quality': 5,
+        }
+
+        context = {'user': self.normal_user['name']}
+        helpers.call_action('dataset_request_create', context=context,
+                            **data_dict)
+
+        with mock.patch('ckanext.glasgow.client.request',
+                        side_effect=client.CircuitOpenError('Open')):
+            with mock.patch('ckanext.glasgow.client.is_available',
+                            return_value=False):
+                response = self.app.get(
+                    '/dataset/test_dataset_pending',
+                    extra_environ={'REMOTE_USER': 'sysadmin_user'})
+
+        # The pending page is still shown, without the EC API status
+        eq_(response.status_int, 200)
+        assert ('[Pending] {0}'.format(data_dict['title'])
+                in response.html.head.title.text)
+        assert 'State - Succeeded' not in response.body
+        assert 'can not be checked while the EC platform is unavailable' \
+            in response.body
+
     def test_normal_dataset_page(self):
 
         data_dict = {
@@ -185,7 +223,7 @@ class TestDatasetController(object):
 
 
     @mock.patch('ckanext.oauth2waad.plugin.service_to_service_access_token')
-    @mock.patch('requests.request')
+    @mock.patch('ckanext.glasgow.client.request')
     def test_pending_dataset_update(self, mock_request, mock_token):
         def request_result(*args, **kwargs):
             if 'ChangeLog' in args[1]:
@@ -219,7 +257,7 @@ class TestDatasetController(object):
 
 
         mock_token.return_value = 'Bearer: token'
-        # make the mock the result of calling requests.request(...)
+        # make the mock the result of calling client.request(...)
         mock_request.side_effect =  request_result
 
         context = {'local_action': True, 'user': 'normal_user'}
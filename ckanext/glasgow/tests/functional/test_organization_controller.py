@@ -29,7 +29,7 @@ class TestOrganizationController(object):
         helpers.reset_db()
 
     @mock.patch('ckanext.oauth2waad.plugin.service_to_service_access_token')
-    @mock.patch('requests.request')
+    @mock.patch('ckanext.glasgow.client.request')
     def test_pending_organization_page(self, mock_request, mock_token):
         def request_result(*args, **kwargs):
             if 'ChangeLog' in args[1]:
@@ -61,7 +61,7 @@ class TestOrganizationController(object):
                     }
                 )
         mock_token.return_value = 'Bearer: token'
-        # make the mock the result of calling requests.request(...)
+        # make the mock the result of calling client.request(...)
         mock_request.side_effect =  request_result
 
         request_dict = helpers.call_action(
@@ -78,7 +78,7 @@ class TestOrganizationController(object):
 
 
     @mock.patch('ckanext.oauth2waad.plugin.service_to_service_access_token')
-    @mock.patch('requests.request')
+    @mock.patch('ckanext.glasgow.client.request')
     def test_normal_organization_page(self, mock_request, mock_token):
         def request_result(*args, **kwargs):
             if 'ChangeLog' in args[1]:
@@ -110,7 +110,7 @@ class TestOrganizationController(object):
                     }
                 )
         mock_token.return_value = 'Bearer: token'
-        # make the mock the result of calling requests.request(...)
+        # make the mock the result of calling client.request(...)
         mock_request.side_effect =  request_result
 
         context = {'ignore_auth': True, 'local_action': True,
@@ -155,7 +155,7 @@ class TestOrganizationUpdateController(object):
         helpers.reset_db()
 
     @mock.patch('ckanext.oauth2waad.plugin.service_to_service_access_token')
-    @mock.patch('requests.request')
+    @mock.patch('ckanext.glasgow.client.request')
     def test_pending_organization_update(self, mock_request, mock_token):
         def request_result(*args, **kwargs):
             if 'ChangeLog' in args[1]:
@@ -189,7 +189,7 @@ class TestOrganizationUpdateController(object):
 
 
         mock_token.return_value = 'Bearer: token'
-        # make the mock the result of calling requests.request(...)
+        # make the mock the result of calling client.request(...)
         mock_request.side_effect =  request_result
 
         context = {'local_action': True, 'user': 'normal_user'}
@@ -215,7 +215,7 @@ class TestOrganizationUpdateController(object):
         nose.tools.assert_true('Message - Organization Update request started' in soup.table.text)
 
     @mock.patch('ckanext.oauth2waad.plugin.service_to_service_access_token')
-    @mock.patch('requests.request')
+    @mock.patch('ckanext.glasgow.client.request')
     def test_pending_organization_name_update(self, mock_request, mock_token):
         def request_result(*args, **kwargs):
             if 'ChangeLog' in args[1]:
@@ -249,7 +249,7 @@ class TestOrganizationUpdateController(object):
 
 
         mock_token.return_value = 'Bearer: token'
-        # make the mock the result of calling requests.request(...)
+        # make the mock the result of calling client.request(...)
         mock_request.side_effect =  request_result
 
         context = {'local_action': True, 'user': 'normal_user'}
@@ -276,7 +276,7 @@ class TestOrganizationUpdateController(object):
         nose.tools.assert_true('Message - Organization Update request started' in soup.table.text)
 
     @mock.patch('ckanext.oauth2waad.plugin.service_to_service_access_token')
-    @mock.patch('requests.request')
+    @mock.patch('ckanext.glasgow.client.request')
     def test_pending_organization_by_name_in_url(self, mock_request, mock_token):
         def request_result(*args, **kwargs):
             if 'ChangeLog' in args[1]:
@@ -310,7 +310,7 @@ class TestOrganizationUpdateController(object):
 
 
         mock_token.return_value = 'Bearer: token'
-        # make the mock the result of calling requests.request(...)
+        # make the mock the result of calling client.request(...)
         mock_request.side_effect =  request_result
 
         context = {'local_action': True, 'user': 'normal_user'}
@@ -365,7 +365,7 @@ class TestOrganizationMembership(object):
 
     @mock.patch('ckan.lib.helpers.flash_success')
     @mock.patch('ckanext.oauth2waad.plugin.service_to_service_access_token')
-    @mock.patch('requests.request')
+    @mock.patch('ckanext.glasgow.client.request')
     def test_membership_add(self, mock_request, mock_token, mock_flash):
         mock_token.return_value = 'Bearer: token'
         mock_request.return_value = mock.Mock(
@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 import json
 import mock
+import requests
 
 import nose.tools as nt
 
 from ckan.lib import search
 from ckan import model
+from ckan.plugins import toolkit
 
 import ckan.new_tests.helpers as helpers
 import ckan.new_tests.factories as factories
@@ -13,13 +15,29 @@ import ckan.new_tests.factories as factories
 import ckanext.harvest.model as harvest_model
 from ckanext.harvest.tests.factories import HarvestJobFactory
 
+import ckanext.glasgow.harvesters.ec_harvester as ec_harvester
+from ckanext.glasgow.harvesters import (
+    HarvestObjectWriter,
+    supersede_harvest_objects,
+)
 from ckanext.glasgow.harvesters.ec_harvester import (
     EcInitialHarvester, EcApiException)
 from ckanext.glasgow.harvesters.changelog import (
+    EcChangelogHarvester,
+    IMPORT_RESULT_EXTRA,
+    REMOTE_METADATA_EXTRA,
+    _get_audit_metadata,
+    batch_partitions,
+    changelog_pages,
+    compact_audits,
+    get_audit_object_key,
+    partition_audits,
     handle_user_create,
     handle_user_update,
 )
-from ckanext.glasgow.tests import run_mock_ec
+from ckanext.glasgow.model import HarvestInitialCheckpoint, HarvestLastAudit
+from ckanext.glasgow.tests import mock_ec, run_mock_ec
+from ckanext.glasgow.tests.benchmark import Catalogue, run_benchmark
 
 
 class TestDatasetCreate(object):
@@ -61,9 +79,9 @@ class TestDatasetCreate(object):
         assert org['id'] in ('1', '2', '3')  # Ids returned by the mock api
 
 
-    @mock.patch('requests.get')
+    @mock.patch('ckanext.glasgow.client.get')
     def test_create_orgs_bad_response(self, m):
-        # setup a mock for requests.get that returns an object
+        # setup a mock for client.get that returns an object
         # with a status_code of 500
         req = mock.MagicMock()
         req.status_code = 500
@@ -73,7 +91,7 @@ class TestDatasetCreate(object):
             EcApiException,
             harvester._create_orgs)
 
-    @mock.patch('requests.get')
+    @mock.patch('ckanext.glasgow.client.get')
     def test_create_orgs_non_json_response(self, m):
         req = mock.MagicMock()
         req.status_code = 200
@@ -84,7 +102,7 @@ class TestDatasetCreate(object):
             EcApiException,
             harvester._create_orgs)
 
-    @mock.patch('requests.get')
+    @mock.patch('ckanext.glasgow.client.get')
     def test_create_orgs_api_error(self, m):
         req = mock.MagicMock()
         req.status_code = 200
@@ -100,9 +118,9 @@ class TestDatasetCreate(object):
             EcApiException,
             harvester._create_orgs)
 
-    @mock.patch('requests.get')
+    @mock.patch('ckanext.glasgow.client.get')
     def test_create_orgs_no_metadataresultset(self, m):
-        # setup a mock for requests.get that returns an object
+        # setup a mock for client.get that returns an object
         # with a status_code of 500
         req = mock.MagicMock()
         req.status_code = 200
@@ -125,9 +143,128 @@ class TestDatasetCreate(object):
 
         nt.assert_equals(len(job.objects), 3)
 
-    @mock.patch('requests.get')
+    def test_gather_organization_error_keeps_other_organizations(self):
+        get_organization_datasets = ec_harvester.get_organization_datasets
+
+        def mock_get_organization_datasets(org_id, skip=0):
+            if org_id == '1':
+                return org_id, [], 'Connection refused'
+            return get_organization_datasets(org_id, skip)
+
+        harvester = EcInitialHarvester()
+        job = HarvestJobFactory()
+        with mock.patch(
+                'ckanext.glasgow.harvesters.ec_harvester.get_organization_datasets',
+                side_effect=mock_get_organization_datasets):
+            harvest_result = harvester.gather_stage(job)
+
+        nt.assert_true(harvest_result)
+        nt.assert_equals(len(job.objects), 3)
+
+        errors = model.Session.query(harvest_model.HarvestGatherError) \
+            .filter_by(harvest_job_id=job.id).all()
+        nt.assert_equals(len(errors), 1)
+        assert 'organization 1' in errors[0].message
+
+    def test_gather_resumes_from_checkpoint(self):
+        get_organization_datasets = ec_harvester.get_organization_datasets
+
+        def mock_get_organization_datasets(org_id, skip=0):
+            if org_id == '4':
+                return org_id, [], 'Connection refused'
+            return get_organization_datasets(org_id, skip)
+
+        harvester = EcInitialHarvester()
+        job = HarvestJobFactory()
+        with mock.patch(
+                'ckanext.glasgow.harvesters.ec_harvester.get_organization_datasets',
+                side_effect=mock_get_organization_datasets):
+            nt.assert_equals(False, harvester.gather_stage(job))
+
+        checkpoints = model.Session.query(HarvestInitialCheckpoint) \
+            .filter_by(harvest_source_id=job.source_id).all()
+        finished = dict((c.organization_id, c.finished) for c in checkpoints)
+        nt.assert_equals(finished, {'1': True, '2': True, '4': False})
+
+        # Only the failed organization is requested again
+        job2 = HarvestJobFactory(source=job.source)
+        with mock.patch(
+                'ckanext.glasgow.harvesters.ec_harvester.get_organization_datasets',
+                side_effect=get_organization_datasets) as m:
+            harvest_result = harvester.gather_stage(job2)
+
+        nt.assert_equals(m.call_args_list, [mock.call('4', 0)])
+        nt.assert_equals(len(harvest_result), 3)
+
+        # Checkpoints are removed once all organizations are done
+        nt.assert_equals(
+            model.Session.query(HarvestInitialCheckpoint)
+            .filter_by(harvest_source_id=job.source_id).count(), 0)
+
+    def test_gather_prefetches_files(self):
+        harvester = EcInitialHarvester()
+        job = HarvestJobFactory()
+        harvester.gather_stage(job)
+
+        nt.assert_equals(len(job.objects), 3)
+        for harvest_object in job.objects:
+            model.Session.refresh(harvest_object)
+            nt.assert_equals(
+                harvester._get_object_extra(harvest_object, 'files_fetched'),
+                'true')
+
+            # The fetch stage does not need to call the API again
+            with mock.patch('ckanext.glasgow.client.get') as m:
+                nt.assert_true(harvester.fetch_stage(harvest_object))
+                nt.assert_false(m.called)
+
+    def test_gather_prefetch_files_unexpected_error(self):
+        harvester = EcInitialHarvester()
+        job = HarvestJobFactory()
+
+        with mock.patch('ckanext.glasgow.harvesters.ec_harvester.'
+                        'get_files_metadata',
+                        side_effect=KeyError('FileId')):
+            harvester.gather_stage(job)
+
+        # The datasets are still gathered, and left for the fetch stage
+        nt.assert_equals(len(job.objects), 3)
+        for harvest_object in job.objects:
+            model.Session.refresh(harvest_object)
+            nt.assert_equals(
+                harvester._get_object_extra(harvest_object, 'files_fetched'),
+                None)
+
+    def test_harvest_object_writer(self):
+        job = HarvestJobFactory()
+
+        writer = HarvestObjectWriter(job, batch_size=2)
+        ids = [writer.add(guid=i, content=json.dumps({'Id': i}),
+                          extras=[('owner_org', 'org-{0}'.format(i))])
+               for i in range(3)]
+        writer.add_extra(ids[0], 'file', '{}')
+        writer.commit()
+
+        harvest_objects = model.Session.query(harvest_model.HarvestObject) \
+            .filter(harvest_model.HarvestObject.harvest_job_id == job.id) \
+            .all()
+        nt.assert_equals(sorted(o.id for o in harvest_objects), sorted(ids))
+
+        for harvest_object in harvest_objects:
+            nt.assert_equals(harvest_object.state, 'WAITING')
+            nt.assert_equals(harvest_object.harvest_source_id, job.source_id)
+            content = json.loads(harvest_object.content)
+            nt.assert_equals(harvest_object.guid, unicode(content['Id']))
+            owner_org = [e.value for e in harvest_object.extras
+                         if e.key == 'owner_org']
+            nt.assert_equals(owner_org, ['org-{0}'.format(content['Id'])])
+            nt.assert_equals(
+                len([e for e in harvest_object.extras if e.key == 'file']),
+                1 if harvest_object.id == ids[0] else 0)
+
+    @mock.patch('ckanext.glasgow.client.get')
     def test_gather_with_ec_500_response(self, m):
-        # setup a mock for requests.get that returns an object
+        # setup a mock for client.get that returns an object
         # with a status_code of 500
         req = mock.MagicMock()
         req.status_code = 500
@@ -138,17 +275,17 @@ class TestDatasetCreate(object):
 
         nt.assert_equals(False, harvester.gather_stage(job))
 
-    @mock.patch('requests.get')
+    @mock.patch('ckanext.glasgow.client.get')
     def test_gather_with_ec_failed_response(self, m):
         # simulate a api error response with error message
         req = mock.MagicMock()
         req.status_code = 200
-        req.content = '''{
+        req.iter_content.return_value = iter(['''{
             "IsRetryRequested": false,
             "ErrorMessage": "an error occured",
             "IsErrorResponse": true,
             "MetadataResultSet": []}
-        '''
+        '''])
         m.return_value = req
 
         harvester = EcInitialHarvester()
@@ -156,6 +293,11 @@ class TestDatasetCreate(object):
 
         nt.assert_equals(False, harvester.gather_stage(job))
 
+        errors = model.Session.query(harvest_model.HarvestGatherError) \
+            .filter_by(harvest_job_id=job.id).all()
+        nt.assert_equals(len(errors), 1)
+        nt.assert_equals(errors[0].message, 'EC API Error: an error occured:')
+
     def test_fetch(self):
         harvester = EcInitialHarvester()
         job = HarvestJobFactory()
@@ -204,6 +346,21 @@ class TestDatasetCreate(object):
 
         nt.assert_equals(len(pkg['resources']), 2)
 
+    def test_fetch_malformed_content(self):
+        harvester = EcInitialHarvester()
+        job = HarvestJobFactory()
+
+        # No OrganisationId
+        harvest_object = harvest_model.HarvestObject(
+            guid='3', job=job, content=json.dumps({'Id': 3}))
+        harvest_object.save()
+
+        nt.assert_false(harvester.fetch_stage(harvest_object))
+
+        nt.assert_equals(len(harvest_object.errors), 1)
+        nt.assert_equals(harvest_object.errors[0].stage, 'Fetch')
+        nt.assert_true('OrganisationId' in harvest_object.errors[0].message)
+
     def test_import(self):
         harvester = EcInitialHarvester()
         job = HarvestJobFactory()
@@ -282,7 +439,7 @@ class TestUserCreate(object):
         helpers.reset_db()
         search.clear()
 
-    @mock.patch('requests.request')
+    @mock.patch('ckanext.glasgow.client.request')
     def test_user_create(self, mock_request):
         content = {"UserName": 'testuser',
             "About": "about",
@@ -383,7 +540,7 @@ class TestChangeLogUserUpdate(object):
         helpers.reset_db()
         search.clear()
 
-    @mock.patch('requests.request')
+    @mock.patch('ckanext.glasgow.client.request')
     def test_user_create(self, mock_request):
         content = {"UserName": 'testuser',
             "About": "about",
@@ -434,3 +591,721 @@ class TestChangeLogUserUpdate(object):
 
         membership = helpers.call_action('member_list', id='an_org')
         nt.assert_false(u'userid123' in set(i[0] for i in membership))
+
+
+class TestChangelogGather(object):
+    @classmethod
+    def setup_class(cls):
+        # Start mock EC API
+        harvest_model.setup()
+        run_mock_ec()
+
+    def setup(self):
+        helpers.reset_db()
+
+    @classmethod
+    def teardown_class(cls):
+        helpers.reset_db()
+
+    def test_changelog_pages(self):
+        pages = list(changelog_pages('0', page_size=2))
+
+        nt.assert_equals(
+            [[a['AuditId'] for a in audits] for audits in pages],
+            [[1005, 1010], [1012]])
+
+    def test_changelog_pages_no_new_audits(self):
+        nt.assert_equals(list(changelog_pages('1012', page_size=2)), [])
+
+    def test_gather_drains_changelog(self):
+        harvester = EcChangelogHarvester()
+        job = HarvestJobFactory()
+
+        with mock.patch.dict(
+                'pylons.config',
+                {'ckanext.glasgow.harvest.changelog_page_size': '2'}):
+            ids = harvester.gather_stage(job)
+
+        nt.assert_equals(len(ids), 3)
+
+        last_audit = model.Session.query(HarvestLastAudit).first()
+        nt.assert_equals(last_audit.audit_id, '1012')
+        nt.assert_equals(last_audit.harvest_job_id, job.id)
+
+    def test_gather_max_audits(self):
+        harvester = EcChangelogHarvester()
+        job = HarvestJobFactory()
+
+        with mock.patch.dict(
+                'pylons.config',
+                {'ckanext.glasgow.harvest.changelog_page_size': '2',
+                 'ckanext.glasgow.harvest.changelog_max_audits': '1'}):
+            ids = harvester.gather_stage(job)
+
+        nt.assert_equals(len(ids), 1)
+
+        last_audit = model.Session.query(HarvestLastAudit).first()
+        nt.assert_equals(last_audit.audit_id, '1005')
+
+    def test_gather_imports_concurrently(self):
+        harvester = EcChangelogHarvester()
+        job = HarvestJobFactory()
+
+        with mock.patch.dict(
+                'pylons.config',
+                {'ckanext.glasgow.harvest.changelog_import_concurrency':
+                    '2'}):
+            with mock.patch.object(EcChangelogHarvester, '_import_audit',
+                                   return_value=True) as mock_import:
+                ids = harvester.gather_stage(job)
+
+                nt.assert_equals(mock_import.call_count, len(ids))
+
+                for harvest_object_id in ids:
+                    harvest_object = harvest_model.HarvestObject.get(
+                        harvest_object_id)
+                    nt.assert_equals(harvester._get_object_extra(
+                        harvest_object, IMPORT_RESULT_EXTRA), 'done')
+
+                    # Not imported again on the import stage
+                    nt.assert_true(harvester.import_stage(harvest_object))
+
+                nt.assert_equals(mock_import.call_count, len(ids))
+
+    def test_gather_concurrent_single_partition(self):
+        harvester = EcChangelogHarvester()
+        job = HarvestJobFactory()
+
+        # A single partition is imported on the gather thread
+        with mock.patch.dict(
+                'pylons.config',
+                {'ckanext.glasgow.harvest.changelog_import_concurrency':
+                    '2'}):
+            with mock.patch('ckanext.glasgow.harvesters.changelog.'
+                            'partition_audits',
+                            side_effect=lambda items: [[items]]):
+                with mock.patch.object(EcChangelogHarvester, '_import_audit',
+                                       return_value=True):
+                    ids = harvester.gather_stage(job)
+
+        # The gather session is still the same
+        nt.assert_true(job in model.Session)
+
+        for harvest_object_id in ids:
+            harvest_object = harvest_model.HarvestObject.get(
+                harvest_object_id)
+            nt.assert_equals(harvester._get_object_extra(
+                harvest_object, IMPORT_RESULT_EXTRA), 'done')
+
+    def test_gather_concurrent_import_errors(self):
+        harvester = EcChangelogHarvester()
+        job = HarvestJobFactory()
+
+        with mock.patch.dict(
+                'pylons.config',
+                {'ckanext.glasgow.harvest.changelog_import_concurrency':
+                    '2'}):
+            with mock.patch.object(EcChangelogHarvester, '_import_audit',
+                                   side_effect=Exception('Boom')):
+                ids = harvester.gather_stage(job)
+
+        for harvest_object_id in ids:
+            harvest_object = harvest_model.HarvestObject.get(
+                harvest_object_id)
+            nt.assert_equals(harvester._get_object_extra(
+                harvest_object, IMPORT_RESULT_EXTRA), 'error')
+            nt.assert_false(harvester.import_stage(harvest_object))
+            nt.assert_equals(len(harvest_object.errors), 1)
+
+    def test_gather_group_commit(self):
+        harvester = EcChangelogHarvester()
+        job = HarvestJobFactory()
+
+        with mock.patch.dict(
+                'pylons.config',
+                {'ckanext.glasgow.harvest.changelog_commit_batch_size':
+                    '2'}):
+            with mock.patch.object(EcChangelogHarvester, '_import_audit',
+                                   return_value=True) as mock_import:
+                ids = harvester.gather_stage(job)
+
+        nt.assert_equals(mock_import.call_count, len(ids))
+        for call in mock_import.call_args_list:
+            nt.assert_true(call[1]['writer'])
+
+        for harvest_object_id in ids:
+            harvest_object = harvest_model.HarvestObject.get(
+                harvest_object_id)
+            nt.assert_equals(harvester._get_object_extra(
+                harvest_object, IMPORT_RESULT_EXTRA), 'done')
+
+    @mock.patch.object(EcChangelogHarvester, '_update_task_states')
+    @mock.patch('ckanext.glasgow.harvesters.changelog.'
+                'get_audit_command_handler')
+    def test_group_commit_rolls_back_failed_audits(self, mock_handler,
+                                                   mock_update_task):
+        job = HarvestJobFactory()
+
+        def handler(context, audit, harvest_object):
+            nt.assert_true(context['defer_commit'])
+            harvest_object.current = True
+            harvest_object.add()
+            model.Session.flush()
+            if audit['AuditId'] == 2:
+                raise toolkit.ValidationError({'name': ['Invalid']})
+            elif audit['AuditId'] == 3:
+                raise Exception('Boom')
+
+        mock_handler.return_value = handler
+
+        partition = []
+        for audit_id in range(1, 5):
+            audit = {'AuditId': audit_id, 'Command': 'UpdateDataSet',
+                     'CustomProperties': {}}
+            harvest_object = harvest_model.HarvestObject(
+                guid=str(audit_id), job=job, content=json.dumps(audit))
+            harvest_object.save()
+            partition.append((harvest_object.id, audit))
+
+        # Errors are not committed until the end of the group
+        with mock.patch.object(EcChangelogHarvester,
+                               '_save_object_error') as mock_save_error:
+            results = EcChangelogHarvester()._import_partition(partition,
+                                                               batch_size=3)
+        nt.assert_false(mock_save_error.called)
+
+        nt.assert_equals([success for _, success in results],
+                         [True, False, False, True])
+
+        harvest_objects = [harvest_model.HarvestObject.get(harvest_object_id)
+                           for harvest_object_id, _ in partition]
+        nt.assert_equals([o.current for o in harvest_objects],
+                         [True, False, False, True])
+        nt.assert_equals([len(o.errors) for o in harvest_objects],
+                         [0, 1, 1, 0])
+
+    @mock.patch.object(EcChangelogHarvester, '_update_task_states')
+    @mock.patch('ckanext.glasgow.harvesters.changelog.'
+                'get_audit_command_handler')
+    def test_group_commit_committing_commands(self, mock_handler,
+                                              mock_update_task):
+        job = HarvestJobFactory()
+
+        def handler(context, audit, harvest_object):
+            if audit['Command'] == 'UpdateUser':
+                # Imported on its own, after committing the previous ones
+                nt.assert_false(context.get('defer_commit'))
+                nt.assert_equals(
+                    model.Session.query(harvest_model.HarvestObject)
+                    .filter_by(current=True).count(), 1)
+                model.Session.commit()
+                raise toolkit.ValidationError({'name': ['Invalid']})
+
+            nt.assert_true(context['defer_commit'])
+            harvest_object.current = True
+            harvest_object.add()
+            model.Session.flush()
+            if audit['AuditId'] == 3:
+                raise toolkit.ValidationError({'name': ['Invalid']})
+
+        mock_handler.return_value = handler
+
+        partition = []
+        for audit_id, command in [(1, 'UpdateDataSet'), (2, 'UpdateUser'),
+                                  (3, 'UpdateDataSet'),
+                                  (4, 'UpdateDataSet')]:
+            audit = {'AuditId': audit_id, 'Command': command,
+                     'CustomProperties': {}}
+            harvest_object = harvest_model.HarvestObject(
+                guid=str(audit_id), job=job, content=json.dumps(audit))
+            harvest_object.save()
+            partition.append((harvest_object.id, audit))
+
+        results = EcChangelogHarvester()._import_partition(partition,
+                                                           batch_size=3)
+
+        nt.assert_equals([success for _, success in results],
+                         [True, False, False, True])
+
+        harvest_objects = [harvest_model.HarvestObject.get(harvest_object_id)
+                           for harvest_object_id, _ in partition]
+        nt.assert_equals([o.current for o in harvest_objects],
+                         [True, False, False, True])
+        nt.assert_equals([len(o.errors) for o in harvest_objects],
+                         [0, 1, 1, 0])
+
+    def _import_file_deletes(self, batch_size):
+        harvester = EcChangelogHarvester()
+        job = HarvestJobFactory()
+        dataset = factories.Dataset()
+
+        # Both audits supersede the previous objects for the same dataset
+        items = []
+        for audit_id, file_id in [(1, 'file-1'), (2, 'file-2')]:
+            audit = {'AuditId': audit_id, 'Command': 'DeleteFileVersion',
+                     'CustomProperties': {'DataSetId': dataset['id'],
+                                          'FileId': file_id}}
+            harvest_object = harvest_model.HarvestObject(
+                guid=dataset['id'], job=job, content=json.dumps(audit))
+            harvest_object.save()
+            items.append((harvest_object.id, audit))
+
+        harvester._import_concurrently(items, 2, batch_size=batch_size)
+        model.Session.remove()
+
+        harvest_objects = [harvest_model.HarvestObject.get(harvest_object_id)
+                           for harvest_object_id, _ in items]
+        nt.assert_equals([harvester._get_object_extra(
+            o, IMPORT_RESULT_EXTRA) for o in harvest_objects],
+            ['done', 'done'])
+        nt.assert_equals([o.current for o in harvest_objects],
+                         [False, True])
+
+    def test_import_concurrently_supersedes_objects_from_same_job(self):
+        self._import_file_deletes(batch_size=1)
+
+    def test_group_commit_supersedes_objects_from_same_job(self):
+        self._import_file_deletes(batch_size=2)
+
+    def test_import_concurrently_validation_errors(self):
+        harvester = EcChangelogHarvester()
+        job = HarvestJobFactory()
+
+        # Validation errors on the worker threads need a translator to
+        # build their messages
+        items = []
+        for audit_id in (1, 2):
+            dataset = factories.Dataset()
+            audit = {'AuditId': audit_id, 'Command': 'UpdateDataSet',
+                     'CustomProperties': {'DataSetId': dataset['id']}}
+            harvest_object = harvest_model.HarvestObject(
+                guid=dataset['id'], job=job, content=json.dumps(audit))
+            harvest_object.extras.append(harvest_model.HarvestObjectExtra(
+                key=REMOTE_METADATA_EXTRA,
+                value=json.dumps({'id': dataset['id'],
+                                  'name': 'Not a valid name!'})))
+            harvest_object.save()
+            items.append((harvest_object.id, audit))
+
+        harvester._import_concurrently(items, 2)
+        model.Session.remove()
+
+        for harvest_object_id, _ in items:
+            harvest_object = harvest_model.HarvestObject.get(
+                harvest_object_id)
+            nt.assert_equals(harvester._get_object_extra(
+                harvest_object, IMPORT_RESULT_EXTRA), 'error')
+            nt.assert_equals(len(harvest_object.errors), 1)
+            nt.assert_true('translator' not in
+                           harvest_object.errors[0].message)
+            nt.assert_true('name' in harvest_object.errors[0].message)
+
+    def test_gather_prefetches_metadata(self):
+        harvester = EcChangelogHarvester()
+        job = HarvestJobFactory()
+
+        def get_metadata(audit):
+            return {'audit_id': audit['AuditId']}
+
+        with mock.patch('ckanext.glasgow.harvesters.changelog.'
+                        'get_remote_metadata',
+                        side_effect=get_metadata) as mock_get:
+            ids = harvester.gather_stage(job)
+
+            # Only the CreateFile audit needs metadata
+            nt.assert_equals(mock_get.call_count, 1)
+
+            for harvest_object_id in ids:
+                harvest_object = harvest_model.HarvestObject.get(
+                    harvest_object_id)
+                audit = json.loads(harvest_object.content)
+                metadata = harvester._get_object_extra(
+                    harvest_object, REMOTE_METADATA_EXTRA)
+                if audit['Command'] == 'CreateFile':
+                    nt.assert_equals(json.loads(metadata),
+                                     {'audit_id': audit['AuditId']})
+                else:
+                    nt.assert_equals(metadata, None)
+
+                nt.assert_true(harvester.fetch_stage(harvest_object))
+
+            # Not requested again on the fetch stage
+            nt.assert_equals(mock_get.call_count, 1)
+
+    def test_gather_prefetch_unexpected_error(self):
+        harvester = EcChangelogHarvester()
+        job = HarvestJobFactory()
+
+        with mock.patch('ckanext.glasgow.harvesters.changelog.'
+                        'get_remote_metadata',
+                        side_effect=KeyError('Version')):
+            ids = harvester.gather_stage(job)
+
+        nt.assert_equals(len(ids), 3)
+
+        last_audit = model.Session.query(HarvestLastAudit).first()
+        nt.assert_equals(last_audit.audit_id, '1012')
+
+        for harvest_object_id in ids:
+            harvest_object = harvest_model.HarvestObject.get(
+                harvest_object_id)
+            nt.assert_equals(harvester._get_object_extra(
+                harvest_object, REMOTE_METADATA_EXTRA), None)
+
+    def test_fetch_stage_gets_metadata(self):
+        harvester = EcChangelogHarvester()
+        job = HarvestJobFactory()
+
+        with mock.patch.dict(
+                'pylons.config',
+                {'ckanext.glasgow.harvest.prefetch_changelog': 'false'}):
+            ids = harvester.gather_stage(job)
+
+        harvest_object = [
+            o for o in
+            [harvest_model.HarvestObject.get(i) for i in ids]
+            if json.loads(o.content)['Command'] == 'CreateFile'][0]
+        nt.assert_equals(harvester._get_object_extra(
+            harvest_object, REMOTE_METADATA_EXTRA), None)
+
+        with mock.patch('ckanext.glasgow.harvesters.changelog.'
+                        'get_remote_metadata',
+                        return_value={'name': 'test'}):
+            nt.assert_true(harvester.fetch_stage(harvest_object))
+
+        nt.assert_equals(json.loads(harvester._get_object_extra(
+            harvest_object, REMOTE_METADATA_EXTRA)), {'name': 'test'})
+
+    def test_fetch_stage_error(self):
+        harvester = EcChangelogHarvester()
+        job = HarvestJobFactory()
+
+        with mock.patch.dict(
+                'pylons.config',
+                {'ckanext.glasgow.harvest.prefetch_changelog': 'false'}):
+            ids = harvester.gather_stage(job)
+
+        harvest_object = [
+            o for o in
+            [harvest_model.HarvestObject.get(i) for i in ids]
+            if json.loads(o.content)['Command'] == 'CreateFile'][0]
+
+        with mock.patch('ckanext.glasgow.harvesters.changelog.'
+                        'get_remote_metadata',
+                        side_effect=requests.exceptions.ConnectionError):
+            nt.assert_false(harvester.fetch_stage(harvest_object))
+
+        nt.assert_equals(len(harvest_object.errors), 1)
+        nt.assert_equals(harvest_object.errors[0].stage, 'Fetch')
+
+    def test_handlers_use_stored_metadata(self):
+        harvest_object = mock.Mock(extras=[
+            mock.Mock(key=REMOTE_METADATA_EXTRA,
+                      value=json.dumps({'name': 'stored'}))])
+        fetch = mock.Mock()
+
+        nt.assert_equals(
+            _get_audit_metadata(harvest_object, {}, fetch),
+            {'name': 'stored'})
+        nt.assert_false(fetch.called)
+
+        nt.assert_equals(_get_audit_metadata(None, {}, fetch),
+                         fetch.return_value)
+
+
+class TestPartitionAudits(object):
+
+    def _audit(self, audit_id, **properties):
+        return {'AuditId': audit_id, 'CustomProperties': properties}
+
+    def test_partitions(self):
+        items = [
+            ('a', self._audit(5, OrganisationId='1', DataSetId='10')),
+            ('b', self._audit(2, OrganisationId='1', DataSetId='10',
+                              FileId='x')),
+            ('c', self._audit(3, OrganisationId='2', DataSetId='20')),
+            ('d', self._audit(4, OrganisationId='1')),
+            ('e', self._audit(1, UserName='someone', OrganisationId='1')),
+            ('f', self._audit(6, OrganisationId='1')),
+        ]
+
+        phases = partition_audits(items)
+
+        # Organizations first
+        nt.assert_equals(len(phases), 2)
+        nt.assert_equals([[i[0] for i in partition]
+                          for partition in phases[0]], [['d', 'f']])
+
+        # Files go with their dataset, in AuditId order
+        nt.assert_equals(sorted([i[0] for i in partition]
+                                for partition in phases[1]),
+                         [['b', 'a'], ['c'], ['e']])
+
+    def test_no_organization_audits(self):
+        items = [('a', self._audit(1, OrganisationId='1', DataSetId='10'))]
+
+        nt.assert_equals(partition_audits(items), [[items]])
+
+    def test_empty(self):
+        nt.assert_equals(partition_audits([]), [])
+
+    def test_batch_partitions(self):
+        partitions = [['a'], ['b', 'c'], ['d'], ['e', 'f', 'g'], ['h']]
+
+        nt.assert_equals(batch_partitions(partitions, 3),
+                         [['a', 'b', 'c'], ['d', 'e', 'f', 'g'], ['h']])
+        nt.assert_equals(batch_partitions(partitions, 1), partitions)
+        nt.assert_equals(batch_partitions([], 3), [])
+
+
+class TestCompactAudits(object):
+
+    def _audit(self, audit_id, command, **properties):
+        return {
+            'AuditId': audit_id,
+            'Command': command,
+            'CustomProperties': properties,
+            'RequestId': 'request-{0}'.format(audit_id),
+        }
+
+    def test_create_and_updates_become_create(self):
+        audits = [
+            self._audit(1, 'CreateFile', DataSetId='1', FileId='a',
+                        VersionId='v1'),
+            self._audit(2, 'UpdateFile', DataSetId='1', FileId='a',
+                        VersionId='v2'),
+            self._audit(3, 'UpdateFile', DataSetId='1', FileId='a',
+                        VersionId='v3'),
+        ]
+
+        compacted = compact_audits(audits)
+
+        nt.assert_equals(len(compacted), 1)
+        nt.assert_equals(compacted[0]['AuditId'], 1)
+        nt.assert_equals(compacted[0]['Command'], 'CreateFile')
+        nt.assert_equals(compacted[0]['CustomProperties']['VersionId'], 'v3')
+        nt.assert_equals(compacted[0]['CompactedAuditIds'], [2, 3])
+        nt.assert_equals(compacted[0]['CompactedRequestIds'],
+                         ['request-2', 'request-3'])
+
+    def test_updates_become_latest(self):
+        audits = [
+            self._audit(3, 'UpdateDataSet', OrganisationId='1',
+                        DataSetId='2'),
+            self._audit(1, 'UpdateDataSet', DataSetId='2',
+                        OrganisationId='1'),
+        ]
+
+        compacted = compact_audits(audits)
+
+        nt.assert_equals([a['AuditId'] for a in compacted], [3])
+        nt.assert_equals(compacted[0]['CompactedAuditIds'], [1])
+
+    def test_changes_before_delete_are_dropped(self):
+        audits = [
+            self._audit(1, 'CreateFile', DataSetId='1', FileId='a',
+                        VersionId='v1'),
+            self._audit(2, 'UpdateFile', DataSetId='1', FileId='a',
+                        VersionId='v2'),
+            self._audit(3, 'DeleteFileVersion', DataSetId='1', FileId='a',
+                        VersionId='v2'),
+            self._audit(4, 'CreateFile', DataSetId='1', FileId='a',
+                        VersionId='v3'),
+        ]
+
+        compacted = compact_audits(audits)
+
+        nt.assert_equals([(a['AuditId'], a['Command']) for a in compacted],
+                         [(3, 'DeleteFileVersion'), (4, 'CreateFile')])
+        nt.assert_equals(compacted[0]['CompactedAuditIds'], [1, 2])
+        assert 'CompactedAuditIds' not in compacted[1]
+
+    def test_different_objects_are_kept(self):
+        audits = [
+            self._audit(1, 'UpdateDataSet', OrganisationId='1',
+                        DataSetId='1'),
+            self._audit(2, 'UpdateOrganisation', OrganisationId='1'),
+            self._audit(3, 'UpdateFile', DataSetId='1', FileId='a',
+                        VersionId='v1'),
+            self._audit(4, 'UpdateFile', DataSetId='1', FileId='b',
+                        VersionId='v1'),
+            self._audit(5, 'UpdateDataSet', OrganisationId='2',
+                        DataSetId='2'),
+        ]
+
+        nt.assert_equals(compact_audits(audits), audits)
+
+    def test_unknown_commands_are_kept(self):
+        audits = [
+            self._audit(1, 'SomeCommand', DataSetId='1'),
+            self._audit(2, 'SomeCommand', DataSetId='1'),
+            self._audit(3, 'UpdateDataSet'),
+            self._audit(4, 'UpdateDataSet'),
+        ]
+
+        nt.assert_equals(compact_audits(audits), audits)
+
+    def test_object_keys(self):
+        nt.assert_equals(
+            get_audit_object_key(self._audit(
+                1, 'UpdateFile', OrganisationId='1', DataSetId=2,
+                FileId='a', VersionId='v1')),
+            ('file', u'2', u'a'))
+        nt.assert_equals(
+            get_audit_object_key(self._audit(
+                1, 'ChangeUserRoles', UserName='someone',
+                OrganisationId='1')),
+            ('user', u'someone'))
+        nt.assert_equals(
+            get_audit_object_key(self._audit(1, 'CreateDataset')),
+            ('audit', u'1'))
+
+    @mock.patch.object(EcChangelogHarvester, '_update_task_states')
+    @mock.patch.object(EcChangelogHarvester, '_get_user_name',
+                       return_value='harvest')
+    @mock.patch('ckanext.glasgow.harvesters.changelog.'
+                'get_audit_command_handler')
+    def test_import_updates_replaced_tasks(self, mock_handler, mock_user,
+                                           mock_update_task):
+        audit = compact_audits([
+            self._audit(1, 'UpdateOrganisation', OrganisationId='1'),
+            self._audit(2, 'UpdateOrganisation', OrganisationId='1'),
+        ])[0]
+        harvest_object = mock.Mock(content=json.dumps(audit), extras=[])
+
+        nt.assert_true(EcChangelogHarvester().import_stage(harvest_object))
+
+        nt.assert_equals(mock_handler.return_value.call_count, 1)
+        states = [(c[0][1], c[0][2]) for c in mock_update_task.call_args_list]
+        nt.assert_equals(states, [
+            (['request-1', 'request-2'], 'processing'),
+            (['request-1', 'request-2'], 'finished'),
+        ])
+
+
+class TestSupersedeHarvestObjects(object):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    def setup(self):
+        helpers.reset_db()
+        self.job = HarvestJobFactory()
+
+    @classmethod
+    def teardown_class(cls):
+        helpers.reset_db()
+
+    def _create_object(self, guid, package_id=None, current=True, job=None):
+        harvest_object = harvest_model.HarvestObject(
+            guid=guid, job=job or self.job, package_id=package_id,
+            current=current)
+        harvest_object.save()
+        return harvest_object
+
+    def test_marks_previous_objects_not_current(self):
+        previous = self._create_object('dataset-1')
+        other = self._create_object('dataset-2')
+        harvest_object = self._create_object('dataset-1')
+
+        superseded = supersede_harvest_objects([harvest_object])
+        model.Session.commit()
+        model.Session.expire_all()
+
+        nt.assert_equals(superseded, 1)
+        nt.assert_false(previous.current)
+        nt.assert_true(other.current)
+        nt.assert_true(harvest_object.current)
+
+    def test_matches_on_package_id(self):
+        package = factories.Dataset()
+        previous = self._create_object('old-guid', package_id=package['id'])
+        harvest_object = self._create_object('new-guid',
+                                             package_id=package['id'])
+
+        supersede_harvest_objects([harvest_object])
+        model.Session.commit()
+        model.Session.expire_all()
+
+        nt.assert_false(previous.current)
+        nt.assert_true(harvest_object.current)
+
+    def test_purge(self):
+        previous = self._create_object('dataset-1', job=HarvestJobFactory())
+        previous.extras.append(
+            harvest_model.HarvestObjectExtra(key='status', value='change'))
+        previous.save()
+        previous_id = previous.id
+        harvest_object = self._create_object('dataset-1')
+        harvest_object_id = harvest_object.id
+
+        superseded = supersede_harvest_objects([harvest_object], purge=True)
+        model.Session.commit()
+        model.Session.expunge_all()
+
+        nt.assert_equals(superseded, 1)
+        nt.assert_equals(harvest_model.HarvestObject.get(previous_id), None)
+        nt.assert_equals(
+            model.Session.query(harvest_model.HarvestObjectExtra)
+            .filter_by(harvest_object_id=previous_id).count(), 0)
+        nt.assert_true(
+            harvest_model.HarvestObject.get(harvest_object_id).current)
+
+    def test_purge_keeps_objects_from_the_same_job(self):
+        previous = self._create_object('dataset-1')
+        previous_id = previous.id
+        harvest_object = self._create_object('dataset-1')
+
+        superseded = supersede_harvest_objects([harvest_object], purge=True)
+        model.Session.commit()
+        model.Session.expunge_all()
+
+        nt.assert_equals(superseded, 1)
+        previous = harvest_model.HarvestObject.get(previous_id)
+        nt.assert_true(previous is not None)
+        nt.assert_false(previous.current)
+
+    def test_no_objects(self):
+        nt.assert_equals(supersede_harvest_objects([]), 0)
+
+
+class TestBenchmark(object):
+    @classmethod
+    def setup_class(cls):
+        harvest_model.setup()
+
+    def setup(self):
+        helpers.reset_db()
+
+    def teardown(self):
+        mock_ec.catalogue = None
+
+    @classmethod
+    def teardown_class(cls):
+        helpers.reset_db()
+        search.clear()
+
+    def test_run_benchmark(self):
+        catalogue = Catalogue(organizations=2, datasets=2, files=1,
+                              versions=1, audits=5)
+
+        # The EC API options are pointed to the benchmark mock EC API
+        with mock.patch.dict('pylons.config', {}):
+            results = run_benchmark(catalogue, port=7073)
+
+        nt.assert_equals(
+            [stage['name'] for stage in results['stages']],
+            ['initial_gather', 'initial_fetch', 'initial_import',
+             'changelog_gather', 'changelog_import'])
+        for stage in results['stages']:
+            nt.assert_equals(stage['errors'], 0)
+
+        initial_gather = results['stages'][0]
+        nt.assert_equals(initial_gather['objects'], 4)
+        assert initial_gather['ec_api']['dataset_list_for_organization']
+
+        nt.assert_equals(results['stages'][3]['objects'], 5)
+
+        nt.assert_equals(
+            model.Session.query(model.Package).filter_by(
+                state='active').count(), 4)
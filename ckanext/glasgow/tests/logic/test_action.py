@@ -2,6 +2,7 @@ import cgi
 import datetime
 import os
 import StringIO
+import time
 import json
 
 import nose
@@ -18,19 +19,30 @@ from ckan.lib import search
 
 from ckanext.glasgow.logic.action import (
     _get_api_endpoint,
-    _create_task_status,
     _update_task_status_success,
     _update_task_status_error,
+    _new_task_status,
+    _save_task_statuses,
+    apply_task_status_operation,
+    _change_request_cache,
     ECAPINotAuthorized,
     ECAPIError,
     )
 
+from ckanext.glasgow.harvesters import get_task_for_request_id
 from ckanext.glasgow.tests import run_mock_ec
 
 
 eq_ = nose.tools.eq_
 
 
+def _save_new_task_status(context, task_type, entity_id, entity_type, key,
+                          value):
+    task_dict = _new_task_status(task_type, entity_id, entity_type, key)
+    task_dict['value'] = value
+    return _save_task_statuses(context, [task_dict])[0]
+
+
 class TestGetAPIEndpoint(object):
 
     @classmethod
@@ -88,15 +100,14 @@ class TestTaskStatusHelpers(object):
     def setup(cls):
         helpers.reset_db()
 
-    def test_create_task_status(self):
+    def test_save_new_task_status(self):
 
-        task_dict = _create_task_status({'user': 'test'},
-                                        task_type='test_task_type',
-                                        entity_id='test_entity_id',
-                                        entity_type='test_entity_type',
-                                        key='test_key',
-                                        value='test_value'
-                                        )
+        task_dict = _new_task_status(task_type='test_task_type',
+                                     entity_id='test_entity_id',
+                                     entity_type='test_entity_type',
+                                     key='test_key')
+        task_dict['value'] = 'test_value'
+        task_dict = _save_task_statuses({'user': 'test'}, [task_dict])[0]
 
         assert 'id' in task_dict
         eq_(task_dict['task_type'], 'test_task_type')
@@ -120,13 +131,13 @@ class TestTaskStatusHelpers(object):
 
     def test_update_task_status_success(self):
 
-        task_dict = _create_task_status({'user': 'test'},
-                                        task_type='test_task_type',
-                                        entity_id='test_entity_id',
-                                        entity_type='test_entity_type',
-                                        key='test_key',
-                                        value='test_value'
-                                        )
+        task_dict = _save_new_task_status({'user': 'test'},
+                                          task_type='test_task_type',
+                                          entity_id='test_entity_id',
+                                          entity_type='test_entity_type',
+                                          key='test_key',
+                                          value='test_value'
+                                          )
 
         task_dict = _update_task_status_success({'user': 'test'},
                                                 task_dict=task_dict,
@@ -151,13 +162,13 @@ class TestTaskStatusHelpers(object):
 
     def test_update_task_status_error(self):
 
-        task_dict = _create_task_status({'user': 'test'},
-                                        task_type='test_task_type',
-                                        entity_id='test_entity_id',
-                                        entity_type='test_entity_type',
-                                        key='test_key',
-                                        value='test_value'
-                                        )
+        task_dict = _save_new_task_status({'user': 'test'},
+                                          task_type='test_task_type',
+                                          entity_id='test_entity_id',
+                                          entity_type='test_entity_type',
+                                          key='test_key',
+                                          value='test_value'
+                                          )
 
         task_dict = _update_task_status_error({'user': 'test'},
                                               task_dict=task_dict,
@@ -180,6 +191,75 @@ class TestTaskStatusHelpers(object):
         eq_(task.value, 'test_value_updated')
         eq_(task.state, 'error')
 
+    def test_new_task_status_is_not_stored(self):
+
+        task_dict = _new_task_status(task_type='test_task_type',
+                                     entity_id='test_entity_id',
+                                     entity_type='test_entity_type',
+                                     key='test_key')
+
+        eq_(len(task_dict['id']), 36)
+        eq_(task_dict['state'], 'new')
+        eq_(model.Session.query(model.TaskStatus).get(task_dict['id']), None)
+
+    def test_save_task_statuses_bulk(self):
+
+        task_dicts = []
+        for i in range(3):
+            task_dict = _new_task_status(task_type='test_task_type',
+                                         entity_id='test_entity_id',
+                                         entity_type='test_entity_type',
+                                         key='test_key_{0}'.format(i))
+            task_dict['value'] = {'data_dict': {'index': i}}
+            task_dicts.append(task_dict)
+
+        with mock.patch.object(model.Session, 'commit',
+                               wraps=model.Session.commit) as mock_commit:
+            saved = _save_task_statuses({'user': 'test'}, task_dicts)
+
+        eq_(mock_commit.call_count, 1)
+        eq_([t['id'] for t in saved], [t['id'] for t in task_dicts])
+
+        for i, task_dict in enumerate(saved):
+            task = model.Session.query(model.TaskStatus).get(task_dict['id'])
+            eq_(task.key, 'test_key_{0}'.format(i))
+            # Values are encoded once
+            eq_(json.loads(task.value), {'data_dict': {'index': i}})
+            eq_(task.value, task_dict['value'])
+
+    def test_save_task_statuses_updates_existing(self):
+
+        task_dict = _save_new_task_status({'user': 'test'},
+                                          task_type='test_task_type',
+                                          entity_id='test_entity_id',
+                                          entity_type='test_entity_type',
+                                          key='test_key',
+                                          value='"test_value"'
+                                          )
+        task_dict['state'] = 'sent'
+
+        _save_task_statuses({'user': 'test'}, [task_dict])
+
+        eq_(model.Session.query(model.TaskStatus).count(), 1)
+        task = model.Session.query(model.TaskStatus).get(task_dict['id'])
+        eq_(task.state, 'sent')
+        # Strings are stored as they are
+        eq_(task.value, '"test_value"')
+
+    def test_save_task_statuses_defer_commit(self):
+
+        task_dict = _new_task_status(task_type='test_task_type',
+                                     entity_id='test_entity_id',
+                                     entity_type='test_entity_type',
+                                     key='test_key')
+
+        with mock.patch.object(model.Session, 'commit') as mock_commit:
+            _save_task_statuses({'user': 'test', 'defer_commit': True},
+                                [task_dict])
+
+        assert not mock_commit.called
+        model.Session.rollback()
+
 
 class TestTaskStatus(object):
 
@@ -190,13 +270,13 @@ class TestTaskStatus(object):
     def test_pending_task_for_dataset_by_name(self):
 
         context = {'user': 'test'}
-        task_dict = _create_task_status(context,
-                                        task_type='test_task_type',
-                                        entity_id='test_dataset_id',
-                                        entity_type='dataset',
-                                        key='test_dataset_name',
-                                        value='test_value'
-                                        )
+        task_dict = _save_new_task_status(context,
+                                          task_type='test_task_type',
+                                          entity_id='test_dataset_id',
+                                          entity_type='dataset',
+                                          key='test_dataset_name',
+                                          value='test_value'
+                                          )
 
         pending_task = helpers.call_action('pending_task_for_dataset',
                                            context=context,
@@ -209,13 +289,13 @@ class TestTaskStatus(object):
     def test_pending_task_for_dataset_by_id(self):
 
         context = {'user': 'test'}
-        task_dict = _create_task_status(context,
-                                        task_type='test_task_type',
-                                        entity_id='test_dataset_id',
-                                        entity_type='dataset',
-                                        key='test_dataset_name',
-                                        value='test_value'
-                                        )
+        task_dict = _save_new_task_status(context,
+                                          task_type='test_task_type',
+                                          entity_id='test_dataset_id',
+                                          entity_type='dataset',
+                                          key='test_dataset_name',
+                                          value='test_value'
+                                          )
 
         pending_task = helpers.call_action('pending_task_for_dataset',
                                            context=context,
@@ -228,13 +308,13 @@ class TestTaskStatus(object):
     def test_pending_task_for_dataset_success_found(self):
 
         context = {'user': 'test'}
-        task_dict = _create_task_status(context,
-                                        task_type='test_task_type',
-                                        entity_id='test_dataset_id',
-                                        entity_type='dataset',
-                                        key='test_dataset_name',
-                                        value='test_value'
-                                        )
+        task_dict = _save_new_task_status(context,
+                                          task_type='test_task_type',
+                                          entity_id='test_dataset_id',
+                                          entity_type='dataset',
+                                          key='test_dataset_name',
+                                          value='test_value'
+                                          )
 
         task_dict = _update_task_status_success(context,
                                                 task_dict=task_dict,
@@ -251,13 +331,13 @@ class TestTaskStatus(object):
 
     def test_pending_task_for_dataset_error_not_found(self):
 
-        task_dict = _create_task_status({'user': 'test'},
-                                        task_type='test_task_type',
-                                        entity_id='test_dataset_id',
-                                        entity_type='dataset',
-                                        key='test_dataset_name',
-                                        value='test_value'
-                                        )
+        task_dict = _save_new_task_status({'user': 'test'},
+                                          task_type='test_task_type',
+                                          entity_id='test_dataset_id',
+                                          entity_type='dataset',
+                                          key='test_dataset_name',
+                                          value='test_value'
+                                          )
 
         task_dict = _update_task_status_error({'user': 'test'},
                                               task_dict=task_dict,
@@ -270,6 +350,98 @@ class TestTaskStatus(object):
 
         eq_(pending_task, None)
 
+    def test_task_for_request_id(self):
+
+        context = {'user': 'test', 'model': model}
+        task_dict = _save_new_task_status(context,
+                                          task_type='test_task_type',
+                                          entity_id='test_dataset_id',
+                                          entity_type='dataset',
+                                          key='test_dataset_name',
+                                          value='test_value'
+                                          )
+
+        eq_(get_task_for_request_id(context, 'test_request_id'), None)
+
+        task_dict = _update_task_status_success(context,
+                                                task_dict=task_dict,
+                                                value={
+                                                    'data_dict': {},
+                                                    'request_id':
+                                                        'test_request_id',
+                                                })
+
+        task = get_task_for_request_id(context, 'test_request_id')
+
+        eq_(task.id, task_dict['id'])
+        eq_(get_task_for_request_id(context, 'other_request_id'), None)
+
+    def test_apply_task_status_operation(self):
+
+        context = {'user': 'test', 'model': model}
+        task_dict = _save_new_task_status(context,
+                                          task_type='test_task_type',
+                                          entity_id='test_dataset_id',
+                                          entity_type='dataset',
+                                          key='test_dataset_name',
+                                          value={'request_id': 'req_1'}
+                                          )
+        task_dict = helpers.call_action('task_status_show',
+                                        id=task_dict['id'])
+
+        # Operations older than the last update are ignored
+        result = apply_task_status_operation(context, dict(task_dict), {
+            'Timestamp': '2000-01-01T00:00:00',
+            'OperationState': 'Failed',
+            'Message': 'Old error',
+        })
+        eq_(result, None)
+
+        result = apply_task_status_operation(context, dict(task_dict), {
+            'Timestamp': '3000-01-01T00:00:00',
+            'OperationState': 'InProgress',
+            'Message': 'In progress',
+        })
+        eq_(result['state'], 'in_progress')
+        eq_(json.loads(result['value'])['ec_api_message'], 'In progress')
+
+    def test_apply_task_status_operations_saved_at_once(self):
+
+        context = {'user': 'test', 'model': model}
+        task_dicts = []
+        for i in range(2):
+            task_dict = _save_new_task_status(
+                context, task_type='test_task_type',
+                entity_id='test_dataset_id_{0}'.format(i),
+                entity_type='dataset', key='test_dataset_name_{0}'.format(i),
+                value={'request_id': 'req_{0}'.format(i)})
+            task_dicts.append(helpers.call_action('task_status_show',
+                                                  id=task_dict['id']))
+
+        updated = [
+            apply_task_status_operation(context, dict(task_dict), {
+                'Timestamp': '3000-01-01T00:00:00',
+                'OperationState': 'InProgress',
+                'Message': 'In progress',
+            }, save=False)
+            for task_dict in task_dicts]
+
+        # Not saved yet
+        for task_dict in task_dicts:
+            eq_(helpers.call_action('task_status_show',
+                                    id=task_dict['id'])['state'],
+                task_dict['state'])
+
+        with mock.patch.object(model.Session, 'commit',
+                               wraps=model.Session.commit) as mock_commit:
+            _save_task_statuses(context, updated)
+        eq_(mock_commit.call_count, 1)
+
+        for task_dict in task_dicts:
+            eq_(helpers.call_action('task_status_show',
+                                    id=task_dict['id'])['state'],
+                'in_progress')
+
     def test_pending_task_for_dataset_not_found(self):
 
         pending_task = helpers.call_action('pending_task_for_dataset',
@@ -356,6 +528,44 @@ class TestDatasetCreate(object):
         eq_(task_dict['state'], 'sent')
         assert 'data_dict' in json.loads(task_dict['value'])
 
+    def test_create_saves_task_once(self):
+
+        data_dict = {
+            'name': 'test_dataset_saved_once',
+            'owner_org': 'test_org',
+            'title': 'Test Dataset saved once',
+            'notes': 'Some longer description',
+            'needs_approval': False,
+            'maintainer': 'Test maintainer',
+            'maintainer_email': 'Test maintainer email',
+            'license_id': 'OGL-UK-2.0',
+            'openness_rating': 3,
+            'quality': 5,
+            'published_on_behalf_of': 'Test published on behalf of',
+            'usage_guidance': 'Test usage guidance',
+            'category': 'Test category',
+            'theme': 'Test theme',
+            'standard_name': 'Test standard name',
+            'standard_rating': 5,
+            'standard_version': 'Test standard version',
+        }
+
+        context = {'user': self.normal_user['name']}
+        with mock.patch('ckanext.glasgow.logic.action._save_task_statuses',
+                        wraps=_save_task_statuses) as mock_save:
+            request_dict = helpers.call_action('dataset_request_create',
+                                               context=context,
+                                               **data_dict)
+
+        eq_(mock_save.call_count, 1)
+
+        task_dict = helpers.call_action('task_status_show',
+                                        id=request_dict['task_id'])
+        eq_(task_dict['state'], 'sent')
+        value = json.loads(task_dict['value'])
+        eq_(value['request_id'], request_dict['request_id'])
+        eq_(value['data_dict']['name'], data_dict['name'])
+
     def test_create_ec_401(self):
 
         data_dict = {
@@ -407,6 +617,48 @@ class TestDatasetCreate(object):
         assert 'data_dict' in value
         assert 'error' in value
 
+    @mock.patch('ckanext.glasgow.client.request')
+    def test_create_non_json_response(self, mock_request):
+
+        mock_request.return_value = mock.Mock(status_code=200,
+                                              content='Not JSON')
+        mock_request.return_value.json.side_effect = ValueError('Not JSON')
+
+        data_dict = {
+            'name': 'test_dataset-non-json',
+            'owner_org': 'test_org',
+            'title': 'Test Dataset non JSON',
+            'notes': 'Some longer description',
+            'needs_approval': False,
+            'maintainer': 'Test maintainer',
+            'maintainer_email': 'Test maintainer email',
+            'license_id': 'OGL-UK-2.0',
+            'openness_rating': 3,
+            'quality': 5,
+            'published_on_behalf_of': 'Test published on behalf of',
+            'usage_guidance': 'Test usage guidance',
+            'category': 'Test category',
+            'theme': 'Test theme',
+            'standard_name': 'Test standard name',
+            'standard_rating': 5,
+            'standard_version': 'Test standard version',
+        }
+
+        context = {'user': self.normal_user['name']}
+        nose.tools.assert_raises(p.toolkit.ValidationError,
+                                 helpers.call_action,
+                                 'dataset_request_create',
+                                 context=context,
+                                 **data_dict)
+
+        # The failed request is stored as an error task
+        task = model.Session.query(model.TaskStatus) \
+                            .filter(model.TaskStatus.key == data_dict['name']) \
+                            .one()
+        eq_(task.task_type, 'dataset_request_create')
+        eq_(task.state, 'error')
+        assert 'error' in json.loads(task.value)
+
 
 def _get_mock_file_upload(file_name='test.csv'):
 
@@ -456,9 +708,9 @@ class TestDatasetUpdate(object):
         helpers.reset_db()
         search.clear()
 
-    @mock.patch('requests.request')
+    @mock.patch('ckanext.glasgow.client.request')
     def test_update(self, mock_request):
-        # make the mock the result of calling requests.request(...)
+        # make the mock the result of calling client.request(...)
         mock_request.return_value = mock.Mock(
             status_code=200,
             content=json.dumps({'RequestId': 'req-id'}),
@@ -625,6 +877,86 @@ class TestFileCreate(object):
         assert 'task_id' in request_dict
         assert 'request_id' in request_dict
 
+    @mock.patch('requests.Session.request')
+    def test_create_upload_not_retried_by_default(self, mock_request):
+        mock_request.return_value = mock.Mock(status_code=503)
+
+        upload = _get_mock_file_upload()
+        upload.file.seek(0)
+
+        data_dict = {
+            'dataset_id': self.dataset['id'],
+            'name': 'Test File name',
+            'description': 'Some longer description',
+            'format': 'application/csv',
+            'license_id': 'uk-ogl',
+            'openness_rating': 3,
+            'quality': 5,
+            'standard_name': 'Test standard name',
+            'standard_rating': 1,
+            'standard_version': 'Test standard version',
+            'creation_date': '2014-03-22T05:42:00',
+            'upload': upload,
+        }
+
+        context = {'user': self.normal_user['name']}
+        nose.tools.assert_raises(
+            p.toolkit.ValidationError,
+            helpers.call_action, 'file_request_create',
+            context=context, **data_dict)
+
+        eq_(mock_request.call_count, 1)
+
+    @mock.patch.dict('pylons.config',
+                     {'ckanext.glasgow.http.retry_backoff': '0',
+                      'ckanext.glasgow.upload.retries': '1'})
+    @mock.patch('requests.Session.request')
+    def test_create_upload_is_streamed_and_retried(self, mock_request):
+        bodies = []
+
+        def read_body(method, url, **kwargs):
+            bodies.append(''.join(kwargs['data']))
+            if len(bodies) == 1:
+                return mock.Mock(status_code=503)
+            return mock.Mock(status_code=200, **{
+                'json.return_value': {'RequestId': 'req-id'},
+            })
+
+        mock_request.side_effect = read_body
+
+        upload = _get_mock_file_upload()
+        upload.file.seek(0)
+
+        data_dict = {
+            'dataset_id': self.dataset['id'],
+            'name': 'Test File name',
+            'description': 'Some longer description',
+            'format': 'application/csv',
+            'license_id': 'uk-ogl',
+            'openness_rating': 3,
+            'quality': 5,
+            'standard_name': 'Test standard name',
+            'standard_rating': 1,
+            'standard_version': 'Test standard version',
+            'creation_date': '2014-03-22T05:42:00',
+            'upload': upload,
+        }
+
+        context = {'user': self.normal_user['name']}
+        request_dict = helpers.call_action('file_request_create',
+                                           context=context,
+                                           **data_dict)
+
+        eq_(request_dict['request_id'], 'req-id')
+        eq_(mock_request.call_count, 2)
+
+        headers = mock_request.call_args[1]['headers']
+        assert headers['Content-Type'].startswith('multipart/form-data')
+
+        # The file was sent again in full after the 503 error
+        eq_(bodies[0], bodies[1])
+        assert 'File contents' in bodies[1]
+
     def test_create_with_url(self):
 
         data_dict = {
@@ -762,9 +1094,9 @@ class TestFileUpdate(object):
         helpers.reset_db()
         search.clear()
 
-    @mock.patch('requests.request')
+    @mock.patch('ckanext.glasgow.client.request')
     def test_update(self, mock_request):
-        # make the mock the result of calling requests.request(...)
+        # make the mock the result of calling client.request(...)
         mock_request.return_value = mock.Mock(
             status_code=200,
             content=json.dumps({'RequestId': 'req-id'}),
@@ -897,7 +1229,7 @@ class TestCheckForTaskStatusUpdate(object):
     def teardown_class(cls):
         helpers.reset_db()
 
-    @mock.patch('requests.request')
+    @mock.patch('ckanext.glasgow.client.request')
     def test_update(self, mock_request):
         # setup a mock response from the EC API platform
         mock_result = mock.Mock()
@@ -962,7 +1294,7 @@ class TestCheckForTaskStatusUpdate(object):
                     }
                 ]
         }
-        # make the mock the result of calling requests.request(...)
+        # make the mock the result of calling client.request(...)
         mock_request.return_value = mock_result
 
         # Create a test task_status here, that will be checked against the
@@ -1012,10 +1344,61 @@ class TestCheckForTaskStatusUpdate(object):
         dataset = helpers.call_action('package_show', 
                                       name_or_id='test_dataset')
 
+    def test_deferred_dataset_create_rolled_back_with_task(self):
+        ckan_data_dict = {
+            'name': 'test_dataset_deferred',
+            'owner_org': 'test_org',
+            'title': 'Test Dataset',
+            'notes': 'Some longer description',
+            'needs_approval': False,
+            'maintainer': 'Test maintainer',
+            'maintainer_email': 'Test maintainer email',
+            'license_id': 'OGL-UK-2.0',
+            'openness_rating': 3,
+            'quality': 5,
+            'published_on_behalf_of': 'Test published on behalf of',
+            'usage_guidance': 'Test usage guidance',
+            'category': 'Test category',
+            'theme': 'Test theme',
+            'standard_name': 'Test standard name',
+            'standard_rating': 5,
+            'standard_version': 'Test standard version',
+        }
+        task_status = helpers.call_action(
+            'task_status_update',
+            task_type='dataset_request_create',
+            entity_type='dataset',
+            entity_id='ent_2',
+            key='test_dataset_deferred',
+            value=json.dumps({
+                'request_id': 'def456',
+                'data_dict': ckan_data_dict
+            }),
+            last_updated=datetime.datetime(2000, 1, 1),
+        )
+
+        # The dataset is created on the caller's transaction, so it is not
+        # kept if the task is not saved
+        context = {'model': model, 'session': model.Session,
+                   'ignore_auth': True, 'defer_commit': True}
+        updated = apply_task_status_operation(context, task_status, {
+            'Timestamp': '3000-01-01T00:00:00',
+            'OperationState': 'Succeeded',
+            'Message': 'Done',
+        }, save=False)
+        eq_(updated['state'], 'succeeded')
+        model.Session.rollback()
+
+        nose.tools.assert_raises(
+            p.toolkit.ObjectNotFound,
+            helpers.call_action,
+            'package_show',
+            name_or_id='test_dataset_deferred')
+
 
 class TestGetChangeRequest(object):
     @mock.patch('ckanext.oauth2waad.plugin.service_to_service_access_token')
-    @mock.patch('requests.request')
+    @mock.patch('ckanext.glasgow.client.request')
     def test_update(self, mock_request, mock_token):
         mock_token.return_value = 'mock_token'
         # setup a mock response from the EC API platform
@@ -1079,7 +1462,7 @@ class TestGetChangeRequest(object):
                     ]
                 }
             ]
-        # make the mock the result of calling requests.request(...)
+        # make the mock the result of calling client.request(...)
         mock_request.return_value = mock_result
 
         result = helpers.call_action('get_change_request', id='dummy')
@@ -1103,7 +1486,7 @@ class TestGetChangeRequest(object):
         )
 
     @mock.patch('ckanext.oauth2waad.plugin.service_to_service_access_token')
-    @mock.patch('requests.request')
+    @mock.patch('ckanext.glasgow.client.request')
     def test_non_json(self, mock_request, mock_token):
         mock_token.return_value = 'mock_token'
 
@@ -1120,6 +1503,73 @@ class TestGetChangeRequest(object):
         )
 
 
+class TestGetChangeRequestCache(object):
+
+    def setup(self):
+        _change_request_cache.clear()
+        config['ckanext.glasgow.change_request_cache.ttl'] = '30'
+
+    def teardown(self):
+        _change_request_cache.clear()
+        config.pop('ckanext.glasgow.change_request_cache.ttl')
+
+    def _mock_response(self, status_code=200, operations=None):
+        mock_result = mock.Mock()
+        mock_result.status_code = status_code
+        mock_result.content = ''
+        mock_result.json.return_value = operations or [
+            {'RequestId': 'abc', 'OperationState': 'InProgress'}]
+        return mock_result
+
+    @mock.patch('ckanext.oauth2waad.plugin.service_to_service_access_token')
+    @mock.patch('ckanext.glasgow.client.request')
+    def test_cached(self, mock_request, mock_token):
+        mock_token.return_value = 'mock_token'
+        mock_request.return_value = self._mock_response()
+
+        result1 = helpers.call_action('get_change_request', id='abc')
+        result2 = helpers.call_action('get_change_request', id='abc')
+
+        eq_(result1, result2)
+        eq_(result1[0]['operation_state'], 'InProgress')
+        eq_(mock_request.call_count, 1)
+
+    @mock.patch('ckanext.oauth2waad.plugin.service_to_service_access_token')
+    @mock.patch('ckanext.glasgow.client.request')
+    def test_not_found_cached(self, mock_request, mock_token):
+        mock_token.return_value = 'mock_token'
+        mock_request.return_value = self._mock_response(status_code=404)
+
+        for i in range(2):
+            nose.tools.assert_raises(
+                ECAPIError,
+                helpers.call_action,
+                'get_change_request',
+                id='abc'
+            )
+
+        eq_(mock_request.call_count, 1)
+
+    @mock.patch('ckanext.oauth2waad.plugin.service_to_service_access_token')
+    @mock.patch('ckanext.glasgow.client.request')
+    def test_stale_returned_on_error(self, mock_request, mock_token):
+        mock_token.return_value = 'mock_token'
+        mock_request.return_value = self._mock_response()
+
+        result1 = helpers.call_action('get_change_request', id='abc')
+
+        # Expire the entry and make the EC API time out
+        config['ckanext.glasgow.change_request_cache.ttl'] = '0.001'
+        time.sleep(0.01)
+        mock_request.side_effect = requests.exceptions.Timeout
+
+        result2 = helpers.call_action('get_change_request', id='abc')
+
+        eq_(result1, result2)
+        eq_(mock_request.call_count, 2)
+        eq_(mock_request.call_args[1]['timeout'], 3.0)
+
+
 class TestChangelog(object):
 
     @classmethod
@@ -1220,7 +1670,7 @@ class TestOrganizationCreate(object):
     def teardown(cls):
         helpers.reset_db()
 
-    @mock.patch('requests.request')
+    @mock.patch('ckanext.glasgow.client.request')
     def test_organization(self, mock_request):
         mock_request.return_value = mock.Mock(
             status_code=200,
@@ -1272,7 +1722,7 @@ class TestOrganizationUpdate(object):
     def teardown(cls):
         helpers.reset_db()
 
-    @mock.patch('requests.request')
+    @mock.patch('ckanext.glasgow.client.request')
     def test_update(self, mock_request):
         mock_request.return_value = mock.Mock(
             status_code=200,
@@ -1329,7 +1779,7 @@ class TestUserRoleUpdate(object):
     def teardown(cls):
         helpers.reset_db()
 
-    @mock.patch('requests.request')
+    @mock.patch('ckanext.glasgow.client.request')
     def test_make_user_member(self, mock_request):
         '''test adding a member goes through ckan only'''
         mock_request.return_value = mock.Mock(
@@ -1360,7 +1810,7 @@ class TestUserRoleUpdate(object):
         nose.tools.assert_in(self.normal_user['id'], member_ids)
 
 
-    @mock.patch('requests.request')
+    @mock.patch('ckanext.glasgow.client.request')
     def test_making_ckan_user_into_org_editor_errors(self, mock_request):
         '''test that making user an org editor
 
@@ -1392,7 +1842,7 @@ class TestUserRoleUpdate(object):
 
 
     @mock.patch('ckan.lib.helpers.flash_success')
-    @mock.patch('requests.request')
+    @mock.patch('ckanext.glasgow.client.request')
     def test_make_ec_user_with_org_into_org_admin(self, mock_request, mock_flash):
         '''test that making user an org admin
 
@@ -1455,7 +1905,7 @@ class TestUserRoleUpdate(object):
         )
 
     @mock.patch('ckan.lib.helpers.flash_success')
-    @mock.patch('requests.request')
+    @mock.patch('ckanext.glasgow.client.request')
     def test_make_ec_user_without_org_into_an_org_admin(self, mock_request, mock_flash):
         mock_request.return_value = mock.Mock(
             status_code=200,
@@ -1509,7 +1959,7 @@ class TestUserRoleUpdate(object):
             }
         )
 
-    @mock.patch('requests.request')
+    @mock.patch('ckanext.glasgow.client.request')
     def test_making_ec_user_editor_a_member_fails(self, mock_request):
         '''test that making an org editor a member
 
@@ -1591,7 +2041,7 @@ class TestUserRoleDelete(object):
         helpers.reset_db()
 
     @mock.patch('ckan.lib.helpers.flash_success')
-    @mock.patch('requests.request')
+    @mock.patch('ckanext.glasgow.client.request')
     def test_make_user_member(self, mock_request, mock_flash):
         content =  {
             # we're cheating here as requests gets called twice
@@ -1659,7 +2109,7 @@ class TestEcUserCreate(object):
         helpers.reset_db()
 
     @mock.patch('ckanext.oauth2waad.plugin.service_to_service_access_token')
-    @mock.patch('requests.request')
+    @mock.patch('ckanext.glasgow.client.request')
     def test_make_user(self, mock_request, mock_token):
         content =  {
             'RequestId': 'requestid',
@@ -1709,7 +2159,7 @@ class TestEcUserCreate(object):
         )
 
     @mock.patch('ckanext.oauth2waad.plugin.service_to_service_access_token')
-    @mock.patch('requests.request')
+    @mock.patch('ckanext.glasgow.client.request')
     def test_make_user_in_org(self, mock_request, mock_token):
         content =  {
             'RequestId': 'requestid',
@@ -1748,3 +2198,67 @@ class TestEcUserCreate(object):
 
         nose.tools.assert_equals('requestid', json.loads(task.value)['request_id'])
         nose.tools.assert_equals('user_request_create', task.task_type)
+
+
+class TestApprovalDownload(object):
+
+    @mock.patch('ckanext.glasgow.client.request')
+    def test_stream_range(self, mock_request):
+        mock_response = mock.Mock(
+            status_code=206,
+            headers={
+                'Content-Type': 'text/csv',
+                'Content-Length': '3',
+                'Content-Range': 'bytes 0-2/10',
+            })
+        mock_response.raw.stream.return_value = iter(['a,b', ])
+        mock_request.return_value = mock_response
+
+        download = helpers.call_action('approval_download',
+                                       context={'ignore_auth': True},
+                                       request_id='req_1',
+                                       stream=True,
+                                       range='bytes=0-2')
+
+        eq_(download['status'], 206)
+        eq_(download['headers']['Content-Range'], 'bytes 0-2/10')
+        eq_(list(download['content']), ['a,b'])
+
+        headers = mock_request.call_args[1]['headers']
+        eq_(headers['Range'], 'bytes=0-2')
+        eq_(headers['Accept-Encoding'], 'identity')
+        eq_(mock_request.call_args[1]['stream'], True)
+        assert mock_response.close.called
+
+    @mock.patch('ckanext.glasgow.client.request')
+    def test_error(self, mock_request):
+        mock_request.return_value = mock.Mock(
+            status_code=416,
+            content='Requested Range Not Satisfiable',
+            **{'json.side_effect': ValueError})
+
+        nose.tools.assert_raises(
+            p.toolkit.ValidationError,
+            helpers.call_action,
+            'approval_download',
+            context={'ignore_auth': True},
+            request_id='req_1',
+            stream=True,
+            range='bytes=100-200')
+
+    @mock.patch('ckanext.glasgow.tokens.invalidate')
+    @mock.patch('ckanext.glasgow.client.request')
+    def test_not_authorized_clears_cached_tokens(self, mock_request,
+                                                 mock_invalidate):
+        mock_request.return_value = mock.Mock(
+            status_code=401, content='Unauthorized',
+            **{'json.return_value': {}})
+
+        nose.tools.assert_raises(
+            ECAPINotAuthorized,
+            helpers.call_action,
+            'approval_download',
+            context={'ignore_auth': True},
+            request_id='req_1')
+
+        mock_invalidate.assert_called_once_with()
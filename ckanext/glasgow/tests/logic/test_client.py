@@ -0,0 +1,232 @@
+import mock
+import nose
+
+import requests
+from pylons import config
+
+from ckanext.glasgow import client, metrics
+
+
+eq_ = nose.tools.eq_
+
+
+class TestClient(object):
+
+    def setup(self):
+        client.reset()
+
+    def teardown(self):
+        client.reset()
+
+    def test_session_shared_per_host(self):
+        session1 = client.get_session('http://data.api:8080/Datasets')
+        session2 = client.get_session('http://data.api:8080/Files/1')
+
+        assert session1 is session2
+
+    def test_session_per_host(self):
+        session1 = client.get_session('http://data.api:8080/Datasets')
+        session2 = client.get_session('http://metadata.api:8081/Metadata')
+
+        assert session1 is not session2
+
+    @mock.patch('requests.Session.request')
+    def test_default_timeout(self, mock_request):
+        config['ckanext.glasgow.http.connect_timeout'] = '5'
+        config['ckanext.glasgow.http.timeout'] = '20'
+
+        try:
+            client.get('http://metadata.api:8081/Metadata')
+        finally:
+            config.pop('ckanext.glasgow.http.connect_timeout')
+            config.pop('ckanext.glasgow.http.timeout')
+
+        eq_(mock_request.call_args[1]['timeout'], (5.0, 20.0))
+
+    @mock.patch('requests.Session.request')
+    def test_explicit_timeout(self, mock_request):
+        client.request('POST', 'http://data.api:8080/Datasets', timeout=50)
+
+        eq_(mock_request.call_args[1]['timeout'], 50)
+
+
+class TestRetries(object):
+
+    def setup(self):
+        client.reset()
+
+    def teardown(self):
+        client.reset()
+
+    @mock.patch('ckanext.glasgow.client.time.sleep')
+    @mock.patch('requests.Session.request')
+    def test_idempotent_requests_are_retried(self, mock_request, mock_sleep):
+        mock_request.side_effect = [
+            requests.exceptions.ConnectionError('Connection refused'),
+            mock.Mock(status_code=503),
+            mock.Mock(status_code=200),
+        ]
+
+        with mock.patch.dict('pylons.config', {
+                'ckanext.glasgow.http.retries': '2',
+                'ckanext.glasgow.http.retry_backoff': '0.5'}):
+            response = client.get('http://metadata.api:8081/Metadata')
+
+        eq_(response.status_code, 200)
+        eq_(mock_request.call_count, 3)
+        eq_([c[0][0] for c in mock_sleep.call_args_list], [0.5, 1.0])
+
+    @mock.patch('ckanext.glasgow.client.time.sleep')
+    @mock.patch('requests.Session.request')
+    def test_last_error_is_returned(self, mock_request, mock_sleep):
+        mock_request.return_value = mock.Mock(status_code=503)
+
+        with mock.patch.dict('pylons.config', {
+                'ckanext.glasgow.http.retries': '1'}):
+            response = client.get('http://metadata.api:8081/Metadata')
+
+        eq_(response.status_code, 503)
+        eq_(mock_request.call_count, 2)
+
+    @mock.patch('ckanext.glasgow.client.time.sleep')
+    @mock.patch('requests.Session.request')
+    def test_other_methods_are_not_retried(self, mock_request, mock_sleep):
+        mock_request.side_effect = requests.exceptions.Timeout('Timeout')
+
+        with mock.patch.dict('pylons.config', {
+                'ckanext.glasgow.http.retries': '2'}):
+            nose.tools.assert_raises(
+                requests.exceptions.Timeout,
+                client.request, 'POST', 'http://data.api:8080/Datasets')
+
+        eq_(mock_request.call_count, 1)
+
+    @mock.patch('ckanext.glasgow.client.time.sleep')
+    @mock.patch('requests.Session.request')
+    def test_explicit_retries_rewind_body(self, mock_request, mock_sleep):
+        mock_request.side_effect = [
+            mock.Mock(status_code=502),
+            mock.Mock(status_code=200),
+        ]
+        body = mock.Mock()
+
+        response = client.request('POST', 'http://data.api:8080/Files',
+                                  data=body, retries=1)
+
+        eq_(response.status_code, 200)
+        eq_(body.rewind.call_count, 1)
+
+
+class TestCircuitBreaker(object):
+
+    def setup(self):
+        client.reset()
+
+    def teardown(self):
+        client.reset()
+
+    @mock.patch('requests.Session.request')
+    def test_circuit_opens_after_failures(self, mock_request):
+        mock_request.side_effect = requests.exceptions.ConnectionError(
+            'Connection refused')
+        url = 'http://metadata.api:8081/Metadata'
+
+        with mock.patch.dict('pylons.config', {
+                'ckanext.glasgow.http.retries': '0',
+                'ckanext.glasgow.http.circuit_breaker.failures': '3'}):
+            for i in range(3):
+                nose.tools.assert_raises(
+                    requests.exceptions.ConnectionError, client.get, url)
+
+            assert not client.is_available(url)
+            assert not client.is_available()
+            eq_(client.get_circuit_states()['http://metadata.api:8081']
+                ['state'], 'open')
+
+            # Fails straight away
+            nose.tools.assert_raises(client.CircuitOpenError, client.get, url)
+            eq_(mock_request.call_count, 3)
+
+            # Other hosts are not affected
+            assert client.is_available('http://data.api:8080/Datasets')
+
+    def test_half_open_trial_request(self):
+        breaker = client.CircuitBreaker(failures=2, reset_timeout=30)
+
+        breaker.record_failure()
+        breaker.before_request()
+        breaker.record_failure()
+        eq_(breaker.state, 'open')
+        nose.tools.assert_raises(client.CircuitOpenError,
+                                 breaker.before_request)
+
+        breaker.opened -= 30
+        eq_(breaker.state, 'half_open')
+
+        # Only one trial request is allowed
+        breaker.before_request()
+        nose.tools.assert_raises(client.CircuitOpenError,
+                                 breaker.before_request)
+
+        # A failed trial opens the circuit again
+        breaker.record_failure()
+        eq_(breaker.state, 'open')
+
+        breaker.opened -= 30
+        breaker.before_request()
+        breaker.record_success()
+        eq_(breaker.state, 'closed')
+        eq_(breaker.consecutive_failures, 0)
+
+    def test_disabled(self):
+        breaker = client.CircuitBreaker(failures=0)
+
+        for i in range(10):
+            breaker.record_failure()
+
+        eq_(breaker.state, 'closed')
+
+
+class TestClientMetrics(object):
+
+    def setup(self):
+        client.reset()
+        metrics.reset()
+
+    def teardown(self):
+        client.reset()
+        metrics.reset()
+
+    @mock.patch('ckanext.glasgow.client.time.sleep')
+    @mock.patch('requests.Session.request')
+    def test_requests_are_recorded(self, mock_request, mock_sleep):
+        response = requests.Response()
+        response.status_code = 200
+        response._content = '{"Id": 1}'
+        mock_request.side_effect = [
+            requests.exceptions.Timeout('Timeout'),
+            response,
+        ]
+
+        with mock.patch.dict('pylons.config', {
+                'ckanext.glasgow.http.retries': '1'}):
+            client.get('http://metadata.api:8081/Metadata/Organisation/1')
+
+        result = metrics.get_metrics()['organization_show']
+        eq_(result['count'], 1)
+        eq_(result['retries'], 1)
+        eq_(result['status_codes'], {'200': 1})
+        eq_(result['bytes_received'], len('{"Id": 1}'))
+
+    @mock.patch('requests.Session.request')
+    def test_errors_are_recorded(self, mock_request):
+        mock_request.side_effect = requests.exceptions.ConnectionError()
+
+        nose.tools.assert_raises(
+            requests.exceptions.ConnectionError,
+            client.request, 'POST', 'http://data.api:8080/Organisations',
+            data='{"Title": "Test"}')
+
+        result = metrics.get_metrics()['organization_request_create']
+        eq_(result['status_codes'], {'error': 1})
+        eq_(result['bytes_sent'], len('{"Title": "Test"}'))
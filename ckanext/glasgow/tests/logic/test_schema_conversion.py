@@ -395,3 +395,44 @@ class TestSchemaConversion(object):
         eq_(ckan_dict['id'], 'org-id')
         eq_(ckan_dict['title'], 'Test Org')
         eq_(ckan_dict['description'], 'Some longer description')
+
+    def test_convert_ec_datasets_to_ckan_datasets(self):
+
+        ec_dicts = [
+            {'Id': 1, 'Title': 'Test Dataset 1', 'Tags': 'a,b'},
+            {'Id': 2, 'Title': 'Test Dataset 2', 'Custom': 'value'},
+        ]
+
+        ckan_dicts = custom_schema.convert_ec_datasets_to_ckan_datasets(
+            ec_dicts)
+
+        eq_(ckan_dicts, [custom_schema.convert_ec_dataset_to_ckan_dataset(d)
+                         for d in ec_dicts])
+        eq_(ckan_dicts[0]['id'], u'1')
+        eq_(ckan_dicts[0]['tags'], [{'name': 'a'}, {'name': 'b'}])
+        eq_(ckan_dicts[0]['extras'], [])
+        eq_(ckan_dicts[1]['extras'], [{'key': 'Custom', 'value': 'value'}])
+
+    def test_convert_ec_files_to_ckan_resources(self):
+
+        ec_dicts = [
+            {'FileId': 1, 'Title': 'Test File 1', 'Custom': 'value'},
+            {'FileId': 2, 'Title': 'Test File 2'},
+        ]
+
+        ckan_dicts = custom_schema.convert_ec_files_to_ckan_resources(
+            ec_dicts)
+
+        eq_(ckan_dicts, [
+            {'id': 1, 'name': 'Test File 1', 'Custom': 'value'},
+            {'id': 2, 'name': 'Test File 2'},
+        ])
+
+    def test_field_mapping(self):
+
+        mapping = custom_schema.FieldMapping(
+            {'id': 'Id', 'tags': 'Tags'}, exclude=('tags',))
+
+        eq_(mapping.fields, (('id', 'Id'),))
+        eq_(mapping.ec_keys, frozenset(['Id', 'Tags']))
+        eq_(mapping.ec_to_ckan, {'Id': 'id', 'Tags': 'tags'})
@@ -0,0 +1,114 @@
+import base64
+import json
+import os
+import tempfile
+import threading
+import time
+
+import mock
+import nose
+
+from pylons import config
+
+from ckanext.glasgow import tokens
+
+
+eq_ = nose.tools.eq_
+
+
+def _jwt(claims):
+    payload = base64.urlsafe_b64encode(json.dumps(claims)).rstrip('=')
+    return 'header.{0}.signature'.format(payload)
+
+
+class TestTokens(object):
+
+    def setup(self):
+        tokens.invalidate()
+        config['ckanext.glasgow.auth_token.cache'] = 'true'
+
+    def teardown(self):
+        tokens.invalidate()
+        config.pop('ckanext.glasgow.auth_token.cache')
+
+    def test_token_expiry(self):
+        eq_(tokens.get_token_expiry(_jwt({'exp': 1400000000})), 1400000000)
+        eq_(tokens.get_token_expiry(
+            'Bearer ' + _jwt({'exp': 1400000000})), 1400000000)
+
+    def test_token_expiry_not_jwt(self):
+        eq_(tokens.get_token_expiry('tmp_auth_token'), None)
+        eq_(tokens.get_token_expiry(_jwt({'aud': 'metadata'})), None)
+
+    def test_token_cached(self):
+        fetch = mock.Mock(return_value='token1')
+
+        eq_(tokens.get_token('metadata', fetch), 'token1')
+        eq_(tokens.get_token('metadata', fetch), 'token1')
+
+        eq_(fetch.call_count, 1)
+
+    def test_token_cached_per_key(self):
+        eq_(tokens.get_token('metadata', lambda: 'token1'), 'token1')
+        eq_(tokens.get_token('identity', lambda: 'token2'), 'token2')
+
+    def test_token_refreshed_before_expiry(self):
+        # Expires within the refresh margin
+        token = _jwt({'exp': time.time() + 30})
+        fetch = mock.Mock(return_value=token)
+
+        tokens.get_token('metadata', fetch)
+        tokens.get_token('metadata', fetch)
+
+        eq_(fetch.call_count, 2)
+
+    def test_token_error_not_cached(self):
+        fetch = mock.Mock(side_effect=[ValueError, 'token1'])
+
+        nose.tools.assert_raises(ValueError, tokens.get_token,
+                                 'metadata', fetch)
+        eq_(tokens.get_token('metadata', fetch), 'token1')
+
+    def test_concurrent_callers_share_refresh(self):
+        def fetch():
+            time.sleep(0.1)
+            return 'token1'
+        fetch = mock.Mock(side_effect=fetch)
+
+        threads = [threading.Thread(target=tokens.get_token,
+                                    args=('metadata', fetch))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        eq_(fetch.call_count, 1)
+
+    @mock.patch('ckanext.oauth2waad.plugin.service_to_service_access_token')
+    def test_service_to_service_access_token(self, mock_token):
+        mock_token.return_value = 'token1'
+
+        eq_(tokens.service_to_service_access_token('metadata'), 'token1')
+        eq_(tokens.service_to_service_access_token('metadata'), 'token1')
+
+        mock_token.assert_called_once_with('metadata')
+
+    def test_tmp_auth_token_invalidate(self):
+        f = tempfile.NamedTemporaryFile(delete=False)
+        f.write('Bearer token1\n')
+        f.close()
+
+        try:
+            eq_(tokens.tmp_auth_token(f.name), 'Bearer token1')
+
+            with open(f.name, 'w') as token_file:
+                token_file.write('Bearer token2')
+
+            # Cached until invalidated
+            eq_(tokens.tmp_auth_token(f.name), 'Bearer token1')
+
+            tokens.invalidate(('tmp_auth_token_file', f.name))
+            eq_(tokens.tmp_auth_token(f.name), 'Bearer token2')
+        finally:
+            os.remove(f.name)
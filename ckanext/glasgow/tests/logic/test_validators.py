@@ -9,7 +9,8 @@ import ckan.new_tests.helpers as helpers
 
 from ckanext.glasgow.logic import validators
 from ckanext.glasgow.logic.action import (
-    _create_task_status,
+    _new_task_status,
+    _save_task_statuses,
 )
 
 
@@ -19,6 +20,13 @@ from ckan.lib.navl.dictization_functions import validate
 eq_ = nose.tools.eq_
 
 
+def _save_new_task_status(context, task_type, entity_id, entity_type, key,
+                          value):
+    task_dict = _new_task_status(task_type, entity_id, entity_type, key)
+    task_dict['value'] = value
+    return _save_task_statuses(context, [task_dict])[0]
+
+
 class TestValidators(object):
 
     def test_string_max_length_valid(self):
@@ -320,13 +328,13 @@ class TestPendingNameValidators(object):
 
     def test_no_pending_dataset_with_same_name_invalid(self):
 
-        task_dict = _create_task_status({'user': 'test'},
-                                        task_type='test_task_type',
-                                        entity_id='test_dataset_id',
-                                        entity_type='dataset',
-                                        key='test_dataset_name',
-                                        value='test_value'
-                                        )
+        task_dict = _save_new_task_status({'user': 'test'},
+                                          task_type='test_task_type',
+                                          entity_id='test_dataset_id',
+                                          entity_type='dataset',
+                                          key='test_dataset_name',
+                                          value='test_value'
+                                          )
 
         value = 'test_dataset_name'
         context = {}
@@ -357,12 +365,12 @@ class TestPendingTitleValidators(object):
 
         data = {'data_dict': {'title': 'Test Title', 'owner_org': 'test_org'}}
 
-        _create_task_status({'user': 'test'},
-                            task_type='test_task_type',
-                            entity_id='test_dataset_id',
-                            entity_type='dataset',
-                            key='test_dataset_name',
-                            value=json.dumps(data)
+        _save_new_task_status({'user': 'test'},
+                              task_type='test_task_type',
+                              entity_id='test_dataset_id',
+                              entity_type='dataset',
+                              key='test_dataset_name',
+                              value=json.dumps(data)
                             )
 
         key = ('title',)
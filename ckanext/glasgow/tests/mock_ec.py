@@ -1,4 +1,7 @@
 import logging
+import random
+import threading
+import time
 import uuid
 import json
 
@@ -38,6 +41,176 @@ def make_json_app(import_name, **kwargs):
 
 app = make_json_app(__name__)
 
+# Synthetic catalogue to serve instead of the fixed responses below (see
+# `ckanext.glasgow.tests.benchmark.Catalogue`)
+catalogue = None
+
+
+def _result_set(records, status_code=200):
+    response = flask.jsonify(**{
+        "MetadataResultSet": records,
+        "ErrorMessage": None,
+        "IsErrorResponse": False,
+        "IsRetryRequested": False
+        }
+    )
+    response.status_code = status_code
+    return response
+
+
+def _catalogue_page(records):
+    skip = int(flask.request.args.get('$skip', 0))
+    return _result_set(records[skip:skip + catalogue.page_size])
+
+
+class Fault(object):
+    '''
+    Faults to inject on the responses of a mock EC API route
+
+    :param delay: seconds to wait before answering, or a `(min, max)` pair
+                  for a random delay between both
+    :param error_rate: share of requests (between 0 and 1) answered with
+                       `error_status` instead of the actual response
+    :param error_status: status code of the injected errors (default 503)
+    :param unauthorized_rate: share of requests answered with a 401, as if
+                              the access token had expired
+    :param truncate_rate: share of responses whose body is cut in half,
+                          leaving invalid JSON
+    :param chunk_size: if set, bodies are streamed in chunks of this many
+                       bytes, waiting `chunk_delay` seconds before each one
+    :param chunk_delay: seconds to wait before sending each chunk
+    :param seed: seed for the random generator, to get the same faults on
+                 every run
+    '''
+
+    def __init__(self, delay=0, error_rate=0, error_status=503,
+                 unauthorized_rate=0, truncate_rate=0, chunk_size=None,
+                 chunk_delay=0, seed=None):
+        self.delay = delay
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.unauthorized_rate = unauthorized_rate
+        self.truncate_rate = truncate_rate
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.injected = {
+            'delay': 0,
+            'error': 0,
+            'unauthorized': 0,
+            'truncated': 0,
+            'slow_body': 0,
+        }
+
+    def _happens(self, rate):
+        with self._lock:
+            return rate and self._random.random() < rate
+
+    def _count(self, fault):
+        with self._lock:
+            self.injected[fault] += 1
+
+    def get_delay(self):
+        if isinstance(self.delay, (list, tuple)):
+            with self._lock:
+                return self._random.uniform(*self.delay)
+        return self.delay
+
+    def before_request(self):
+        '''
+        Waits for the delay, and returns an error response if one is due
+        '''
+        delay = self.get_delay()
+        if delay:
+            self._count('delay')
+            time.sleep(delay)
+
+        if self._happens(self.unauthorized_rate):
+            self._count('unauthorized')
+            response = flask.jsonify(Message='Not Auhtorized')
+            response.status_code = 401
+            return response
+
+        if self._happens(self.error_rate):
+            self._count('error')
+            response = flask.jsonify(
+                Message='Injected error',
+                IsErrorResponse=True,
+            )
+            response.status_code = self.error_status
+            return response
+
+    def after_request(self, response):
+        '''
+        Truncates or slows down the body of the response
+        '''
+        if response.status_code >= 400:
+            return response
+
+        data = response.get_data()
+
+        if self._happens(self.truncate_rate):
+            self._count('truncated')
+            data = data[:len(data) / 2]
+            response.set_data(data)
+
+        if self.chunk_size:
+            self._count('slow_body')
+            chunk_size = self.chunk_size
+            chunk_delay = self.chunk_delay
+
+            def slow_body():
+                for i in range(0, len(data), chunk_size):
+                    time.sleep(chunk_delay)
+                    yield data[i:i + chunk_size]
+
+            response.response = slow_body()
+            response.headers['Content-Length'] = str(len(data))
+
+        return response
+
+
+# Faults to inject, keyed by the name of the route function (eg
+# `request_changelog`), or `*` for all routes
+faults = {}
+
+
+def set_fault(route='*', **kwargs):
+    '''
+    Injects faults on a route, see :py:class:`Fault` for the options
+
+    :param route: name of the route function, or `*` for all of them
+    :returns: the new :py:class:`Fault`, which keeps the number of faults
+              injected in `injected`
+    '''
+    fault = faults[route] = Fault(**kwargs)
+    return fault
+
+
+def clear_faults():
+    faults.clear()
+
+
+def _get_fault():
+    return faults.get(flask.request.endpoint) or faults.get('*')
+
+
+@app.before_request
+def inject_request_faults():
+    fault = _get_fault()
+    if fault:
+        return fault.before_request()
+
+
+@app.after_request
+def inject_response_faults(response):
+    fault = _get_fault()
+    if fault:
+        response = fault.after_request(response)
+    return response
+
 dataset_all_fields = [
     'Category',
     'Description',
@@ -166,6 +339,9 @@ def request_file_update(organization_id, dataset_id):
 
 @app.route('/Organisations/<org_id>/Datasets', methods=['GET'])
 def request_datasets(org_id):
+    if catalogue is not None:
+        return _catalogue_page(catalogue.datasets.get(org_id, []))
+
     skip = int(flask.request.args.get('$skip', 0))
     metadata_result_set = {
         '4': [
@@ -256,6 +432,12 @@ def request_datasets(org_id):
 @app.route('/Metadata/Organisation/<org_id>/Dataset/<dataset_id>/File',
            methods=['GET'])
 def request_files(org_id, dataset_id):
+    if catalogue is not None:
+        files = catalogue.files.get((org_id, dataset_id))
+        if files is None:
+            flask.abort(404)
+        return _result_set(files)
+
     skip = int(flask.request.args.get('$skip', 0))
     metadata_result_set =  {
         ('1', '3'): [
@@ -324,6 +506,9 @@ def request_files(org_id, dataset_id):
 
 @app.route('/Metadata/Organisation', methods=['GET'])
 def request_orgs():
+    if catalogue is not None:
+        return _catalogue_page(catalogue.organizations)
+
     skip = int(flask.request.args.get('$skip', 0))
     metadata_result_set = [
         {
@@ -354,9 +539,41 @@ def request_orgs():
         }
     )
 
+@app.route('/Metadata/Organisation/<org_id>', methods=['GET'])
+def request_org(org_id):
+    org = catalogue.get_organization(org_id) if catalogue else None
+    if not org:
+        flask.abort(404)
+    return _result_set([org])
+
+
+@app.route('/Metadata/Organisation/<org_id>/Dataset/<dataset_id>',
+           methods=['GET'])
+def request_dataset(org_id, dataset_id):
+    dataset = (catalogue.get_dataset(org_id, dataset_id) if catalogue
+               else None)
+    if not dataset:
+        flask.abort(404)
+    return _result_set(dataset)
+
+
+@app.route('/Metadata/Organisation/<org_id>/Dataset/<dataset_id>/File/<file_id>/Version/<version_id>',
+           methods=['GET'])
+def request_file_version(org_id, dataset_id, file_id, version_id):
+    version = (catalogue.get_file_version(org_id, dataset_id, file_id,
+                                          version_id) if catalogue else None)
+    if not version:
+        flask.abort(404)
+    return _result_set(version)
+
+
 @app.route('/Metadata/Organisation/<org_id>/Dataset/<dataset_id>/File/<file_id>/Versions',
            methods=['GET'])
 def file_versions(org_id, dataset_id, file_id):
+    if catalogue is not None:
+        return _catalogue_page(catalogue.file_versions.get(
+            (org_id, dataset_id, file_id), []))
+
     skip = int(flask.request.args.get('$skip', 0))
     metadata_result_set = {
         ('1', '1', '1'): [
@@ -457,6 +674,15 @@ def request_change_status(request_id):
 @app.route('/ChangeLog/RequestChanges')
 @app.route('/ChangeLog/RequestChanges/<audit_id>')
 def request_changelog(audit_id=None):
+    if catalogue is not None:
+        audits = catalogue.get_audits(
+            audit_id, int(flask.request.args.get('$top', 1000)),
+            flask.request.args.get('$ObjectType'))
+        return flask.Response(json.dumps(audits),
+                              headers={
+                              'Content-type': 'application/json'
+                              })
+
 
     # Authorization
 
@@ -533,7 +759,7 @@ def request_changelog(audit_id=None):
 
     if audit_id:
         for index, audit in enumerate(response):
-            if audit['AuditId'] == audit_id:
+            if str(audit['AuditId']) == audit_id:
                 response = response[index:]
 
     if object_type:
@@ -739,5 +965,26 @@ def run(**kwargs):
     app.run(**kwargs)
 
 
+def load_faults(path):
+    '''
+    Sets the faults defined in a JSON file
+
+    The file contains an object with the route names (or `*`) as keys and
+    the :py:class:`Fault` options as values, eg:
+
+        {
+            "*": {"delay": [0.05, 0.5]},
+            "request_changelog": {"error_rate": 0.1, "truncate_rate": 0.05}
+        }
+    '''
+    with open(path) as f:
+        for route, options in json.load(f).iteritems():
+            set_fault(route, **dict(
+                (str(key), value) for key, value in options.iteritems()))
+
+
 if __name__ == '__main__':
-    run(port=7070, debug=True)
+    import sys
+    if len(sys.argv) > 1:
+        load_faults(sys.argv[1])
+    run(port=7070, debug=True, threaded=True)
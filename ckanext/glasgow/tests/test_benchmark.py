@@ -0,0 +1,118 @@
+import json
+
+import nose
+
+from ckanext.glasgow.tests import mock_ec
+from ckanext.glasgow.tests.benchmark import Catalogue
+
+
+eq_ = nose.tools.eq_
+
+
+class TestCatalogue(object):
+
+    def test_size(self):
+        catalogue = Catalogue(organizations=3, datasets=4, files=2,
+                              versions=3, audits=25)
+
+        eq_(len(catalogue.organizations), 3)
+        eq_(sum(len(d) for d in catalogue.datasets.values()), 12)
+        eq_(sum(len(f) for f in catalogue.files.values()), 24)
+        eq_(sum(len(v) for v in catalogue.file_versions.values()), 72)
+        eq_(len(catalogue.audits), 25)
+
+    def test_same_seed_same_catalogue(self):
+        first = Catalogue(organizations=2, datasets=3, audits=10, seed=4)
+        second = Catalogue(organizations=2, datasets=3, audits=10, seed=4)
+        other = Catalogue(organizations=2, datasets=3, audits=10, seed=5)
+
+        eq_(first.audits, second.audits)
+        eq_(first.file_versions, second.file_versions)
+        assert first.audits != other.audits
+
+    def test_files_are_latest_versions(self):
+        catalogue = Catalogue(organizations=1, datasets=2, files=2,
+                              versions=3)
+
+        for (org_id, dataset_id), files in catalogue.files.iteritems():
+            for file_dict in files:
+                versions = catalogue.file_versions[
+                    (org_id, dataset_id, file_dict['FileId'])]
+                eq_(file_dict, versions[-1])
+
+    def test_audits_reference_existing_objects(self):
+        catalogue = Catalogue(organizations=3, datasets=2, audits=50)
+
+        for audit in catalogue.audits:
+            props = audit['CustomProperties']
+            org_id = props['OrganisationId']
+            assert catalogue.get_organization(org_id)
+            if 'DataSetId' in props:
+                assert catalogue.get_dataset(org_id, props['DataSetId'])
+            if 'FileId' in props:
+                assert catalogue.get_file_version(
+                    org_id, props['DataSetId'], props['FileId'],
+                    props['VersionId'])
+
+    def test_audits_without_datasets(self):
+        catalogue = Catalogue(organizations=2, datasets=0, audits=10)
+
+        for audit in catalogue.audits:
+            eq_(audit['Command'], 'UpdateOrganisation')
+            eq_(audit['ObjectType'], 'Organisation')
+
+    def test_get_audits(self):
+        catalogue = Catalogue(organizations=2, datasets=2, audits=20)
+
+        eq_(len(catalogue.get_audits()), 20)
+        eq_([a['AuditId'] for a in catalogue.get_audits('5', top=3)],
+            [5, 6, 7])
+        eq_(catalogue.get_audits('21'), [])
+
+        files = catalogue.get_audits(object_type='File')
+        assert all(a['ObjectType'] == 'File' for a in files)
+
+
+class TestMockEcCatalogue(object):
+
+    def setup(self):
+        self.catalogue = Catalogue(organizations=2, datasets=3, files=2,
+                                   audits=10, page_size=2)
+        mock_ec.catalogue = self.catalogue
+        self.app = mock_ec.app.test_client()
+
+    def teardown(self):
+        mock_ec.catalogue = None
+
+    def test_organizations_are_paged(self):
+        response = self.app.get('/Metadata/Organisation')
+        eq_(len(json.loads(response.data)['MetadataResultSet']), 2)
+
+        response = self.app.get('/Metadata/Organisation?$skip=2')
+        eq_(json.loads(response.data)['MetadataResultSet'], [])
+
+    def test_datasets(self):
+        response = self.app.get('/Organisations/1/Datasets?$skip=2')
+        datasets = json.loads(response.data)['MetadataResultSet']
+
+        eq_(datasets, self.catalogue.datasets['1'][2:])
+
+    def test_file_version(self):
+        version = self.catalogue.file_versions.values()[0][0]
+        url = ('/Metadata/Organisation/{0}/Dataset/{1}/File/{2}/'
+               'Version/{3}'.format(version['OrganisationId'],
+                                    version['DataSetId'], version['FileId'],
+                                    version['Version']))
+
+        response = self.app.get(url)
+        eq_(json.loads(response.data)['MetadataResultSet'], version)
+
+    def test_missing_objects(self):
+        eq_(self.app.get('/Metadata/Organisation/10').status_code, 404)
+        eq_(self.app.get(
+            '/Metadata/Organisation/1/Dataset/1000/File').status_code, 404)
+
+    def test_changelog(self):
+        response = self.app.get('/ChangeLog/RequestChanges/3?$top=4')
+
+        eq_([a['AuditId'] for a in json.loads(response.data)], [3, 4, 5, 6])
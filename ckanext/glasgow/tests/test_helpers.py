@@ -0,0 +1,52 @@
+import mock
+import nose
+
+import ckanext.glasgow.helpers as custom_helpers
+
+
+eq_ = nose.tools.eq_
+
+
+class TestHelpers(object):
+
+    def test_cached_for_request(self):
+        tmpl_context = mock.Mock(_glasgow_helpers_cache='')
+        function = mock.Mock(__name__='function', return_value=['result'])
+        cached_function = custom_helpers.cached_for_request()(function)
+
+        with mock.patch('ckan.plugins.toolkit.c', tmpl_context):
+            eq_(cached_function('a'), ['result'])
+            eq_(cached_function('a'), ['result'])
+            eq_(cached_function('b'), ['result'])
+
+        eq_(function.call_args_list, [mock.call('a'), mock.call('b')])
+
+    def test_cached_for_request_key(self):
+        tmpl_context = mock.Mock(_glasgow_helpers_cache='')
+        function = mock.Mock(__name__='function', return_value=['result'])
+        cached_function = custom_helpers.cached_for_request(
+            lambda pkg_dict: pkg_dict['name'])(function)
+
+        with mock.patch('ckan.plugins.toolkit.c', tmpl_context):
+            cached_function({'name': 'test-dataset'})
+            cached_function({'name': 'test-dataset', 'title': 'Test'})
+
+        eq_(function.call_count, 1)
+
+    def test_cached_for_request_no_request(self):
+        function = mock.Mock(__name__='function', return_value=['result'])
+        cached_function = custom_helpers.cached_for_request()(function)
+
+        cached_function('a')
+        cached_function('a')
+
+        eq_(function.call_count, 2)
+
+    def test_resource_ec_extra_fields(self):
+        extra_fields = custom_helpers.get_resource_ec_extra_fields({
+            'name': 'Test file',
+            'FileName': 'test.csv',
+            'FileVersion': '1',
+        })
+
+        eq_(extra_fields, [{'key': 'FileVersion', 'value': '1'}])
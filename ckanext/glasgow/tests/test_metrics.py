@@ -0,0 +1,97 @@
+import mock
+import nose
+
+from ckanext.glasgow import metrics
+
+
+eq_ = nose.tools.eq_
+
+
+class TestGetOperation(object):
+
+    def test_operations(self):
+        base = 'https://ec.api:8080/'
+        for method, path, operation in (
+            ('GET', 'ChangeLog/RequestChanges/1234?$top=100', 'changelog_show'),
+            ('POST', 'Datasets/Organisation/1', 'dataset_request_create'),
+            ('PUT', 'Datasets/Organisation/1/Dataset/2',
+             'dataset_request_update'),
+            ('GET', 'Metadata/Organisation/1/Dataset/2', 'dataset_show'),
+            ('GET', 'Metadata/Organisation/1/Dataset/2/File',
+             'file_list_for_dataset'),
+            ('GET', 'Metadata/Organisation/1/Dataset/2/File/3/Versions',
+             'file_versions_show'),
+            ('PUT', 'Files/Organisation/1/Dataset/2/File/3/Version/4',
+             'file_version_request_update'),
+            ('DELETE', 'Files/Organisation/1/Dataset/2/File/3/Version/4',
+             'file_version_request_delete'),
+            ('PUT', 'UserRoles/User/5', 'user_role_update'),
+            ('GET', 'Approval/6/Download', 'approval_download'),
+            ('GET', 'Some/Other/Path', 'unknown'),
+            ('POST', 'Metadata/Organisation/1', 'unknown'),
+        ):
+            eq_(metrics.get_operation(method, base + path), operation)
+
+
+class TestMetrics(object):
+
+    def setup(self):
+        metrics.reset()
+
+    def teardown(self):
+        metrics.reset()
+
+    def test_record(self):
+        metrics.record('dataset_show', 0.2, 200, bytes_received=100)
+        metrics.record('dataset_show', 3, 503, retries=2)
+        metrics.record('dataset_request_create', 0.01, 'error',
+                       bytes_sent=50)
+
+        result = metrics.get_metrics()
+
+        dataset_show = result['dataset_show']
+        eq_(dataset_show['count'], 2)
+        eq_(dataset_show['retries'], 2)
+        eq_(dataset_show['bytes_received'], 100)
+        nose.tools.assert_almost_equal(dataset_show['latency_sum'], 3.2)
+        eq_(dataset_show['status_codes'], {'200': 1, '503': 1})
+        eq_(dataset_show['latency_buckets']['0.1'], 0)
+        eq_(dataset_show['latency_buckets']['0.25'], 1)
+        eq_(dataset_show['latency_buckets']['5.0'], 2)
+        eq_(dataset_show['latency_buckets']['+Inf'], 2)
+
+        eq_(result['dataset_request_create']['status_codes'], {'error': 1})
+        eq_(result['dataset_request_create']['bytes_sent'], 50)
+
+    def test_prometheus(self):
+        metrics.record('dataset_show', 0.2, 200)
+        metrics.record('dataset_show', 120, 504)
+
+        text = metrics.to_prometheus()
+
+        for line in (
+            'ckanext_glasgow_ec_api_requests_total'
+            '{operation="dataset_show",status="200"} 1',
+            'ckanext_glasgow_ec_api_requests_total'
+            '{operation="dataset_show",status="504"} 1',
+            'ckanext_glasgow_ec_api_request_duration_seconds_bucket'
+            '{operation="dataset_show",le="0.25"} 1',
+            'ckanext_glasgow_ec_api_request_duration_seconds_bucket'
+            '{operation="dataset_show",le="+Inf"} 2',
+            'ckanext_glasgow_ec_api_request_duration_seconds_count'
+            '{operation="dataset_show"} 2',
+            '# TYPE ckanext_glasgow_ec_api_request_duration_seconds '
+            'histogram',
+        ):
+            assert line in text.split('\n'), line
+
+    @mock.patch('ckanext.glasgow.metrics.socket.socket')
+    def test_statsd(self, mock_socket):
+        with mock.patch.dict('pylons.config', {
+                'ckanext.glasgow.metrics.statsd_host': 'statsd.host'}):
+            metrics.record('dataset_show', 0.2, 200)
+
+        packet, address = mock_socket.return_value.sendto.call_args[0]
+        eq_(address, ('statsd.host', 8125))
+        assert 'ckanext.glasgow.ec_api.dataset_show.latency:200|ms' in packet
+        assert 'ckanext.glasgow.ec_api.dataset_show.status.200:1|c' in packet
@@ -0,0 +1,160 @@
+import json
+import os
+import tempfile
+
+import mock
+import nose
+from pylons import config
+
+from ckan.plugins import toolkit
+
+from ckanext.glasgow.logic.action import (
+    ECAPINotAuthorized,
+    send_request_to_ec_platform,
+)
+from ckanext.glasgow.tests import mock_ec, run_mock_ec
+
+
+eq_ = nose.tools.eq_
+
+
+class TestFaultInjection(object):
+
+    def setup(self):
+        self.app = mock_ec.app.test_client()
+
+    def teardown(self):
+        mock_ec.clear_faults()
+
+    @mock.patch('ckanext.glasgow.tests.mock_ec.time.sleep')
+    def test_fixed_delay(self, mock_sleep):
+        fault = mock_ec.set_fault('request_orgs', delay=0.5)
+
+        response = self.app.get('/Metadata/Organisation')
+
+        eq_(response.status_code, 200)
+        mock_sleep.assert_called_once_with(0.5)
+        eq_(fault.injected['delay'], 1)
+
+    @mock.patch('ckanext.glasgow.tests.mock_ec.time.sleep')
+    def test_random_delay(self, mock_sleep):
+        mock_ec.set_fault(delay=(0.1, 0.3), seed=1)
+
+        for i in range(5):
+            self.app.get('/Metadata/Organisation')
+
+        eq_(mock_sleep.call_count, 5)
+        for call in mock_sleep.call_args_list:
+            assert 0.1 <= call[0][0] <= 0.3
+
+    def test_error_rate(self):
+        fault = mock_ec.set_fault('request_orgs', error_rate=1,
+                                  error_status=502)
+
+        response = self.app.get('/Metadata/Organisation')
+
+        eq_(response.status_code, 502)
+        eq_(json.loads(response.data)['IsErrorResponse'], True)
+        eq_(fault.injected['error'], 1)
+
+    def test_error_rate_is_a_share_of_requests(self):
+        fault = mock_ec.set_fault(error_rate=0.5, seed=2)
+
+        statuses = [self.app.get('/Metadata/Organisation').status_code
+                    for i in range(100)]
+
+        eq_(statuses.count(503), fault.injected['error'])
+        assert 20 < fault.injected['error'] < 80
+
+    def test_unauthorized(self):
+        mock_ec.set_fault('request_orgs', unauthorized_rate=1)
+
+        eq_(self.app.get('/Metadata/Organisation').status_code, 401)
+
+    def test_truncated_json(self):
+        mock_ec.set_fault('request_orgs', truncate_rate=1)
+
+        response = self.app.get('/Metadata/Organisation')
+
+        eq_(response.status_code, 200)
+        eq_(int(response.headers['Content-Length']), len(response.data))
+        nose.tools.assert_raises(ValueError, json.loads, response.data)
+
+    @mock.patch('ckanext.glasgow.tests.mock_ec.time.sleep')
+    def test_slow_body(self, mock_sleep):
+        expected = self.app.get('/Metadata/Organisation').data
+        mock_ec.set_fault('request_orgs', chunk_size=100, chunk_delay=0.2)
+
+        response = self.app.get('/Metadata/Organisation')
+
+        eq_(response.data, expected)
+        eq_(mock_sleep.call_count, (len(expected) + 99) / 100)
+
+    def test_faults_are_per_route(self):
+        mock_ec.set_fault('request_orgs', error_rate=1)
+
+        eq_(self.app.get('/Metadata/Organisation').status_code, 503)
+        eq_(self.app.get('/Organisations/1/Datasets').status_code, 200)
+
+    def test_load_faults(self):
+        f = tempfile.NamedTemporaryFile(suffix='.json', delete=False)
+        json.dump({
+            '*': {'delay': [0.1, 0.2]},
+            'request_orgs': {'error_rate': 1},
+        }, f)
+        f.close()
+
+        try:
+            mock_ec.load_faults(f.name)
+        finally:
+            os.remove(f.name)
+
+        eq_(mock_ec.faults['*'].delay, [0.1, 0.2])
+        eq_(mock_ec.faults['request_orgs'].error_rate, 1)
+
+
+class TestRequestsWithFaults(object):
+
+    @classmethod
+    def setup_class(cls):
+        run_mock_ec()
+
+    def setup(self):
+        self.url = config['ckanext.glasgow.metadata_api'].rstrip('/') + \
+            '/Metadata/Organisation'
+        self.headers = {'Authorization': 'Bearer token'}
+
+    def teardown(self):
+        mock_ec.clear_faults()
+
+    def test_timeout(self):
+        mock_ec.set_fault('request_orgs', delay=1)
+
+        nose.tools.assert_raises(
+            toolkit.ValidationError, send_request_to_ec_platform,
+            'GET', self.url, headers=self.headers, timeout=0.2)
+
+    def test_truncated_json(self):
+        mock_ec.set_fault('request_orgs', truncate_rate=1)
+
+        with nose.tools.assert_raises(toolkit.ValidationError) as cm:
+            send_request_to_ec_platform('GET', self.url,
+                                        headers=self.headers)
+
+        eq_(cm.exception.error_dict['message'],
+            ['Error decoding JSON from EC Platform response'])
+
+    def test_unauthorized(self):
+        mock_ec.set_fault('request_orgs', unauthorized_rate=1)
+
+        nose.tools.assert_raises(
+            ECAPINotAuthorized, send_request_to_ec_platform,
+            'GET', self.url, headers=self.headers)
+
+    def test_slow_body(self):
+        mock_ec.set_fault('request_orgs', chunk_size=50, chunk_delay=0.01)
+
+        content = send_request_to_ec_platform('GET', self.url,
+                                              headers=self.headers)
+
+        eq_(len(content['MetadataResultSet']), 3)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import cgi
+import json
+import StringIO
+
+import mock
+import nose
+
+from ckanext.glasgow import streaming
+
+
+eq_ = nose.tools.eq_
+
+
+def _chunks(body, size):
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+
+class TestJSONListStream(object):
+
+    def test_items_and_fields(self):
+        response = {
+            'IsErrorResponse': False,
+            'MetadataResultSet': [
+                {'Id': i, 'Title': u'Dataset {0} with spéciàl çhãrs'.format(i)}
+                for i in range(20)],
+            'Count': 20,
+        }
+        body = json.dumps(response)
+
+        # Small chunks to split tokens and multi-byte characters
+        for size in (1, 3, 100):
+            result = streaming.JSONListStream(_chunks(body, size),
+                                              'MetadataResultSet')
+
+            eq_(list(result), response['MetadataResultSet'])
+            eq_(result.fields, {'IsErrorResponse': False, 'Count': 20})
+
+    def test_items_are_yielded_as_received(self):
+        chunks = iter(['{"MetadataResultSet": [{"Id": 1}, ', '{"Id": 2}]}'])
+        result = iter(streaming.JSONListStream(chunks, 'MetadataResultSet'))
+
+        eq_(next(result), {'Id': 1})
+        # The second chunk has not been read yet
+        eq_(list(chunks), ['{"Id": 2}]}'])
+
+    def test_missing_or_null_list(self):
+        for body in ('{}', '{"MetadataResultSet": null}'):
+            result = streaming.JSONListStream([body], 'MetadataResultSet')
+
+            eq_(list(result), [])
+
+    def test_not_json(self):
+        for body in ('<html>not json</html>', '{"MetadataResultSet": [{',
+                     ''):
+            result = streaming.JSONListStream([body], 'MetadataResultSet')
+
+            nose.tools.assert_raises(ValueError, list, result)
+
+
+class TestIterRawContent(object):
+
+    def test_chunks_and_close(self):
+        response = mock.Mock()
+        response.raw.stream.return_value = iter(['a', 'b'])
+
+        eq_(list(streaming.iter_raw_content(response, chunk_size=1)),
+            ['a', 'b'])
+        response.raw.stream.assert_called_with(1, decode_content=False)
+        assert response.close.called
+
+
+class TestMultipartEncoder(object):
+
+    def _get_encoder(self, **kwargs):
+        upload = StringIO.StringIO()
+        upload.write('File contents ' * 1000)
+        upload.seek(0)
+
+        encoder = streaming.MultipartEncoder([
+            ('metadata', json.dumps({'Title': u'Tést'})),
+            ('file', (u'tést.csv', upload, 'text/csv')),
+        ], **kwargs)
+        return encoder, upload
+
+    def _parse(self, encoder, body):
+        return cgi.FieldStorage(
+            fp=StringIO.StringIO(body),
+            environ={
+                'REQUEST_METHOD': 'POST',
+                'CONTENT_TYPE': encoder.content_type,
+                'CONTENT_LENGTH': str(len(body)),
+            })
+
+    def test_body(self):
+        for size in (1, 7, 100, -1):
+            encoder, upload = self._get_encoder()
+            body = ''
+            while True:
+                chunk = encoder.read(size)
+                if not chunk:
+                    break
+                body += chunk
+
+            eq_(len(body), len(encoder))
+
+            form = self._parse(encoder, body)
+            eq_(json.loads(form['metadata'].value), {'Title': u'Tést'})
+            eq_(form['file'].value, 'File contents ' * 1000)
+            eq_(form['file'].filename, u'tést.csv'.encode('utf-8'))
+            eq_(form['file'].type, 'text/csv')
+
+    def test_byte_string_filename(self):
+        upload = StringIO.StringIO('a,b\n1,2\n')
+        encoder = streaming.MultipartEncoder([
+            ('file', ('Donn\xc3\xa9es.csv', upload)),
+        ])
+
+        form = self._parse(encoder, encoder.read())
+        eq_(form['file'].filename, 'Donn\xc3\xa9es.csv')
+        eq_(form['file'].value, 'a,b\n1,2\n')
+
+    def test_rewind(self):
+        encoder, upload = self._get_encoder(chunk_size=10)
+
+        body = ''.join(encoder)
+        encoder.rewind()
+
+        eq_(''.join(encoder), body)
+
+    def test_callback(self):
+        callback = mock.Mock()
+        encoder, upload = self._get_encoder(callback=callback)
+
+        body = encoder.read()
+
+        callback.assert_called_with(len(body), len(encoder))
+
+    def test_summary(self):
+        encoder, upload = self._get_encoder()
+
+        eq_(encoder.summary(), {
+            'metadata': json.dumps({'Title': u'Tést'}),
+            'file': {'filename': u'tést.csv'},
+        })
@@ -0,0 +1,180 @@
+'''
+Cache for the auth tokens used to call the EC platform APIs
+
+Getting a Service to Service token from WAAD is a remote request, and the
+temporary token is read from a file, so tokens are kept in memory (per
+process) and reused until shortly before they expire.
+
+Tokens are cached by a key (eg the audience of a Service to Service
+token). The expiry time is read from the `exp` claim if the token is a
+JWT, otherwise a fixed time to live is used. When a token needs to be
+refreshed only one thread requests a new one, and any others needing the
+same token wait for it instead of requesting their own.
+
+Relevant configuration options:
+
+    # Set to false to disable the cache (default true)
+    ckanext.glasgow.auth_token.cache = true
+
+    # Seconds to keep tokens with no known expiry (default 300)
+    ckanext.glasgow.auth_token.ttl = 300
+
+    # Seconds before the expiry time when tokens are refreshed (default 60)
+    ckanext.glasgow.auth_token.refresh_margin = 60
+
+'''
+import base64
+import json
+import logging
+import threading
+import time
+
+from pylons import config
+
+import ckan.plugins as p
+
+import ckanext.oauth2waad.plugin as oauth2
+
+
+log = logging.getLogger(__name__)
+
+_tokens = {}
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def _get_lock(key):
+    lock = _locks.get(key)
+    if lock is None:
+        with _locks_lock:
+            lock = _locks.setdefault(key, threading.Lock())
+    return lock
+
+
+def _is_fresh(entry):
+    if entry is None:
+        return False
+
+    token, expires = entry
+    margin = float(
+        config.get('ckanext.glasgow.auth_token.refresh_margin', 60))
+
+    return time.time() < expires - margin
+
+
+def get_token_expiry(token):
+    '''
+    Returns the expiry time of a JWT token, from its `exp` claim
+
+    :param token: the token, with or without the `Bearer` prefix
+    :type token: string
+
+    :returns: the expiry time as a Unix timestamp, or None if the token is
+              not a JWT or does not include an expiry time
+    :rtype: float
+    '''
+
+    if token.startswith('Bearer '):
+        token = token[len('Bearer '):]
+
+    parts = token.split('.')
+    if len(parts) != 3:
+        return None
+
+    payload = parts[1]
+    payload += '=' * (-len(payload) % 4)
+    try:
+        claims = json.loads(base64.urlsafe_b64decode(str(payload)))
+        return float(claims['exp'])
+    except (TypeError, ValueError, KeyError):
+        return None
+
+
+def get_token(key, fetch):
+    '''
+    Returns the cached token for `key`, getting a new one if needed
+
+    :param key: cache key for the token
+    :param fetch: function with no parameters that returns a new token. Any
+                  exception raised is passed to the caller, and nothing is
+                  cached.
+
+    :returns: the token
+    :rtype: string
+    '''
+
+    if not p.toolkit.asbool(
+            config.get('ckanext.glasgow.auth_token.cache', True)):
+        return fetch()
+
+    entry = _tokens.get(key)
+    if _is_fresh(entry):
+        return entry[0]
+
+    with _get_lock(key):
+        # Another thread may have refreshed it while we were waiting
+        entry = _tokens.get(key)
+        if _is_fresh(entry):
+            return entry[0]
+
+        log.debug('Getting new auth token for {0}'.format(key))
+        token = fetch()
+
+        expires = get_token_expiry(token)
+        if expires is None:
+            expires = time.time() + float(
+                config.get('ckanext.glasgow.auth_token.ttl', 300))
+
+        _tokens[key] = (token, expires)
+
+    return token
+
+
+def invalidate(key=None):
+    '''
+    Removes a token from the cache (or all of them if no key is provided)
+
+    Useful if the EC API rejected a token before its expiry time.
+    '''
+    if key is None:
+        _tokens.clear()
+    else:
+        _tokens.pop(key, None)
+
+
+def service_to_service_access_token(audience):
+    '''
+    Cached version of `service_to_service_access_token` from
+    ckanext-oauth2waad
+
+    :param audience: the EC API the token is for, eg `metadata`, `identity`
+                     or `data_collection`
+    :type audience: string
+
+    :raises: :py:exc:`ckanext.oauth2waad.plugin.ServiceToServiceAccessTokenError`
+        if a new token could not be obtained
+
+    :returns: the access token
+    :rtype: string
+    '''
+
+    return get_token(
+        ('service_to_service', audience),
+        lambda: oauth2.service_to_service_access_token(audience))
+
+
+def tmp_auth_token(path):
+    '''
+    Returns the temporary token stored in the provided file
+
+    :raises: IOError if the file could not be read
+
+    :returns: the token
+    :rtype: string
+    '''
+
+    def read():
+        with open(path, 'r') as f:
+            return f.read().strip('\n')
+
+    return get_token(('tmp_auth_token_file', path), read)
@@ -33,6 +33,8 @@ setup(
     changelog_update=ckanext.glasgow.commands.changelog_update:UpdateFromEcApiChangeLog
     changelog_audit=ckanext.glasgow.commands.changelog_update:ChangelogAudit
     db_clean=ckanext.glasgow.commands.changelog_update:Cleanup
+    request_tasks=ckanext.glasgow.commands.changelog_update:RequestTasks
     get_initial_users=ckanext.glasgow.commands.get_users:GetInitialUsers
+    glasgow_benchmark=ckanext.glasgow.commands.benchmark:Benchmark
     ''',
 )